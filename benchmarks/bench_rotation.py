@@ -0,0 +1,123 @@
+"""
+Many processes sending and validating tokens across rotation boundaries,
+against a local redis stand-in (`fakeredis.TcpFakeServer`), or a real server
+with `--redis-url`. The stand-in is much slower than redis, only compare
+throughputs measured against the same server.
+
+Each process gets the token (as a sender would) and validates the tokens it
+got `--latency` seconds earlier (as a receiver would). It reports:
+- rotations per window: tokens created by all processes per rotation window
+  (`TOKEN_TTL - TOKEN_TTL_EXPIRY_THRESHOLD` seconds). 1 is ideal, more means
+  processes raced to rotate the token.
+- false-rejection rate: tokens handed out by the library but rejected when
+  they were validated.
+
+    python benchmarks/bench_rotation.py [--processes N] [--duration S]
+"""
+import argparse
+import collections
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from common import setup_django  # noqa
+
+
+def run_worker(args, barrier, results):
+    from kobo_service_account.metrics import TOKEN_ROTATIONS, get_metrics_sink
+    from kobo_service_account.models import ServiceAccountUser
+
+    sink = get_metrics_sink()
+    sent = collections.deque()
+    validations = rejections = calls = 0
+    barrier.wait()
+
+    deadline = time.monotonic() + args.duration
+    while (now := time.monotonic()) < deadline:
+        sent.append((now, ServiceAccountUser.get_or_create_authentication_token()))
+        calls += 1
+        while sent and sent[0][0] <= now - args.latency:
+            _, token = sent.popleft()
+            validations += 1
+            if not ServiceAccountUser.has_valid_authentication_token(token):
+                rejections += 1
+
+    results.put({
+        'calls': calls,
+        'validations': validations,
+        'rejections': rejections,
+        'rotations': sink.get_counter(TOKEN_ROTATIONS),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--ttl', type=int, default=3)
+    parser.add_argument('--threshold', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--redis-url', help='Use a real redis server')
+    parser.add_argument(
+        '--no-local-cache',
+        action='store_true',
+        help='Disable LOCAL_TOKEN_CACHE and VALIDATED_TOKEN_CACHE_SIZE',
+    )
+    args = parser.parse_args()
+
+    server = None
+    backend = {}
+    if not (location := args.redis_url):
+        import fakeredis
+
+        server = fakeredis.TcpFakeServer(('127.0.0.1', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+        location = f'redis://{host}:{port}/0'
+        # The stand-in is much slower than redis under contention
+        backend['OPTIONS'] = {'SOCKET_TIMEOUT': 10, 'SOCKET_CONNECT_TIMEOUT': 10}
+
+    setup_django(
+        BACKEND={'LOCATION': location, **backend},
+        TOKEN_TTL=args.ttl,
+        TOKEN_TTL_EXPIRY_THRESHOLD=args.threshold,
+        LOCAL_TOKEN_CACHE=not args.no_local_cache,
+        VALIDATED_TOKEN_CACHE_SIZE=0 if args.no_local_cache else 32,
+        METRICS_SINK='kobo_service_account.metrics.InMemoryMetricsSink',
+    )
+
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(args.processes)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=run_worker, args=(args, barrier, results))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    totals = collections.Counter()
+    for _ in processes:
+        totals.update(results.get())
+    for process in processes:
+        process.join()
+    if server is not None:
+        server.shutdown()
+
+    windows = args.duration / (args.ttl - args.threshold)
+    validations = totals['validations'] or 1
+    print(f'processes:            {args.processes}')
+    print(f'duration:             {args.duration}s')
+    print(f'token calls:          {totals["calls"]:,}')
+    print(f'validations:          {totals["validations"]:,}')
+    print(f'rotations:            {totals["rotations"]:.0f}')
+    print(f'rotations per window: {totals["rotations"] / windows:.2f}')
+    print(f'false rejections:     {totals["rejections"]:,} '
+          f'({totals["rejections"] / validations:.4%})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Throughput and latency of the hot paths of kobo-service-account:
+`ServiceAccountAuthentication.authenticate()`, `get_request_headers()` and
+`get_real_user()`.
+
+Tokens are stored in `fakeredis` by default, so results measure the overhead
+of this library (and of redis-py) without network latency. Use `--redis-url`
+to run them against a real server.
+
+    python benchmarks/bench_service_account.py [--iterations N] [--redis-url URL]
+"""
+import argparse
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from common import measure, print_header, print_result, setup_django  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--redis-url', help='Use a real redis server')
+    args = parser.parse_args()
+
+    setup_django(
+        BACKEND={'LOCATION': args.redis_url or 'redis://localhost/'},
+    )
+
+    import fakeredis
+    from django.contrib.auth import get_user_model
+
+    from kobo_service_account.authentication import ServiceAccountAuthentication
+    from kobo_service_account.config import compile_settings
+    from kobo_service_account.models import ServiceAccountUser
+    from kobo_service_account.settings import service_account_settings
+    from kobo_service_account.stores import InMemoryTokenStore, RedisTokenStore
+    from kobo_service_account.utils import (
+        get_real_user,
+        get_request_headers,
+        real_user_cache,
+    )
+
+    def _use_store(store):
+        ServiceAccountUser.token_store = store
+        ServiceAccountUser.token_cache.clear()
+        ServiceAccountUser.validated_tokens.clear()
+
+    def _override(**new_settings):
+        for setting, value in new_settings.items():
+            setattr(service_account_settings, setting, value)
+        compile_settings()
+
+    if args.redis_url:
+        redis_store = RedisTokenStore()
+    else:
+        redis_store = RedisTokenStore(fakeredis.FakeStrictRedis())
+    stores = {'redis': redis_store, 'memory': InMemoryTokenStore()}
+
+    user = get_user_model().objects.create(username='bench')
+    iterations = args.iterations
+    auth_class = ServiceAccountAuthentication()
+
+    def _request():
+        headers = get_request_headers(user.username)
+        return SimpleNamespace(
+            user=ServiceAccountUser(),
+            headers=headers,
+            META={
+                'HTTP_AUTHORIZATION': headers['Authorization'],
+                'HTTP_HOST': 'testserver',
+                'HTTP_KOBO_SERVICE_ACCOUNT_ON_BEHALF': user.username,
+            },
+        )
+
+    print_header('authenticate()')
+    for store_name, store in stores.items():
+        for cache_size in (0, 32):
+            _use_store(store)
+            _override(VALIDATED_TOKEN_CACHE_SIZE=cache_size)
+            request = _request()
+            result = measure(lambda: auth_class.authenticate(request), iterations)
+            print_result(
+                f'{store_name}, validated token cache={cache_size}', result
+            )
+
+    _use_store(redis_store)
+    _override(WHITELISTED_HOSTS=['*.kobotoolbox.org', 'testserver'])
+    request = _request()
+    result = measure(lambda: auth_class.authenticate(request), iterations)
+    print_result('redis, with whitelisted hosts', result)
+    _override(WHITELISTED_HOSTS=[])
+
+    print_header('get_request_headers()')
+    for local_cache in (False, True):
+        _use_store(redis_store)
+        _override(LOCAL_TOKEN_CACHE=local_cache)
+        result = measure(lambda: get_request_headers(user.username), iterations)
+        print_result(f'redis, local token cache={local_cache}', result)
+
+    print_header('get_real_user()')
+    request = _request()
+    for cache_size in (0, 100):
+        real_user_cache.clear()
+        _override(REAL_USER_CACHE_SIZE=cache_size)
+        result = measure(lambda: get_real_user(request), iterations // 10)
+        print_result(f'real user cache={cache_size}', result)
+
+    _override(REAL_USER_CACHE_SIZE=0, REAL_USER_FIELDS=['id', 'username'])
+    result = measure(lambda: get_real_user(request), iterations // 10)
+    print_result('real user cache=0, only id and username', result)
+
+
+if __name__ == '__main__':
+    main()
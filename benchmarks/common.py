@@ -0,0 +1,90 @@
+"""
+Helpers shared by benchmarks: Django setup, timing and reporting.
+
+Benchmarks are plain scripts, not collected by pytest. Run them from the root
+of the repository, e.g. `python benchmarks/bench_service_account.py`.
+"""
+import statistics
+import time
+from copy import deepcopy
+from typing import Callable, Optional
+
+import django
+from django.conf import settings
+
+
+def setup_django(**service_account_settings):
+    """
+    Configure Django with an in-memory database, like the test suite
+    """
+    from kobo_service_account.settings import DEFAULTS
+
+    test_settings = deepcopy(DEFAULTS)
+    test_settings.update(service_account_settings)
+    settings.configure(
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+        ],
+        SERVICE_ACCOUNT=test_settings,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            }
+        },
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def measure(
+    func: Callable[[], object],
+    iterations: int,
+    warmup: Optional[int] = None,
+) -> dict:
+    """
+    Call `func` `iterations` times and return throughput (calls per second)
+    and latency percentiles (in microseconds)
+    """
+    for _ in range(warmup if warmup is not None else iterations // 10):
+        func()
+
+    latencies = []
+    perf_counter = time.perf_counter
+    start = perf_counter()
+    for _ in range(iterations):
+        call_start = perf_counter()
+        func()
+        latencies.append(perf_counter() - call_start)
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+    return {
+        'ops': iterations / elapsed,
+        'p50': _percentile(latencies, 50) * 1e6,
+        'p99': _percentile(latencies, 99) * 1e6,
+        'mean': statistics.fmean(latencies) * 1e6,
+    }
+
+
+def print_header(title: str):
+    print(f'\n{title}')
+    print(f'{"benchmark":<48} {"ops/s":>12} {"p50 µs":>10} {"p99 µs":>10}')
+
+
+def print_result(name: str, result: dict):
+    print(
+        f'{name:<48} {result["ops"]:>12,.0f} '
+        f'{result["p50"]:>10.1f} {result["p99"]:>10.1f}'
+    )
+
+
+def _percentile(sorted_values: list, percent: float) -> float:
+    index = min(
+        int(round(percent / 100 * (len(sorted_values) - 1))),
+        len(sorted_values) - 1,
+    )
+    return sorted_values[index]
@@ -1,8 +1,10 @@
 from copy import deepcopy
 from typing import Any
 
+import fakeredis
 import pytest
 from django.conf import settings
+from mock import patch
 from kobo_service_account.settings import DEFAULTS, service_account_settings
 
 
@@ -10,6 +12,7 @@ def pytest_configure():
     installed_apps = [
         'django.contrib.contenttypes',
         'django.contrib.auth',
+        'kobo_service_account',
     ]
 
     # Update some settings for testing purposes.
@@ -17,6 +20,7 @@ def pytest_configure():
         'TOKEN_TTL': 3,
         'TOKEN_TTL_EXPIRY_THRESHOLD': 2,
         'TOKEN_LENGTH': 10,
+        'TOKEN_STORE': 'kobo_service_account.stores.InMemoryTokenStore',
     }
     test_settings = deepcopy(DEFAULTS)
     test_settings.update(pytest.test_settings)
@@ -35,12 +39,16 @@ def override_settings():
     a test. Same idea as `django.test.utils.override_settings` but without the
     need to pass the all `SERVICE_ACCOUNT` dictionary
     """
+    from kobo_service_account.config import compile_settings
     old_settings = {}
 
     def _override_settings(**new_settings):
         for setting, new_value in new_settings.items():
-            old_settings[setting] = getattr(service_account_settings, setting)
+            old_settings.setdefault(
+                setting, getattr(service_account_settings, setting)
+            )
             setattr(service_account_settings, setting, new_value)
+        compile_settings()
         return new_settings
 
     yield _override_settings
@@ -48,3 +56,39 @@ def override_settings():
     # TearDown
     for setting, old_value in old_settings.items():
         setattr(service_account_settings, setting, old_value)
+    compile_settings()
+
+
+@pytest.fixture(autouse=True)
+def clear_token_caches():
+    """
+    Start each test with an empty token store and empty process-local caches
+    """
+    from kobo_service_account.authentication import ServiceAccountAuthentication
+    from kobo_service_account.models import ServiceAccountUser
+    from kobo_service_account.utils import real_user_cache
+    vars(ServiceAccountAuthentication)['failure_limiter'].reset()
+    vars(ServiceAccountUser)['token_store'].reset()
+    vars(ServiceAccountUser)['circuit_breaker'].reset()
+    ServiceAccountUser.token_cache.clear()
+    ServiceAccountUser._identity_token_caches.clear()
+    ServiceAccountUser.validated_tokens.clear()
+    ServiceAccountUser.permission_cache.clear()
+    real_user_cache.clear()
+
+
+@pytest.fixture
+def redis_store():
+    """
+    Store tokens in a fake redis server, to test redis-specific behaviours
+    (round-trips, pub/sub, asyncio clients)
+    """
+    from kobo_service_account.models import ServiceAccountUser
+    from kobo_service_account.stores import RedisTokenStore
+    server = fakeredis.FakeServer()
+    store = RedisTokenStore(
+        fakeredis.FakeStrictRedis(server=server),
+        fakeredis.FakeAsyncRedis(server=server),
+    )
+    with patch.object(ServiceAccountUser, 'token_store', store):
+        yield store
@@ -5,11 +5,17 @@ from setuptools import setup, find_packages
 
 
 requirements = [
+    'asgiref>=3.6',  # `markcoroutinefunction()`
     'Django>=3.2,<4.3',
     'djangorestframework>=3.13,<4',
-    'redis'
+    'redis>=6.2',  # Transactions with Redis Cluster, sync and async
 ]
 
+extras_require = {
+    'httpx': ['httpx'],
+    'requests': ['requests'],
+}
+
 dep_links = []
 
 
@@ -21,7 +27,9 @@ setup(
     url='https://github.com/kobotoolbox/kobo-service-account/',
     packages=[str(pkg) for pkg in find_packages('src')],
     package_dir={'': 'src'},
+    python_requires='>=3.9',
     install_requires=requirements,
+    extras_require=extras_require,
     dependency_links=dep_links,
     include_package_data=True,
     zip_safe=False,
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class ServiceAccountConfig(AppConfig):
+    name = 'kobo_service_account'
+    verbose_name = 'Kobo Service Account'
+
+    def ready(self):
+        from .config import compile_settings
+
+        # Compile settings before the first request needs them
+        compile_settings()
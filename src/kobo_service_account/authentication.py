@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from typing import Optional
+
 from django.contrib.auth import get_user_model
 from django.core.exceptions import BadRequest
 from django.utils.translation import gettext_lazy as t
@@ -10,9 +12,22 @@ from rest_framework.authentication import (
 )
 from rest_framework.request import Request
 
+from .config import get_host_policy
+from .connection import ProcessLocal
 from .exceptions import HostNotAllowedException
+from .metrics import (
+    REDIS_ROUND_TRIPS_PER_REQUEST,
+    THROTTLED_AUTHENTICATIONS,
+    get_metrics_sink,
+)
 from .models import ServiceAccountUser
 from .settings import service_account_settings as settings
+from .stats import redis_round_trips
+from .throttling import create_failure_limiter
+
+# Attribute of the Django request where the middleware keeps the user and
+# the token it authenticated
+MIDDLEWARE_AUTHENTICATION_ATTRIBUTE = '_service_account_authentication'
 
 
 class ServiceAccountAuthentication(BaseAuthentication):
@@ -26,14 +41,102 @@ class ServiceAccountAuthentication(BaseAuthentication):
     For example:
 
         Authorization: ServiceAccountToken 401f7ac837da42b97f613d789819ff93537bee6a
+
+    Sources which send too many invalid tokens are throttled (see
+    `settings.FAILED_AUTHENTICATION_LIMIT`).
     """
 
     keyword = 'ServiceAccountToken'
+    # `keyword` as found in headers, computed once per class
+    _keyword_prefix = f'{keyword} '
+    _keyword_bytes = keyword.lower().encode()
+    failure_limiter = ProcessLocal(create_failure_limiter)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._keyword_prefix = f'{cls.keyword} '
+        cls._keyword_bytes = cls.keyword.lower().encode()
 
     def authenticate(self, request: Request):
+        if (authenticated := self._get_middleware_authentication(request)):
+            return authenticated
+
+        if (token := self._get_token(request)) is None:
+            return None
+
+        return self.authenticate_credentials(token, request)
+
+    async def aauthenticate(self, request: Request):
+        """
+        Async counterpart of `authenticate()`, e.g. for ASGI views.
+        DRF itself only calls `authenticate()`.
+        """
+        if (authenticated := self._get_middleware_authentication(request)):
+            return authenticated
+
+        if (token := self._get_token(request)) is None:
+            return None
+
+        return await self.aauthenticate_credentials(token, request)
+
+    def authenticate_credentials(
+        self, token: str, request: Request
+    ) -> tuple['settings.AUTH_USER_MODEL', str]:
+        # Disallowed hosts are rejected before querying the token store.
+        self._validate_host(request)
+        source = self._get_failure_source(request)
+        round_trips = redis_round_trips.context_count
+        service_account_user = ServiceAccountUser.get_instance(
+            ServiceAccountUser.get_token_identity(token)
+        )
+        is_valid = service_account_user.has_valid_authentication_token(token)
+        if not is_valid and source is not None:
+            self.failure_limiter.record_failure(source)
+        self._record_round_trips(round_trips)
+        if not is_valid:
+            raise exceptions.AuthenticationFailed(t('Invalid token header.'))
+
+        return service_account_user, token
+
+    async def aauthenticate_credentials(
+        self, token: str, request: Request
+    ) -> tuple['settings.AUTH_USER_MODEL', str]:
+        # Disallowed hosts are rejected before querying the token store.
+        self._validate_host(request)
+        source = self._get_failure_source(request)
+        round_trips = redis_round_trips.context_count
+        service_account_user = ServiceAccountUser.get_instance(
+            ServiceAccountUser.get_token_identity(token)
+        )
+        is_valid = await service_account_user.ahas_valid_authentication_token(token)
+        if not is_valid and source is not None:
+            await self.failure_limiter.arecord_failure(source)
+        self._record_round_trips(round_trips)
+        if not is_valid:
+            raise exceptions.AuthenticationFailed(t('Invalid token header.'))
+
+        return service_account_user, token
+
+    def authenticate_header(self, request: Request):
+        return self.keyword
+
+    def _get_token(self, request: Request) -> Optional[str]:
+        """
+        Return the token passed in the "Authorization" header, or `None` if
+        the header does not use this authentication scheme.
+        """
+        # Fast path for well-formed headers: printable ASCII tokens need
+        # neither splitting nor encoding.
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        prefix = self._keyword_prefix
+        if isinstance(header, str) and header.startswith(prefix):
+            token = header[len(prefix):]
+            if token and token.isascii() and token.isprintable() and ' ' not in token:
+                return token
+
         auth = get_authorization_header(request).split()
 
-        if not auth or auth[0].lower() != self.keyword.lower().encode():
+        if not auth or auth[0].lower() != self._keyword_bytes:
             return None
 
         if len(auth) == 1:
@@ -44,31 +147,58 @@ class ServiceAccountAuthentication(BaseAuthentication):
             raise exceptions.AuthenticationFailed(msg)
 
         try:
-            token = auth[1].decode()
+            return auth[1].decode()
         except UnicodeError:
             msg = t(
                 'Invalid token header. Token string should not contain invalid characters.')
             raise exceptions.AuthenticationFailed(msg)
 
-        return self.authenticate_credentials(token, request)
+    def _get_failure_source(self, request: Request) -> Optional[str]:
+        """
+        Return the source of `request` whose failures are counted, or `None`
+        if failures are not limited.
 
-    def authenticate_credentials(
-        self, token: str, request: Request
-    ) -> tuple['settings.AUTH_USER_MODEL', str]:
-        service_account_user = ServiceAccountUser()
-        if not service_account_user.has_valid_authentication_token(token):
-            raise exceptions.AuthenticationFailed(t('Invalid token header.'))
+        Raise `Throttled` if the source is blocked, before querying the token
+        store.
+        """
+        if settings.FAILED_AUTHENTICATION_LIMIT <= 0:
+            return None
 
-        if settings.WHITELISTED_HOSTS:
-            try:
-                http_host = request.META['HTTP_HOST']
-            except KeyError:
-                raise BadRequest
+        source = request.META.get(settings.FAILED_AUTHENTICATION_SOURCE)
+        if source is None:
+            return None
 
-            if http_host not in settings.WHITELISTED_HOSTS:
-                raise HostNotAllowedException
+        if (retry_after := self.failure_limiter.get_retry_after(source)) is not None:
+            get_metrics_sink().increment(THROTTLED_AUTHENTICATIONS)
+            raise exceptions.Throttled(retry_after)
+        return source
+
+    @staticmethod
+    def _get_middleware_authentication(
+        request: Request,
+    ) -> Optional[tuple['settings.AUTH_USER_MODEL', str]]:
+        """
+        Return the user and the token authenticated by
+        `ServiceAccountAuthenticationMiddleware`, if any
+        """
+        # DRF requests proxy missing attributes to the Django request.
+        return getattr(request, MIDDLEWARE_AUTHENTICATION_ATTRIBUTE, None)
+
+    @staticmethod
+    def _record_round_trips(start_count: int):
+        get_metrics_sink().observe(
+            REDIS_ROUND_TRIPS_PER_REQUEST,
+            redis_round_trips.context_count - start_count,
+        )
+
+    def _validate_host(self, request: Request):
+        if (host_policy := get_host_policy()) is None:
+            return
 
-        return service_account_user, token
+        try:
+            http_host = request.META['HTTP_HOST']
+        except KeyError:
+            raise BadRequest
 
-    def authenticate_header(self, request: Request):
-        return self.keyword
+        if not host_policy.is_allowed(http_host):
+            raise HostNotAllowedException
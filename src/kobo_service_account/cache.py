@@ -0,0 +1,537 @@
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterator, NamedTuple, Optional
+
+import redis
+import redis.asyncio
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Published when the token of the default identity is rotated. Other
+# identities publish their name.
+INVALIDATION_MESSAGE = 'rotate'
+
+_MISSING = object()
+
+
+class LocalTokenCache:
+    """
+    Process-local copy of the authentication token used to sign outgoing
+    requests.
+
+    The expiry is tracked with the local monotonic clock, so the cache knows
+    when the token is about to expire without asking redis for its TTL.
+    """
+
+    def __init__(self):
+        # `lock` is exposed to let callers serialize the (slow) refresh from
+        # redis. Reads never acquire it.
+        self.lock = threading.Lock()
+        # Token and expiry are stored together in one tuple to be read and
+        # replaced atomically.
+        self._entry = (None, 0.0)
+
+    def clear(self):
+        self._entry = (None, 0.0)
+
+    def get(self, min_ttl: float) -> Optional[str]:
+        """
+        Return the cached token if it is still valid for at least
+        `min_ttl` seconds, `None` otherwise.
+        """
+        token, _ = self.get_with_ttl(min_ttl)
+        return token
+
+    def get_with_ttl(self, min_ttl: float) -> tuple[Optional[str], float]:
+        """
+        Same as `get()` but also return the remaining time to live (in seconds)
+        of the token.
+        """
+        token, expires_at = self._entry
+        ttl = expires_at - time.monotonic()
+        if token and ttl >= min_ttl:
+            return token, ttl
+        return None, 0
+
+    def set(self, token: str, ttl: float, now: Optional[float] = None):
+        """
+        Cache `token` for `ttl` seconds from `now` (monotonic clock).
+
+        `now` should be read before asking redis for the TTL, so the local
+        expiry never ends up later than the real one.
+        """
+        if now is None:
+            now = time.monotonic()
+        self._entry = (token, now + ttl)
+
+
+class ExpiringLRUCache:
+    """
+    Thread-safe, bounded in-memory cache where each entry has its own expiry.
+
+    The least recently used entries are evicted first when the size given to
+    `set()` is reached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate: Callable[[Any], bool]):
+        """
+        Remove all entries whose value matches `predicate`
+        """
+        with self._lock:
+            for key in [k for k, (v, _) in self._entries.items() if predicate(v)]:
+                del self._entries[key]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value, expires_at = self._entries[key]
+            except KeyError:
+                return default
+
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl: float,
+        max_size: int,
+        now: Optional[float] = None,
+    ):
+        if max_size <= 0:
+            return
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (value, now + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+
+class ValidatedTokenCache(ExpiringLRUCache):
+    """
+    Bounded in-memory set of tokens already accepted by redis, used on the
+    receiving side.
+
+    Each token is kept until the expiry of its redis key.
+
+    Digests of rejected tokens are kept apart (see `add_rejected()`), with
+    their own bound, so invalid tokens never evict valid ones. Both are
+    dropped on rotation.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._rejected = ExpiringLRUCache()
+
+    def add(
+        self,
+        token: str,
+        ttl: float,
+        max_size: int,
+        now: Optional[float] = None,
+        identity: Optional[str] = None,
+    ):
+        # The identity is the value, so rotating the token of one identity
+        # only drops the tokens of that identity.
+        self.set(token, identity, ttl, max_size, now)
+
+    def add_rejected(
+        self,
+        token: str,
+        ttl: float,
+        max_size: int,
+        now: Optional[float] = None,
+        identity: Optional[str] = None,
+    ):
+        self._rejected.set(_digest(token), identity, ttl, max_size, now)
+
+    def clear(self):
+        super().clear()
+        self._rejected.clear()
+
+    def invalidate(self, identity: Optional[str] = None):
+        """
+        Drop the tokens of `identity` (the default identity if `None`)
+        """
+        def predicate(token_identity):
+            return token_identity == identity
+
+        self.discard_where(predicate)
+        self._rejected.discard_where(predicate)
+
+    def is_rejected(self, token: str) -> bool:
+        return _digest(token) in self._rejected
+
+
+class SharedPair(NamedTuple):
+    current: str
+    current_expires_at: float
+    obsolete: Optional[str]
+    obsolete_expires_at: float
+    refreshed_at: float
+
+
+class SharedMemoryPairCache:
+    """
+    Current and obsolete tokens, with their expiry (wall clock), shared by all
+    processes of a host through a memory-mapped file at `path`.
+
+    Any token written in the file is trusted: `PermissionError` is raised if
+    it is not a regular file private to the effective user (mode 0600), and
+    symbolic links are not followed.
+
+    One process at a time writes, while holding `lock()` (an exclusive
+    `flock()` on the file). Readers never lock: the entry starts with a
+    seqlock-style version counter, odd while a write is in progress, and
+    readers start over if it changed while they were copying the entry.
+    """
+
+    # Tokens (UTF-8) longer than that are not cached
+    MAX_TOKEN_SIZE = 256
+    # Readers give up (and the caller reads the token store) after that many
+    # attempts, e.g. if a writer died in the middle of a write.
+    MAX_READ_ATTEMPTS = 100
+
+    # version, refreshed at, current expiry, obsolete expiry, lengths of the
+    # current and obsolete tokens; then both tokens.
+    _version = struct.Struct('<Q')
+    _header = struct.Struct('<QdddHH')
+    SIZE = _header.size + 2 * MAX_TOKEN_SIZE
+
+    def __init__(self, path: str):
+        if fcntl is None:
+            raise RuntimeError('Shared memory caches require `fcntl.flock()`')
+
+        self.path = path
+        self._thread_lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            check_private(os.fstat(fd), path)
+            # Growing the file zero-fills it, i.e. an empty entry. A file
+            # which has the right size already is left untouched.
+            if os.fstat(fd).st_size < self.SIZE:
+                os.ftruncate(fd, self.SIZE)
+            self._mmap = mmap.mmap(fd, self.SIZE)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def clear(self):
+        """
+        Empty the entry, so the next reader refreshes it. Must be called
+        while holding `lock()`.
+        """
+        self._write(b'', 0, b'', 0, 0)
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def lock(self, blocking: bool = True) -> Iterator[bool]:
+        """
+        Hold the write lock of the host. Yield whether it is held, which is
+        always the case if `blocking`.
+        """
+        if not self._thread_lock.acquire(blocking):
+            yield False
+            return
+
+        try:
+            # `flock()` does not exclude threads sharing the descriptor,
+            # hence the thread lock above.
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(self._fd, flags)
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def read(self) -> Optional[SharedPair]:
+        """
+        Return the cached pair, or `None` if there is none (or if it cannot
+        be read consistently)
+        """
+        mm = self._mmap
+        for _ in range(self.MAX_READ_ATTEMPTS):
+            (version,) = self._version.unpack_from(mm)
+            if version & 1:
+                time.sleep(0)
+                continue
+
+            data = mm[:self.SIZE]
+            if self._version.unpack_from(mm) != (version,):
+                continue
+
+            (
+                _,
+                refreshed_at,
+                current_expires_at,
+                obsolete_expires_at,
+                current_size,
+                obsolete_size,
+            ) = self._header.unpack_from(data)
+            if not current_size:
+                return None
+
+            offset = self._header.size
+            obsolete_offset = offset + self.MAX_TOKEN_SIZE
+            return SharedPair(
+                data[offset:offset + current_size].decode(),
+                current_expires_at,
+                data[obsolete_offset:obsolete_offset + obsolete_size].decode()
+                or None,
+                obsolete_expires_at,
+                refreshed_at,
+            )
+
+        return None
+
+    def write(
+        self,
+        current: Optional[str],
+        current_expires_at: float,
+        obsolete: Optional[str],
+        obsolete_expires_at: float,
+        refreshed_at: float,
+    ):
+        """
+        Replace the entry. Must be called while holding `lock()`.
+        """
+        current = (current or '').encode()
+        obsolete = (obsolete or '').encode()
+        if max(len(current), len(obsolete)) > self.MAX_TOKEN_SIZE:
+            self.clear()
+            return
+
+        self._write(
+            current,
+            current_expires_at,
+            obsolete,
+            obsolete_expires_at,
+            refreshed_at,
+        )
+
+    def _write(
+        self,
+        current: bytes,
+        current_expires_at: float,
+        obsolete: bytes,
+        obsolete_expires_at: float,
+        refreshed_at: float,
+    ):
+        mm = self._mmap
+        (version,) = self._version.unpack_from(mm)
+        # An odd version tells readers a write is in progress.
+        self._version.pack_into(mm, 0, version + 1)
+        offset = self._header.size
+        mm[offset:offset + len(current)] = current
+        obsolete_offset = offset + self.MAX_TOKEN_SIZE
+        mm[obsolete_offset:obsolete_offset + len(obsolete)] = obsolete
+        self._header.pack_into(
+            mm,
+            0,
+            version + 1,
+            refreshed_at,
+            current_expires_at,
+            obsolete_expires_at,
+            len(current),
+            len(obsolete),
+        )
+        self._version.pack_into(mm, 0, version + 2)
+
+
+class TokenInvalidationSubscriber:
+    """
+    Drop the tokens of a `ValidatedTokenCache` as soon as any process
+    rotates the token.
+
+    Invalidation messages are published on a redis channel. They are polled
+    without blocking before each lookup, which only reads what redis has
+    already pushed on the socket and costs no round-trip.
+    """
+
+    def __init__(self, cache: ValidatedTokenCache):
+        self._cache = cache
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._client = None
+        self._channel = None
+        self._pid = None
+        self._subscribed = False
+
+    @property
+    def cache(self) -> ValidatedTokenCache:
+        return self._cache
+
+    def poll(self, redis_client: redis.Redis, channel: str) -> bool:
+        """
+        Process pending invalidation messages.
+
+        Return whether the cache can be trusted, i.e. whether the subscription
+        to `channel` is confirmed and still alive. Redis errors are raised,
+        after the subscription has been forgotten.
+        """
+        # Threads do not wait for each other (nor for a stalled connection):
+        # while another thread polls, the cache is not trusted.
+        if not self._lock.acquire(blocking=False):
+            return False
+
+        try:
+            if self._must_subscribe(redis_client, channel):
+                if pubsub := self._reset():
+                    pubsub.close()
+                self._cache.clear()
+                self._pubsub = redis_client.pubsub()
+                self._pubsub.subscribe(channel)
+                self._set_subscription(redis_client, channel)
+
+            while message := self._pubsub.get_message(timeout=0):
+                self._handle_message(message)
+        except redis.RedisError:
+            # Messages may have been lost, start over on next call.
+            self._reset()
+            raise
+        finally:
+            self._lock.release()
+
+        return self._subscribed
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def _handle_message(self, message: dict):
+        # Any rotation published before the subscription is confirmed would be
+        # missed. The cache is therefore not trusted until redis confirms it.
+        if message['type'] == 'subscribe':
+            self._subscribed = True
+        elif message['type'] == 'message':
+            data = message['data']
+            if isinstance(data, bytes):
+                data = data.decode()
+            self._cache.invalidate(None if data == INVALIDATION_MESSAGE else data)
+
+    def _must_subscribe(self, redis_client: redis.Redis, channel: str) -> bool:
+        return (
+            self._pubsub is None
+            or self._client is not redis_client
+            or self._channel != channel
+            or self._pid != os.getpid()
+        )
+
+    def _reset(self):
+        """
+        Forget the subscription.
+
+        The cache is not trusted anymore, but it is only cleared on the next
+        subscription: until then, it is still used to accept known tokens
+        while the token store is unavailable.
+
+        Return the previous `PubSub` object if it can be closed by the current
+        process.
+        """
+        pubsub = self._pubsub if self._pid == os.getpid() else None
+        self._pubsub = None
+        self._client = None
+        self._channel = None
+        self._pid = None
+        self._subscribed = False
+        return pubsub
+
+    def _set_subscription(self, redis_client: redis.Redis, channel: str):
+        self._client = redis_client
+        self._channel = channel
+        self._pid = os.getpid()
+
+
+class AsyncTokenInvalidationSubscriber(TokenInvalidationSubscriber):
+    """
+    Same as `TokenInvalidationSubscriber` with a `redis.asyncio` client
+    """
+
+    async def poll(self, redis_client: redis.asyncio.Redis, channel: str) -> bool:
+        # Only one coroutine at a time can read from the connection. The
+        # others rely on the current state, which is being refreshed.
+        if not self._lock.acquire(blocking=False):
+            return self._subscribed
+
+        try:
+            if self._must_subscribe(redis_client, channel):
+                if pubsub := self._reset():
+                    await pubsub.reset()
+                self._cache.clear()
+                self._pubsub = redis_client.pubsub()
+                await self._pubsub.subscribe(channel)
+                self._set_subscription(redis_client, channel)
+
+            while message := await self._pubsub.get_message(timeout=0):
+                self._handle_message(message)
+        except redis.RedisError:
+            # Messages may have been lost, start over on next call.
+            self._reset()
+            raise
+        finally:
+            self._lock.release()
+
+        return self._subscribed
+
+
+def check_private(st: os.stat_result, path: str):
+    """
+    Raise `PermissionError` if `st`, the status of `path`, shows that other
+    users than the effective one own it or can access it
+    """
+    if st.st_uid != os.geteuid() or st.st_mode & 0o077:
+        raise PermissionError(
+            f'`{path}` must be owned by the current user and private to it'
+        )
+
+
+def _digest(token: str) -> bytes:
+    # Fixed size, whatever the length of the token sent
+    return hashlib.sha256(token.encode()).digest()
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from .exceptions import TokenStoreUnavailable
+from .metrics import CIRCUIT_BREAKER_OPENINGS, get_metrics_sink
+from .settings import service_account_settings as settings
+
+
+class CircuitBreaker:
+    """
+    Stop calling the token store after `settings.CIRCUIT_BREAKER_THRESHOLD`
+    consecutive failures (connection errors and timeouts), so requests fail
+    fast instead of piling up while the store is down.
+
+    The circuit stays open for `settings.CIRCUIT_BREAKER_RESET_TIMEOUT`
+    seconds. Then one call at a time is let through: the circuit closes
+    again on its first success.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @contextmanager
+    def guard(self, errors: tuple[type[BaseException], ...]) -> Iterator[None]:
+        """
+        Run the block unless the circuit is open.
+
+        `errors` raised by the block count as failures. They, and calls
+        rejected by the open circuit, raise `TokenStoreUnavailable`.
+        """
+        if self._opened_at is not None:
+            with self._lock:
+                if self.is_open:
+                    raise TokenStoreUnavailable
+                if self._opened_at is not None:
+                    # Trial call; the others keep failing fast until it
+                    # succeeds, or until the reset timeout elapses again.
+                    self._opened_at = time.monotonic()
+
+        try:
+            yield
+        except errors as e:
+            self.record_failure()
+            raise TokenStoreUnavailable from e
+
+        self.record_success()
+
+    @property
+    def is_open(self) -> bool:
+        if (opened_at := self._opened_at) is None:
+            return False
+        return (
+            time.monotonic() - opened_at < settings.CIRCUIT_BREAKER_RESET_TIMEOUT
+        )
+
+    def record_failure(self):
+        threshold = settings.CIRCUIT_BREAKER_THRESHOLD
+        with self._lock:
+            self._failures += 1
+            if threshold <= 0 or self._failures < threshold:
+                return
+            if self._opened_at is None:
+                get_metrics_sink().increment(CIRCUIT_BREAKER_OPENINGS)
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        # Lock-free when the circuit is closed, i.e. almost always
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                self._failures = 0
+                self._opened_at = None
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
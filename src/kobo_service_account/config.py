@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import re
+from operator import attrgetter
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+from .hosts import HostPolicy
+from .settings import TOKEN_MODE_SIGNED, service_account_settings as settings
+from .stores import TokenKeys, uses_hash_tags
+
+
+# Identity names prefix their tokens, followed by a dot
+IDENTITY_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+
+class CompiledSettings(NamedTuple):
+    """
+    Values derived from the settings, computed once instead of on each
+    request: key names, compiled host policy and header names.
+
+    Immutable; settings changes replace the whole snapshot (see
+    `compile_settings()`).
+    """
+
+    # Keys of the default identity
+    token_keys: TokenKeys
+    # Keys of each service identity (see `settings.SERVICE_IDENTITIES`)
+    identity_token_keys: Mapping[str, TokenKeys]
+    # `None` if all hosts are allowed
+    host_policy: Optional[HostPolicy]
+    on_behalf_header: str
+    # Key of the on-behalf header in `request.META`
+    on_behalf_meta_key: str
+    failed_authentications_key_prefix: str
+
+
+class CompiledAttribute:
+    """
+    Descriptor which reads `path` (e.g. `'token_keys.current'`) from the
+    current compiled settings, so class attributes such as
+    `ServiceAccountUser.redis_key` follow settings changes.
+    """
+
+    def __init__(self, path: str):
+        self._getter = attrgetter(path)
+
+    def __get__(self, instance, owner) -> Any:
+        return self._getter(get_compiled_settings())
+
+
+_compiled: Optional[CompiledSettings] = None
+
+
+def compile_settings() -> CompiledSettings:
+    """
+    Compile the current settings and replace the snapshot returned by
+    `get_compiled_settings()`.
+
+    Called when the app is ready and whenever `SERVICE_ACCOUNT` changes.
+    Settings modified in place (e.g. attributes of `service_account_settings`
+    set by tests) need an explicit call.
+    """
+    global _compiled
+
+    _validate_identities()
+    namespace = settings.NAMESPACE
+    channel = f'{namespace}::authentication_key::invalidation'
+    # With Redis Cluster, the namespace is used as a hash tag, so both keys
+    # of a pair live in the same slot and can be read with one command. Each
+    # identity has its own hash tag, so token pairs are spread across slots.
+    # Other stores keep the key names used by older versions.
+    prefix_format = '{{{}}}' if uses_hash_tags() else '{}'
+    identity_token_keys = {}
+    for identity in settings.SERVICE_IDENTITIES:
+        identity_token_keys[identity] = _get_token_keys(
+            prefix_format.format(f'{namespace}:{identity}'), channel, identity
+        )
+
+    on_behalf_header = settings.ON_BEHALF_HEADER
+    hosts = settings.WHITELISTED_HOSTS
+    compiled = CompiledSettings(
+        token_keys=_get_token_keys(prefix_format.format(namespace), channel),
+        identity_token_keys=MappingProxyType(identity_token_keys),
+        host_policy=HostPolicy(hosts) if hosts else None,
+        on_behalf_header=on_behalf_header,
+        on_behalf_meta_key=f"HTTP_{on_behalf_header.upper().replace('-', '_')}",
+        failed_authentications_key_prefix=(
+            f'{{{namespace}}}::failed_authentications::'
+        ),
+    )
+    # Replaced in one assignment: readers get either snapshot, never a mix
+    _compiled = compiled
+    return compiled
+
+
+def get_compiled_settings() -> CompiledSettings:
+    """
+    Return the settings compiled by `compile_settings()`, compiling them on
+    first call if the app is not in `INSTALLED_APPS`
+    """
+    if (compiled := _compiled) is not None:
+        return compiled
+    return compile_settings()
+
+
+def get_host_policy() -> Optional[HostPolicy]:
+    """
+    Return the policy compiled from `settings.WHITELISTED_HOSTS`, or `None`
+    if all hosts are allowed.
+    """
+    return get_compiled_settings().host_policy
+
+
+def _get_token_keys(
+    prefix: str, channel: str, identity: Optional[str] = None
+) -> TokenKeys:
+    return TokenKeys(
+        f'{prefix}::authentication_key::current',
+        f'{prefix}::authentication_key::obsolete',
+        f'{prefix}::authentication_key::ring',
+        channel,
+        identity,
+    )
+
+
+def _validate_identities():
+    identities = settings.SERVICE_IDENTITIES
+    if settings.TOKEN_MODE == TOKEN_MODE_SIGNED and (
+        identities or settings.SERVICE_IDENTITY is not None
+    ):
+        raise ImproperlyConfigured(
+            'Service identities cannot be used with signed tokens'
+        )
+
+    for identity in identities:
+        if not (
+            isinstance(identity, str)
+            and IDENTITY_NAME_PATTERN.fullmatch(identity)
+        ):
+            raise ImproperlyConfigured(
+                f'Invalid service identity name `{identity}`: only letters, '
+                'digits, `_` and `-` are allowed'
+            )
+
+
+def _reload_settings(setting: str, **kwargs):
+    if setting == 'SERVICE_ACCOUNT':
+        settings.reload()
+        compile_settings()
+
+
+setting_changed.connect(
+    _reload_settings, dispatch_uid='kobo_service_account_settings'
+)
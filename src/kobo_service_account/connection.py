@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+import weakref
+from typing import Any, Callable, Optional
+
+import redis
+import redis.asyncio
+from django.utils.module_loading import import_string
+
+from .settings import service_account_settings as settings
+
+
+class PoolStatsMixin:
+    """
+    Keep track of connection usage of a `redis.ConnectionPool`, to help
+    sizing pools under load.
+    """
+
+    def reset(self):
+        super().reset()
+        if not hasattr(self, '_stats_lock'):
+            self._stats_lock = threading.Lock()
+        self._stats_created = 0
+        self._stats_in_use = 0
+        self._stats_wait_count = 0
+        self._stats_wait_time = 0.0
+        self._stats_max_wait_time = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        connection = super().get_connection(*args, **kwargs)
+        wait_time = time.perf_counter() - start
+        with self._stats_lock:
+            self._stats_in_use += 1
+            self._stats_wait_count += 1
+            self._stats_wait_time += wait_time
+            self._stats_max_wait_time = max(self._stats_max_wait_time, wait_time)
+        return connection
+
+    def get_stats(self) -> dict:
+        """
+        Return a snapshot of the pool statistics.
+
+        Wait times (in seconds) include the time needed to open new
+        connections.
+        """
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created': self._stats_created,
+                'in_use': self._stats_in_use,
+                'idle': self._stats_created - self._stats_in_use,
+                'wait_count': self._stats_wait_count,
+                'wait_time': self._stats_wait_time,
+                'max_wait_time': self._stats_max_wait_time,
+            }
+
+    def make_connection(self):
+        connection = super().make_connection()
+        with self._stats_lock:
+            self._stats_created += 1
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        with self._stats_lock:
+            self._stats_in_use = max(self._stats_in_use - 1, 0)
+
+
+class ProcessLocal:
+    """
+    Descriptor which returns an object created by `factory` on first access.
+
+    Settings are therefore not read at import time, and each process gets
+    its own object: a forked worker (e.g. gunicorn, uwsgi) never shares the
+    connection pool of its parent.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+
+    def __get__(self, instance, owner) -> Any:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self._factory()
+                    self._pid = os.getpid()
+        return self._value
+
+    def reset(self):
+        """
+        Drop the current object, e.g. after changing the backend settings.
+        """
+        with self._lock:
+            self._value = None
+            self._pid = None
+
+
+class LoopLocal:
+    """
+    Return an object created by `factory` for the running event loop.
+
+    asyncio connections cannot be shared across event loops, so each loop
+    gets its own client (and connection pool), created on first access.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._values = weakref.WeakKeyDictionary()
+
+    def get(self) -> Any:
+        loop = asyncio.get_running_loop()
+        try:
+            return self._values[loop]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if (value := self._values.get(loop)) is None:
+                value = self._factory()
+                self._values[loop] = value
+
+        return value
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+def create_async_redis_client(
+    location: Optional[str] = None,
+) -> redis.asyncio.Redis:
+    return redis.asyncio.Redis.from_url(
+        location or settings.BACKEND['LOCATION'], **get_connection_kwargs()
+    )
+
+
+def create_redis_client(location: Optional[str] = None) -> redis.Redis:
+    """
+    Return a client of the redis server at `location` (default to
+    `settings.BACKEND['LOCATION']`)
+    """
+    options = settings.BACKEND.get('OPTIONS', {})
+    pool_class = import_string(
+        options.get('CONNECTION_POOL_CLASS', 'redis.ConnectionPool')
+    )
+    pool_class = type(pool_class.__name__, (PoolStatsMixin, pool_class), {})
+    pool = pool_class.from_url(
+        location or settings.BACKEND['LOCATION'], **get_connection_kwargs()
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def get_connection_kwargs() -> dict:
+    """
+    Return the connection pool keyword arguments from
+    `settings.BACKEND['OPTIONS']`.
+
+    Options follow django-redis conventions: `SOCKET_TIMEOUT`,
+    `SOCKET_CONNECT_TIMEOUT` and `CONNECTION_POOL_KWARGS` (e.g.
+    `max_connections`, `socket_keepalive`, `health_check_interval`).
+
+    Both timeouts default to `settings.TOKEN_STORE_TIMEOUT`, so a stalled
+    server cannot block requests indefinitely.
+    """
+    options = settings.BACKEND.get('OPTIONS', {})
+    kwargs = dict(options.get('CONNECTION_POOL_KWARGS', {}))
+    kwargs.setdefault('socket_timeout', settings.TOKEN_STORE_TIMEOUT)
+    kwargs.setdefault('socket_connect_timeout', settings.TOKEN_STORE_TIMEOUT)
+    if 'SOCKET_TIMEOUT' in options:
+        kwargs['socket_timeout'] = options['SOCKET_TIMEOUT']
+    if 'SOCKET_CONNECT_TIMEOUT' in options:
+        kwargs['socket_connect_timeout'] = options['SOCKET_CONNECT_TIMEOUT']
+    return kwargs
+
+
+def get_pool_stats() -> dict:
+    """
+    Return the statistics of the redis connection pool of the current process
+
+    Only redis token stores have a connection pool (see
+    `settings.TOKEN_STORE`).
+    """
+    from .models import ServiceAccountUser
+    return ServiceAccountUser.token_store.client.connection_pool.get_stats()
@@ -1,5 +1,6 @@
 from django.utils.translation import gettext_lazy as t
-from rest_framework.exceptions import PermissionDenied
+from rest_framework import status
+from rest_framework.exceptions import APIException, PermissionDenied
 
 
 class HostNotAllowedException(PermissionDenied):
@@ -9,3 +10,17 @@ class HostNotAllowedException(PermissionDenied):
 
 class MissingHeaderError(Exception):
     pass
+
+
+class TokenRotationLockTimeout(Exception):
+    # Raised when another process holds the rotation lock for too long and no
+    # valid token can be returned instead. Not an outage of the token store.
+    pass
+
+
+class TokenStoreUnavailable(APIException):
+    # Raised when the token store cannot be reached (or the circuit breaker
+    # is open) and no token seen before can be used instead.
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = t('Service account token store is unavailable.')
+    default_code = 'token_store_unavailable'
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import re
+from typing import Iterable
+
+from django.http.request import split_domain_port
+
+_port_re = re.compile(r':\d+$')
+
+
+class HostPolicy:
+    """
+    Decide whether a host may use service account authentication.
+
+    Hosts are compiled once into a set of exact names and one regular
+    expression for patterns, so checking a host does not depend on the
+    number of allowed hosts. Patterns follow Django `ALLOWED_HOSTS`
+    conventions (`.example.com` matches `example.com` and its subdomains,
+    `*` matches any host) and also support wildcards such as
+    `api-*.example.com`.
+
+    Case, ports and trailing dots are ignored.
+    """
+
+    def __init__(self, hosts: Iterable[str]):
+        self.allow_all = False
+        exact_hosts = set()
+        patterns = []
+
+        for host in hosts:
+            host = _port_re.sub('', host.lower()).rstrip('.')
+            if host == '*':
+                self.allow_all = True
+            elif host.startswith('.'):
+                patterns.append(f'(?:[^.]+\\.)*{re.escape(host[1:])}')
+            elif '*' in host:
+                patterns.append(re.escape(host).replace(r'\*', '[^.]+'))
+            else:
+                exact_hosts.add(host)
+
+        self.hosts = frozenset(exact_hosts)
+        self.pattern = re.compile('|'.join(patterns)) if patterns else None
+
+    def is_allowed(self, http_host: str) -> bool:
+        """
+        Return whether `http_host` (the value of the `Host` header, with or
+        without port) is allowed
+        """
+        if self.allow_all:
+            return True
+
+        host, _ = split_domain_port(http_host)
+        if not host:
+            return False
+
+        if host in self.hosts:
+            return True
+
+        return self.pattern is not None and self.pattern.fullmatch(host) is not None
@@ -0,0 +1,106 @@
+"""
+Authenticate outgoing `httpx` calls (sync and async) with the service account.
+
+Requires `httpx` (`pip install kobo-service-account[httpx]`).
+"""
+from __future__ import annotations
+
+from typing import AsyncGenerator, Generator, Optional
+
+import httpx
+
+from .models import ServiceAccountUser
+from .utils import aget_request_headers, get_request_headers
+
+DEFAULT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+
+class ServiceAccountAuth(httpx.Auth):
+    """
+    Add the headers returned by `get_request_headers()` (or
+    `aget_request_headers()` with `httpx.AsyncClient`) to each request sent on
+    behalf of `username`, with a token of `identity` (default to
+    `settings.SERVICE_IDENTITY`).
+
+    The token comes from the local token cache (see
+    `settings.LOCAL_TOKEN_CACHE`). If the receiving app answers 401 (e.g. the
+    token was rotated in the meantime), the token is read again from the token
+    store and, if it has changed, the request is replayed once.
+
+        httpx.get(url, auth=ServiceAccountAuth(request.user.username))
+    """
+
+    # Streamed bodies are read first, so they can be sent again
+    requires_request_body = True
+
+    def __init__(self, username: str, identity: Optional[str] = None):
+        self.username = username
+        self.identity = identity
+
+    def sync_auth_flow(
+        self, request: httpx.Request
+    ) -> Generator[httpx.Request, httpx.Response, None]:
+        request.headers.update(get_request_headers(self.username, self.identity))
+        response = yield request
+        if response.status_code == 401:
+            ServiceAccountUser.clear_local_token(self.identity)
+            headers = get_request_headers(self.username, self.identity)
+            if self._update_token(request, headers):
+                yield request
+
+    async def async_auth_flow(
+        self, request: httpx.Request
+    ) -> AsyncGenerator[httpx.Request, httpx.Response]:
+        request.headers.update(
+            await aget_request_headers(self.username, self.identity)
+        )
+        response = yield request
+        if response.status_code == 401:
+            ServiceAccountUser.clear_local_token(self.identity)
+            headers = await aget_request_headers(self.username, self.identity)
+            if self._update_token(request, headers):
+                yield request
+
+    @staticmethod
+    def _update_token(request: httpx.Request, headers: dict) -> bool:
+        """
+        Update the headers of the rejected `request`. Return whether its token
+        has changed, i.e. whether it is worth sending it again.
+        """
+        if headers['Authorization'] == request.headers['Authorization']:
+            return False
+        request.headers.update(headers)
+        return True
+
+
+def get_client(
+    username: Optional[str] = None,
+    identity: Optional[str] = None,
+    limits: httpx.Limits = DEFAULT_LIMITS,
+    **kwargs,
+) -> httpx.Client:
+    """
+    Return an `httpx.Client` which keeps connections alive and pools them
+    (see `limits`), to send many requests to other apps without a TCP (and
+    TLS) handshake each time. Other `kwargs` are passed to `httpx.Client`.
+
+    Requests are authenticated on behalf of `username` if given; otherwise
+    pass `auth=ServiceAccountAuth(username)` to each call.
+    """
+    if username is not None:
+        kwargs['auth'] = ServiceAccountAuth(username, identity)
+    return httpx.Client(limits=limits, **kwargs)
+
+
+def get_async_client(
+    username: Optional[str] = None,
+    identity: Optional[str] = None,
+    limits: httpx.Limits = DEFAULT_LIMITS,
+    **kwargs,
+) -> httpx.AsyncClient:
+    """
+    Async counterpart of `get_client()`
+    """
+    if username is not None:
+        kwargs['auth'] = ServiceAccountAuth(username, identity)
+    return httpx.AsyncClient(limits=limits, **kwargs)
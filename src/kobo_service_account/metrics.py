@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import bisect
+import socket
+import threading
+from typing import Optional
+
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from .settings import service_account_settings as settings
+
+# Metric names
+TOKEN_VALIDATION_SECONDS = 'token_validation_seconds'
+TOKEN_VALIDATIONS = 'token_validations_total'
+TOKEN_ROTATIONS = 'token_rotations_total'
+REDIS_ROUND_TRIPS_PER_REQUEST = 'redis_round_trips_per_request'
+REAL_USER_LOOKUPS = 'real_user_lookups_total'
+CIRCUIT_BREAKER_OPENINGS = 'circuit_breaker_openings_total'
+THROTTLED_AUTHENTICATIONS = 'throttled_authentications_total'
+
+# Outcomes of `TOKEN_VALIDATIONS`
+OUTCOME_CACHED = 'cached'
+OUTCOME_CURRENT = 'current'
+OUTCOME_OBSOLETE = 'obsolete'
+OUTCOME_RING = 'ring'
+OUTCOME_MISS = 'miss'
+OUTCOME_SIGNED = 'signed'
+# Accepted from memory while the token store is unavailable
+OUTCOME_DEGRADED = 'degraded'
+# Rejected from memory: the token store rejected the same token before
+OUTCOME_REJECTED = 'rejected'
+
+# Upper bounds of histogram buckets, from 100µs (local checks) to 1s
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1,
+)
+
+
+class BaseMetricsSink:
+    """
+    Receive the metrics recorded by this library.
+
+    Sinks are called in the request path, they must not block.
+    """
+
+    def increment(self, name: str, value: float = 1, tags: Optional[dict] = None):
+        raise NotImplementedError
+
+    def observe(self, name: str, value: float, tags: Optional[dict] = None):
+        """
+        Record one observation of a histogram, e.g. a duration in seconds
+        """
+        raise NotImplementedError
+
+
+class NullMetricsSink(BaseMetricsSink):
+    """
+    Drop all metrics (default)
+    """
+
+    def increment(self, name: str, value: float = 1, tags: Optional[dict] = None):
+        pass
+
+    def observe(self, name: str, value: float, tags: Optional[dict] = None):
+        pass
+
+
+class InMemoryMetricsSink(BaseMetricsSink):
+    """
+    Prometheus-style registry of counters and histograms, kept in process
+    memory.
+
+    `render()` returns the registry in Prometheus text exposition format,
+    e.g. to be served by a metrics view of the application.
+
+    Options (`settings.METRICS_OPTIONS`):
+    - `PREFIX`: prepended to metric names (default: `kobo_service_account`)
+    - `BUCKETS`: upper bounds of histogram buckets
+    """
+
+    def __init__(self):
+        options = settings.METRICS_OPTIONS
+        self.prefix = options.get('PREFIX', 'kobo_service_account')
+        self.buckets = tuple(options.get('BUCKETS', DEFAULT_BUCKETS))
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def get_counter(self, name: str, tags: Optional[dict] = None) -> float:
+        return self._counters.get(self._get_key(name, tags), 0)
+
+    def get_histogram(self, name: str, tags: Optional[dict] = None) -> dict:
+        """
+        Return the `count`, the `sum` and the (non-cumulative) `buckets`
+        counts of a histogram
+        """
+        try:
+            counts, total, count = self._histograms[self._get_key(name, tags)]
+        except KeyError:
+            return {'count': 0, 'sum': 0, 'buckets': [0] * (len(self.buckets) + 1)}
+        return {'count': count, 'sum': total, 'buckets': list(counts)}
+
+    def increment(self, name: str, value: float = 1, tags: Optional[dict] = None):
+        key = self._get_key(name, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, tags: Optional[dict] = None):
+        key = self._get_key(name, tags)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if (histogram := self._histograms.get(key)) is None:
+                histogram = [[0] * (len(self.buckets) + 1), 0, 0]
+                self._histograms[key] = histogram
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._histograms.items()
+            }
+
+        lines = []
+        for (name, tags), value in sorted(counters.items()):
+            lines.append(f'{self._format_name(name, tags)} {value}')
+
+        for (name, tags), (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_tags = tags + (('le', str(bound)),)
+                lines.append(
+                    f'{self._format_name(name + "_bucket", bucket_tags)} {cumulative}'
+                )
+            lines.append(f'{self._format_name(name + "_sum", tags)} {total}')
+            lines.append(f'{self._format_name(name + "_count", tags)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _format_name(self, name: str, tags: tuple) -> str:
+        name = f'{self.prefix}_{name}' if self.prefix else name
+        if not tags:
+            return name
+        labels = ','.join(f'{key}="{value}"' for key, value in tags)
+        return f'{name}{{{labels}}}'
+
+    @staticmethod
+    def _get_key(name: str, tags: Optional[dict]) -> tuple:
+        return name, tuple(sorted(tags.items())) if tags else ()
+
+
+class StatsdMetricsSink(BaseMetricsSink):
+    """
+    Send metrics to a statsd agent over UDP, with DogStatsD tags.
+
+    Durations are sent as timers in milliseconds. Packets are sent without
+    waiting for any acknowledgement; errors are ignored.
+
+    Options (`settings.METRICS_OPTIONS`):
+    - `HOST` (default: `localhost`) and `PORT` (default: `8125`)
+    - `PREFIX`: prepended to metric names (default: `kobo_service_account`)
+    """
+
+    def __init__(self):
+        options = settings.METRICS_OPTIONS
+        self.prefix = options.get('PREFIX', 'kobo_service_account')
+        # Resolved once, with the address family of the host (IPv4 or IPv6),
+        # instead of on each packet.
+        try:
+            family, type_, proto, _, self._address = socket.getaddrinfo(
+                options.get('HOST', 'localhost'),
+                int(options.get('PORT', 8125)),
+                type=socket.SOCK_DGRAM,
+            )[0]
+        except OSError:
+            # Metrics are dropped rather than failing requests
+            self._socket = None
+            return
+        self._socket = socket.socket(family, type_, proto)
+        self._socket.setblocking(False)
+
+    def increment(self, name: str, value: float = 1, tags: Optional[dict] = None):
+        self._send(name, value, 'c', tags)
+
+    def observe(self, name: str, value: float, tags: Optional[dict] = None):
+        if name.endswith('_seconds'):
+            self._send(name[:-len('_seconds')], value * 1000, 'ms', tags)
+        else:
+            self._send(name, value, 'h', tags)
+
+    def _send(self, name: str, value: float, metric_type: str, tags: Optional[dict]):
+        if self._socket is None:
+            return
+        name = f'{self.prefix}.{name}' if self.prefix else name
+        packet = f'{name}:{value:g}|{metric_type}'
+        if tags:
+            packet += '|#' + ','.join(f'{k}:{v}' for k, v in tags.items())
+        try:
+            self._socket.sendto(packet.encode(), self._address)
+        except OSError:
+            pass
+
+
+_sink = None
+_sink_path = None
+_sink_lock = threading.Lock()
+
+
+def get_metrics_sink() -> BaseMetricsSink:
+    """
+    Return the instance of `settings.METRICS_SINK` of the current process
+    """
+    global _sink, _sink_path
+
+    if (path := settings.METRICS_SINK) != _sink_path:
+        with _sink_lock:
+            if path != _sink_path:
+                _sink = import_string(path)()
+                _sink_path = path
+    return _sink
+
+
+def _reset_metrics_sink(setting: str, **kwargs):
+    """
+    Drop the sink when `SERVICE_ACCOUNT` changes, e.g. another statsd host
+    """
+    global _sink, _sink_path
+
+    if setting == 'SERVICE_ACCOUNT':
+        with _sink_lock:
+            _sink = None
+            _sink_path = None
+
+
+setting_changed.connect(
+    _reset_metrics_sink, dispatch_uid='kobo_service_account_metrics_sink'
+)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from typing import Awaitable, Callable, Optional, Union
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.exceptions import APIException
+
+from .authentication import (
+    MIDDLEWARE_AUTHENTICATION_ATTRIBUTE,
+    ServiceAccountAuthentication,
+)
+from .utils import LazyRealUser
+
+
+class RealUserMiddleware(MiddlewareMixin):
+    """
+    Set `request.real_user`, the user returned by `get_real_user()`, resolved
+    on first access and at most once per request. `get_real_user()`,
+    `get_real_user_id()` and the reversion patch resolve it too, so they
+    share the same lookup.
+
+    With DRF, the service account is authenticated by the view: if
+    `request.real_user` is accessed before (e.g. by another middleware), it
+    is resolved again once `request.user` has changed.
+
+    Under ASGI, `request.real_user` cannot be resolved from async code (it
+    queries the database); use `await aget_real_user(request)` instead.
+    """
+
+    def process_request(self, request: HttpRequest):
+        request.real_user = LazyRealUser(request)
+
+
+class ServiceAccountAuthenticationMiddleware:
+    """
+    Authenticate requests sent with a service account token before any view
+    is called, without DRF: plain Django views (e.g. health checks) can use
+    `request.user` directly. Sync and async (ASGI) capable.
+
+    Tokens are validated like `ServiceAccountAuthentication` does, which
+    then reuses the user authenticated by this middleware instead of
+    validating the token again. Requests without a service account token are
+    left untouched; invalid tokens are answered with 401 (429 for throttled
+    sources), like DRF does.
+
+    Must come after `AuthenticationMiddleware`, which would replace
+    `request.user` otherwise.
+
+    Authenticated requests are exempt from CSRF checks: they do not rely on
+    cookies, and DRF `SessionAuthentication`, which reads `request.user`
+    too, would reject their unsafe methods otherwise. If it comes before
+    `ServiceAccountAuthentication` in the authentication classes, DRF
+    `request.auth` is `None` instead of the token.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(
+        self,
+        get_response: Callable[
+            [HttpRequest], Union[HttpResponse, Awaitable[HttpResponse]]
+        ],
+    ):
+        self.get_response = get_response
+        self.authentication = ServiceAccountAuthentication()
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.async_mode:
+            return self.__acall__(request)
+
+        try:
+            authenticated = self.authentication.authenticate(request)
+        except APIException as e:
+            return self._get_error_response(request, e)
+
+        self._set_user(request, authenticated)
+        return self.get_response(request)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        try:
+            authenticated = await self.authentication.aauthenticate(request)
+        except APIException as e:
+            return self._get_error_response(request, e)
+
+        self._set_user(request, authenticated)
+        return await self.get_response(request)
+
+    def _get_error_response(
+        self, request: HttpRequest, exc: APIException
+    ) -> HttpResponse:
+        response = JsonResponse({'detail': exc.detail}, status=exc.status_code)
+        if exc.status_code == 401:
+            response['WWW-Authenticate'] = self.authentication.authenticate_header(
+                request
+            )
+        if getattr(exc, 'wait', None):
+            response['Retry-After'] = '%d' % exc.wait
+        return response
+
+    @staticmethod
+    def _set_user(request: HttpRequest, authenticated: Optional[tuple]):
+        if authenticated is None:
+            return
+
+        request.user = authenticated[0]
+        # Same flag as `django.test.Client`, honored by `CsrfViewMiddleware`
+        # and DRF `SessionAuthentication`
+        request._dont_enforce_csrf_checks = True
+        setattr(request, MIDDLEWARE_AUTHENTICATION_ATTRIBUTE, authenticated)
@@ -1,13 +1,42 @@
-import redis
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Optional
+
 from django.contrib.auth.models import (
     _user_get_permissions as user_get_permissions,  # noqa
     Group,
     Permission,
 )
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.db.models.manager import EmptyManager
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.utils.crypto import get_random_string
 
-from .settings import service_account_settings as settings
+from .cache import ExpiringLRUCache, LocalTokenCache, ValidatedTokenCache
+from .circuit_breaker import CircuitBreaker
+from .config import CompiledAttribute, get_compiled_settings
+from .connection import ProcessLocal
+from .exceptions import TokenStoreUnavailable
+from .metrics import (
+    OUTCOME_CACHED,
+    OUTCOME_CURRENT,
+    OUTCOME_DEGRADED,
+    OUTCOME_MISS,
+    OUTCOME_OBSOLETE,
+    OUTCOME_REJECTED,
+    OUTCOME_RING,
+    OUTCOME_SIGNED,
+    TOKEN_ROTATIONS,
+    TOKEN_VALIDATION_SECONDS,
+    TOKEN_VALIDATIONS,
+    get_metrics_sink,
+)
+from .settings import TOKEN_MODE_SIGNED, service_account_settings as settings
+from .signing import create_signed_token, verify_signed_token
+from .stores import StoreClient, TokenKeys, create_token_store
 
 
 class ServiceAccountUser:
@@ -16,21 +45,42 @@ class ServiceAccountUser:
 
     The main difference is an instance of this class is granted with
     superuser privileges
+
+    `identity` is the name of the service identity which authenticated the
+    request (see `settings.SERVICE_IDENTITIES`), or `None` for the default
+    identity shared by all apps.
     """
 
     id = None
     pk = None
     username = 'system_user'
+    identity = None
     is_staff = True
     is_active = True
     is_superuser = True
     _groups = EmptyManager(Group)
     _user_permissions = EmptyManager(Permission)
-    redis_client = redis.Redis.from_url(
-        settings.BACKEND['LOCATION']
-    )
-    redis_key = f'{settings.NAMESPACE}::authentication_key::current'
-    redis_obsolete_key = f'{settings.NAMESPACE}::authentication_key::obsolete'
+    token_store = ProcessLocal(create_token_store)
+    circuit_breaker = ProcessLocal(CircuitBreaker)
+    # Clients of the token store, for redis stores only
+    redis_client = StoreClient('client')
+    async_redis_client = StoreClient('async_client')
+    # Keys of the default identity, see `CompiledSettings`
+    redis_key = CompiledAttribute('token_keys.current')
+    redis_obsolete_key = CompiledAttribute('token_keys.obsolete')
+    redis_ring_key = CompiledAttribute('token_keys.ring')
+    redis_channel = CompiledAttribute('token_keys.channel')
+    token_keys = CompiledAttribute('token_keys')
+    token_cache = LocalTokenCache()
+    validated_tokens = ValidatedTokenCache()
+    permission_cache = ExpiringLRUCache()
+    _identity_lock = threading.Lock()
+    _instances = {}
+    _identity_token_caches = {}
+
+    def __init__(self, identity: Optional[str] = None):
+        if identity is not None:
+            self.identity = identity
 
     def __str__(self):
         return 'ServiceAccountUser'
@@ -49,46 +99,205 @@ class ServiceAccountUser:
             'Are you trying to use it in place of User?'
         )
 
+    @classmethod
+    async def aget_or_create_authentication_token(
+        cls, identity: Optional[str] = None
+    ) -> str:
+        """
+        Async counterpart of `get_or_create_authentication_token()`, which
+        uses `redis.asyncio` with redis token stores.
+
+        Tokens are shared with the sync API: same store, same local cache.
+        """
+        token, _ = await cls.aget_or_create_authentication_token_with_ttl(
+            identity=identity
+        )
+        return token
+
+    @classmethod
+    async def aget_or_create_authentication_token_with_ttl(
+        cls, min_ttl: Optional[float] = None, identity: Optional[str] = None
+    ) -> tuple[str, float]:
+        """
+        Async counterpart of `get_or_create_authentication_token_with_ttl()`
+        """
+        identity = cls._get_identity(identity)
+        if min_ttl is None:
+            min_ttl = cls.get_identity_setting(
+                identity, 'TOKEN_TTL_EXPIRY_THRESHOLD'
+            )
+
+        if not settings.LOCAL_TOKEN_CACHE:
+            return await cls._aget_or_create_authentication_token(
+                min_ttl, identity
+            )
+
+        token_cache = cls._get_token_cache(identity)
+        token, ttl = token_cache.get_with_ttl(min_ttl)
+        if token:
+            return token, ttl
+
+        now = time.monotonic()
+        try:
+            token, ttl = await cls._aget_or_create_authentication_token(
+                min_ttl, identity
+            )
+        except TokenStoreUnavailable:
+            # Degraded mode: reuse the last token until it expires
+            token, ttl = token_cache.get_with_ttl(0)
+            if not token:
+                raise
+            return token, ttl
+
+        token_cache.set(token, ttl, now)
+        return token, ttl
+
+    @classmethod
+    async def ahas_valid_authentication_token(cls, header_token: str) -> bool:
+        """
+        Async counterpart of `has_valid_authentication_token()`, which uses
+        `redis.asyncio` with redis token stores.
+        """
+        start = time.perf_counter()
+        outcome = await cls._avalidate_authentication_token(header_token)
+        cls._record_validation(outcome, start)
+        return outcome not in (OUTCOME_MISS, OUTCOME_REJECTED)
+
     def check_password(self, raw_password):
         raise NotImplementedError(
             "Django doesn't provide a DB representation for ServiceAccountUser."
         )
 
+    @classmethod
+    def clear_local_token(cls, identity: Optional[str] = None):
+        """
+        Forget the token of `identity` (default to `settings.SERVICE_IDENTITY`)
+        kept in process memory, e.g. after it has been rejected, so the next
+        call to `get_or_create_authentication_token()` reads the token store.
+        """
+        cls._get_token_cache(cls._get_identity(identity)).clear()
+
     def delete(self):
         raise NotImplementedError(
             "Django doesn't provide a DB representation for ServiceAccountUser."
         )
 
     def get_all_permissions(self, obj=None):
-        return user_get_permissions(self, obj, 'all')
+        return self._get_permissions(obj, 'all')
 
     def get_group_permissions(self, obj=None):
-        return user_get_permissions(self, obj, 'group')
+        return self._get_permissions(obj, 'group')
+
+    @staticmethod
+    def get_identity_setting(identity: Optional[str], name: str) -> Any:
+        """
+        Return the value of setting `name` for `identity`, which overrides
+        the global one if set in `settings.SERVICE_IDENTITIES`
+        """
+        if identity is not None:
+            try:
+                return settings.SERVICE_IDENTITIES[identity][name]
+            except (KeyError, TypeError):
+                pass
+        return getattr(settings, name)
 
     @classmethod
-    def get_or_create_authentication_token(cls):
-        ttl = cls.redis_client.ttl(cls.redis_key)
-        if ttl >= settings.TOKEN_TTL_EXPIRY_THRESHOLD:
-            token = cls.redis_client.get(cls.redis_key)
-            # if `settings.TOKEN_TTL_EXPIRY_THRESHOLD` is (close to) 0,
-            # redis.get() could return None.
-            if token:
-                return token.decode()
-
-        # Rotate keys to avoid race conditions when a new key is created
-        # just after a request is sent with old key but before authentication
-        # is completed.
-        p = cls.redis_client.pipeline()
-        # ttl equals -2 when key has expired
-        if 0 < ttl < settings.TOKEN_TTL_EXPIRY_THRESHOLD:
-            p.rename(cls.redis_key, cls.redis_obsolete_key)
-        token = get_random_string(settings.TOKEN_LENGTH)
-        p.setex(cls.redis_key, settings.TOKEN_TTL, token)
-        p.execute()
+    def get_or_create_authentication_token(
+        cls, identity: Optional[str] = None
+    ) -> str:
+        """
+        Return the current authentication token of `identity` (default to
+        `settings.SERVICE_IDENTITY`), and create a new one if it is about to
+        expire.
+
+        When `settings.LOCAL_TOKEN_CACHE` is enabled, the token is served from
+        process memory until `settings.TOKEN_TTL_EXPIRY_THRESHOLD` is reached,
+        and the token store is only queried when the token needs to be
+        rotated. If the token store is unavailable, the cached token is used
+        until it expires; `TokenStoreUnavailable` is raised afterwards.
+        """
+        token, _ = cls.get_or_create_authentication_token_with_ttl(
+            identity=identity
+        )
         return token
 
+    @classmethod
+    def get_or_create_authentication_token_with_ttl(
+        cls, min_ttl: Optional[float] = None, identity: Optional[str] = None
+    ) -> tuple[str, float]:
+        """
+        Same as `get_or_create_authentication_token()` but also return the
+        remaining time to live (in seconds) of the token.
+
+        The token is rotated if it expires in less than `min_ttl` seconds
+        (default to `settings.TOKEN_TTL_EXPIRY_THRESHOLD`).
+        """
+        identity = cls._get_identity(identity)
+        if min_ttl is None:
+            min_ttl = cls.get_identity_setting(
+                identity, 'TOKEN_TTL_EXPIRY_THRESHOLD'
+            )
+
+        if not settings.LOCAL_TOKEN_CACHE:
+            return cls._get_or_create_authentication_token(min_ttl, identity)
+
+        token_cache = cls._get_token_cache(identity)
+        token, ttl = token_cache.get_with_ttl(min_ttl)
+        if token:
+            return token, ttl
+
+        # Only one thread per process refreshes the token; the others wait and
+        # get the refreshed token from the cache.
+        with token_cache.lock:
+            token, ttl = token_cache.get_with_ttl(min_ttl)
+            if token:
+                return token, ttl
+            now = time.monotonic()
+            try:
+                token, ttl = cls._get_or_create_authentication_token(
+                    min_ttl, identity
+                )
+            except TokenStoreUnavailable:
+                # Degraded mode: reuse the last token until it expires
+                token, ttl = token_cache.get_with_ttl(0)
+                if not token:
+                    raise
+                return token, ttl
+
+            token_cache.set(token, ttl, now)
+
+        return token, ttl
+
+    @classmethod
+    def get_token_identity(cls, header_token: str) -> Optional[str]:
+        """
+        Return the name of the service identity `header_token` belongs to,
+        or `None` for the default identity.
+
+        Tokens of named identities are prefixed with the name of the identity,
+        so no lookup is needed.
+        """
+        identity, separator, _ = header_token.partition('.')
+        if separator and identity in settings.SERVICE_IDENTITIES:
+            return identity
+        return None
+
+    @classmethod
+    def get_instance(cls, identity: Optional[str] = None) -> ServiceAccountUser:
+        """
+        Return the instance shared by all requests authenticated by
+        `identity`, instead of creating one per request.
+
+        Instances hold no per-request state and must not be modified.
+        """
+        try:
+            return cls._instances[identity]
+        except KeyError:
+            with cls._identity_lock:
+                return cls._instances.setdefault(identity, cls(identity))
+
     def get_user_permissions(self, obj=None):
-        return user_get_permissions(self, obj, 'user')
+        return self._get_permissions(obj, 'user')
 
     def get_username(self) -> str:
         return self.username
@@ -111,27 +320,36 @@ class ServiceAccountUser:
     def has_valid_authentication_token(cls, header_token: str) -> bool:
         """
         Validate whether the token equals the current token or the previous one
-        which is about to expire.
+        which is about to expire, of the service identity the token belongs to
+        (see `get_token_identity()`).
 
         It gives a chance to requests sent with an old token but could not
-        authenticated in time before the new token is created.
-        """
-        redis_token = cls.redis_client.get(cls.redis_key)  # returns bytes
-        # If redis returns `None`, even the previous one has expired. No need to
-        # go further.
-        if not redis_token:
-            return False
+        authenticated in time before the new token is created. With
+        `settings.TOKEN_RING_SIZE`, any token of the ring is accepted until its
+        own expiry.
 
-        # We have a match, return True.
-        if redis_token.decode() == header_token:
-            return True
+        Accepted tokens are kept in memory (see
+        `settings.VALIDATED_TOKEN_CACHE_SIZE`) until their key expires or the
+        token is rotated, so validating a known token does not query the token
+        store. So are rejected tokens (see `settings.REJECTED_TOKEN_CACHE_SIZE`),
+        until `settings.REJECTED_TOKEN_CACHE_TTL` elapses or the token is
+        rotated.
 
-        # Last chance, compare with previous token if it exists
-        redis_token = cls.redis_client.get(cls.redis_obsolete_key)
-        if not redis_token:
-            return False
+        With signed tokens (see `settings.TOKEN_MODE`), the signature and the
+        expiry of the token are checked locally instead.
 
-        return redis_token.decode() == header_token
+        While the token store is unavailable (see
+        `settings.CIRCUIT_BREAKER_THRESHOLD`), only tokens accepted before are
+        accepted, until their expiry. Other tokens raise
+        `TokenStoreUnavailable`.
+
+        Latency and outcome of each validation are recorded with the metrics
+        sink (see `settings.METRICS_SINK`).
+        """
+        start = time.perf_counter()
+        outcome = cls._validate_authentication_token(header_token)
+        cls._record_validation(outcome, start)
+        return outcome not in (OUTCOME_MISS, OUTCOME_REJECTED)
 
     @property
     def is_anonymous(self) -> bool:
@@ -155,3 +373,384 @@ class ServiceAccountUser:
     def user_permissions(self):
         # This user does not have any assigned permissions.
         return self._user_permissions
+
+    @classmethod
+    def _cache_validation(
+        cls,
+        header_token: str,
+        ttl: Optional[float],
+        outcome: str,
+        use_cache: bool,
+        now: float,
+        identity: Optional[str],
+    ) -> str:
+        if not use_cache:
+            return outcome
+
+        if ttl is not None:
+            cls.validated_tokens.add(
+                header_token,
+                ttl,
+                settings.VALIDATED_TOKEN_CACHE_SIZE,
+                now,
+                identity,
+            )
+        else:
+            cls.validated_tokens.add_rejected(
+                header_token,
+                settings.REJECTED_TOKEN_CACHE_TTL,
+                settings.REJECTED_TOKEN_CACHE_SIZE,
+                now,
+                identity,
+            )
+        return outcome
+
+    @classmethod
+    async def _aget_or_create_authentication_token(
+        cls, min_ttl: float, identity: Optional[str]
+    ) -> tuple[str, float]:
+        if settings.TOKEN_MODE == TOKEN_MODE_SIGNED:
+            return create_signed_token()
+
+        with cls.circuit_breaker.guard(cls.token_store.unavailable_errors):
+            token_keys = cls._get_token_keys(identity)
+            if ring_size := settings.TOKEN_RING_SIZE:
+                token, ttl = await cls.token_store.aget_ring_current(token_keys)
+            else:
+                token, ttl = await cls.token_store.aget_current(token_keys)
+            # if `min_ttl` is (close to) 0, the key could have expired between
+            # both commands.
+            if token and ttl >= min_ttl:
+                return token, ttl
+
+            new_token = cls._new_token(identity)
+            token_ttl = cls.get_identity_setting(identity, 'TOKEN_TTL')
+            if ring_size:
+                token, ttl = await cls.token_store.arotate_ring(
+                    token_keys, new_token, token_ttl, min_ttl, ring_size
+                )
+            else:
+                token, ttl = await cls.token_store.arotate(
+                    token_keys, new_token, token_ttl, min_ttl
+                )
+            if token == new_token:
+                get_metrics_sink().increment(TOKEN_ROTATIONS)
+            return token, ttl
+
+    @classmethod
+    async def _avalidate_authentication_token(cls, header_token: str) -> str:
+        if settings.TOKEN_MODE == TOKEN_MODE_SIGNED:
+            return cls._verify_signed_token(header_token)
+
+        if cls.circuit_breaker.is_open:
+            return cls._validate_degraded(header_token)
+
+        try:
+            use_cache = cls._use_validation_cache() and (
+                await cls.token_store.apoll_invalidation(
+                    cls.redis_channel, cls.validated_tokens
+                )
+            )
+        except cls.token_store.unavailable_errors:
+            # Counted like failed reads: while the circuit is open, the
+            # subscription is not attempted again.
+            cls.circuit_breaker.record_failure()
+            return cls._validate_degraded(header_token)
+        if use_cache and (outcome := cls._get_cached_outcome(header_token)):
+            return outcome
+
+        now = time.monotonic()
+        identity = cls.get_token_identity(header_token)
+        token_keys = cls._get_token_keys(identity)
+        try:
+            with cls.circuit_breaker.guard(cls.token_store.unavailable_errors):
+                if settings.TOKEN_RING_SIZE:
+                    ttl = await cls.token_store.aget_ring_token_ttl(
+                        token_keys, header_token
+                    )
+                    outcome = OUTCOME_MISS if ttl is None else OUTCOME_RING
+                else:
+                    pair = await cls.token_store.aget_pair_for(
+                        token_keys, header_token
+                    )
+                    ttl, outcome = cls._match_token(
+                        header_token, pair, identity
+                    )
+        except TokenStoreUnavailable:
+            return cls._validate_degraded(header_token)
+
+        return cls._cache_validation(
+            header_token, ttl, outcome, use_cache, now, identity
+        )
+
+    @classmethod
+    def _get_cached_outcome(cls, header_token: str) -> Optional[str]:
+        if header_token in cls.validated_tokens:
+            return OUTCOME_CACHED
+        if cls.validated_tokens.is_rejected(header_token):
+            return OUTCOME_REJECTED
+        return None
+
+    @classmethod
+    def _get_identity(cls, identity: Optional[str]) -> Optional[str]:
+        if identity is None:
+            identity = settings.SERVICE_IDENTITY
+        if identity is not None and identity not in settings.SERVICE_IDENTITIES:
+            raise ImproperlyConfigured(
+                f'Service identity `{identity}` is not declared in '
+                '`SERVICE_IDENTITIES`'
+            )
+        return identity
+
+    @classmethod
+    def _get_or_create_authentication_token(
+        cls, min_ttl: float, identity: Optional[str]
+    ) -> tuple[str, float]:
+        """
+        Return the current token from the token store with its remaining time
+        to live (in seconds). A new token is created if the current one
+        expires in less than `min_ttl` seconds.
+
+        Exactly one process rotates the token (see `BaseTokenStore.rotate()`),
+        and every token handed out is either the current or the obsolete one.
+
+        With signed tokens (see `settings.TOKEN_MODE`), a new token is signed
+        without querying the token store.
+        """
+        if settings.TOKEN_MODE == TOKEN_MODE_SIGNED:
+            return create_signed_token()
+
+        with cls.circuit_breaker.guard(cls.token_store.unavailable_errors):
+            token_keys = cls._get_token_keys(identity)
+            if ring_size := settings.TOKEN_RING_SIZE:
+                token, ttl = cls.token_store.get_ring_current(token_keys)
+            else:
+                token, ttl = cls.token_store.get_current(token_keys)
+            # if `min_ttl` is (close to) 0, the key could have expired between
+            # both commands.
+            if token and ttl >= min_ttl:
+                return token, ttl
+
+            new_token = cls._new_token(identity)
+            token_ttl = cls.get_identity_setting(identity, 'TOKEN_TTL')
+            if ring_size:
+                token, ttl = cls.token_store.rotate_ring(
+                    token_keys, new_token, token_ttl, min_ttl, ring_size
+                )
+            else:
+                token, ttl = cls.token_store.rotate(
+                    token_keys, new_token, token_ttl, min_ttl
+                )
+            if token == new_token:
+                get_metrics_sink().increment(TOKEN_ROTATIONS)
+            return token, ttl
+
+    def _get_permissions(self, obj, from_name: str) -> set[str]:
+        """
+        Return the permissions granted by the authentication backends.
+
+        As a superuser, the service account gets the whole `Permission` table
+        from `ModelBackend`. Permissions are therefore computed once per
+        process and kept for `settings.PERMISSION_CACHE_TTL` seconds, or until
+        migrations run or permissions are changed in this process. Object
+        permissions are not cached.
+        """
+        ttl = settings.PERMISSION_CACHE_TTL
+        if obj is not None or ttl <= 0:
+            return user_get_permissions(self, obj, from_name)
+
+        if (permissions := self.permission_cache.get(from_name)) is None:
+            _connect_permission_cache_signals()
+            now = time.monotonic()
+            # Backends cache permissions on the user object: compute them with
+            # a throwaway instance, so shared instances never keep them.
+            permissions = frozenset(
+                user_get_permissions(type(self)(), None, from_name)
+            )
+            # One entry for each of 'all', 'group' and 'user'
+            self.permission_cache.set(from_name, permissions, ttl, 3, now)
+
+        return set(permissions)
+
+    @classmethod
+    def _get_token_cache(cls, identity: Optional[str]) -> LocalTokenCache:
+        if identity is None:
+            return cls.token_cache
+
+        try:
+            return cls._identity_token_caches[identity]
+        except KeyError:
+            with cls._identity_lock:
+                return cls._identity_token_caches.setdefault(
+                    identity, LocalTokenCache()
+                )
+
+    @staticmethod
+    def _get_token_keys(identity: Optional[str]) -> TokenKeys:
+        """
+        Return the keys of the token pair of `identity`
+        """
+        compiled = get_compiled_settings()
+        if identity is None:
+            return compiled.token_keys
+        return compiled.identity_token_keys[identity]
+
+    @classmethod
+    def _match_token(
+        cls,
+        header_token: str,
+        pair: tuple[tuple[Optional[str], float], tuple[Optional[str], float]],
+        identity: Optional[str] = None,
+    ) -> tuple[Optional[float], str]:
+        """
+        Compare `header_token` with the tokens returned by
+        `BaseTokenStore.get_pair()` for `identity`.
+
+        Return the remaining time to live (in seconds) of the matching token,
+        or `None` if there is no match, with the outcome of the comparison.
+        """
+        (token, ttl), (obsolete_token, obsolete_ttl) = pair
+
+        # If the store returns `None`, even the previous one has expired.
+        if not token:
+            return None, OUTCOME_MISS
+
+        outcome = OUTCOME_CURRENT
+        if token != header_token:
+            # Last chance, compare with previous token if it exists
+            if not obsolete_token or obsolete_token != header_token:
+                return None, OUTCOME_MISS
+            ttl = obsolete_ttl
+            outcome = OUTCOME_OBSOLETE
+
+        # A key without expiry (ttl = -1) should not happen; fall back
+        # on the TTL of the identity.
+        if ttl == -1:
+            ttl = cls.get_identity_setting(identity, 'TOKEN_TTL')
+        elif ttl <= 0:
+            # Expired (or deleted) between the read of the token and of its
+            # TTL (-2): it must not be accepted, nor cached.
+            return None, OUTCOME_MISS
+        return ttl, outcome
+
+    @classmethod
+    def _new_token(cls, identity: Optional[str]) -> str:
+        token = get_random_string(
+            cls.get_identity_setting(identity, 'TOKEN_LENGTH')
+        )
+        return f'{identity}.{token}' if identity is not None else token
+
+    @staticmethod
+    def _record_validation(outcome: str, start: float):
+        sink = get_metrics_sink()
+        tags = {'outcome': outcome}
+        sink.observe(TOKEN_VALIDATION_SECONDS, time.perf_counter() - start, tags)
+        sink.increment(TOKEN_VALIDATIONS, tags=tags)
+
+    @staticmethod
+    def _use_validation_cache() -> bool:
+        return (
+            settings.VALIDATED_TOKEN_CACHE_SIZE > 0
+            or settings.REJECTED_TOKEN_CACHE_SIZE > 0
+        )
+
+    @classmethod
+    def _validate_authentication_token(cls, header_token: str) -> str:
+        """
+        Validate `header_token` and return the outcome of the validation
+        """
+        if settings.TOKEN_MODE == TOKEN_MODE_SIGNED:
+            return cls._verify_signed_token(header_token)
+
+        if cls.circuit_breaker.is_open:
+            return cls._validate_degraded(header_token)
+
+        try:
+            use_cache = cls._use_validation_cache() and (
+                cls.token_store.poll_invalidation(
+                    cls.redis_channel, cls.validated_tokens
+                )
+            )
+        except cls.token_store.unavailable_errors:
+            # Counted like failed reads: while the circuit is open, the
+            # subscription is not attempted again.
+            cls.circuit_breaker.record_failure()
+            return cls._validate_degraded(header_token)
+        if use_cache and (outcome := cls._get_cached_outcome(header_token)):
+            return outcome
+
+        now = time.monotonic()
+        identity = cls.get_token_identity(header_token)
+        token_keys = cls._get_token_keys(identity)
+        try:
+            with cls.circuit_breaker.guard(cls.token_store.unavailable_errors):
+                if settings.TOKEN_RING_SIZE:
+                    # One membership check, whatever the number of valid tokens
+                    ttl = cls.token_store.get_ring_token_ttl(
+                        token_keys, header_token
+                    )
+                    outcome = OUTCOME_MISS if ttl is None else OUTCOME_RING
+                else:
+                    pair = cls.token_store.get_pair_for(token_keys, header_token)
+                    ttl, outcome = cls._match_token(
+                        header_token, pair, identity
+                    )
+        except TokenStoreUnavailable:
+            return cls._validate_degraded(header_token)
+
+        return cls._cache_validation(
+            header_token, ttl, outcome, use_cache, now, identity
+        )
+
+    @classmethod
+    def _validate_degraded(cls, header_token: str) -> str:
+        """
+        Validate `header_token` while the token store is unavailable: only
+        tokens accepted before, which have not expired yet, are accepted.
+        """
+        if header_token in cls.validated_tokens:
+            return OUTCOME_DEGRADED
+        raise TokenStoreUnavailable
+
+    @staticmethod
+    def _verify_signed_token(header_token: str) -> str:
+        if verify_signed_token(header_token) is None:
+            return OUTCOME_MISS
+        return OUTCOME_SIGNED
+
+
+def _connect_permission_cache_signals():
+    post_migrate.connect(
+        _invalidate_permission_cache,
+        dispatch_uid='kobo_service_account_permission_cache',
+    )
+    for signal in (post_save, post_delete):
+        signal.connect(
+            _invalidate_permission_cache,
+            sender=Permission,
+            dispatch_uid='kobo_service_account_permission_cache',
+        )
+
+
+def _invalidate_permission_cache(sender, **kwargs):
+    ServiceAccountUser.permission_cache.clear()
+
+
+def _reset_token_store(setting: str, **kwargs):
+    """
+    Drop the token store, and the tokens known by this process, when
+    `SERVICE_ACCOUNT` changes (e.g. another backend or namespace)
+    """
+    if setting != 'SERVICE_ACCOUNT':
+        return
+
+    vars(ServiceAccountUser)['token_store'].reset()
+    vars(ServiceAccountUser)['circuit_breaker'].reset()
+    ServiceAccountUser.token_cache.clear()
+    ServiceAccountUser._identity_token_caches.clear()
+    ServiceAccountUser.validated_tokens.clear()
+
+
+setting_changed.connect(
+    _reset_token_store, dispatch_uid='kobo_service_account_token_store'
+)
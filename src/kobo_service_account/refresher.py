@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+from typing import Optional
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .models import ServiceAccountUser
+from .settings import service_account_settings as settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before trying again when redis cannot be reached
+RETRY_INTERVAL = 1
+# Never refresh more often than that (in seconds)
+MIN_INTERVAL = 0.1
+
+
+class BaseTokenRefresher:
+    """
+    Rotate the authentication token ahead of its expiry and keep the
+    process-local copy warm (see `settings.LOCAL_TOKEN_CACHE`).
+
+    The token is refreshed `settings.TOKEN_REFRESH_MARGIN` seconds before
+    `settings.TOKEN_TTL_EXPIRY_THRESHOLD` is reached, so
+    `get_or_create_authentication_token()` (and therefore
+    `get_request_headers()`) only reads memory.
+    """
+
+    @property
+    def min_ttl(self) -> float:
+        return settings.TOKEN_TTL_EXPIRY_THRESHOLD + settings.TOKEN_REFRESH_MARGIN
+
+    def _get_interval(self, ttl: float) -> float:
+        """
+        Return the number of seconds to wait before the next refresh of a
+        token which expires in `ttl` seconds.
+        """
+        return max(ttl - self.min_ttl, MIN_INTERVAL)
+
+    def check_settings(self):
+        """
+        Raise `ImproperlyConfigured` if new tokens would need to be refreshed
+        right away, i.e. if the refresher would rotate them in a loop.
+        """
+        token_ttl = ServiceAccountUser.get_identity_setting(
+            settings.SERVICE_IDENTITY, 'TOKEN_TTL'
+        )
+        if self.min_ttl >= token_ttl:
+            raise ImproperlyConfigured(
+                '`TOKEN_TTL_EXPIRY_THRESHOLD` + `TOKEN_REFRESH_MARGIN` must be '
+                'lower than `TOKEN_TTL` to refresh tokens in the background'
+            )
+
+
+class TokenRefresher(BaseTokenRefresher):
+    """
+    Refresh the token in a daemon thread.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def refresh(self) -> float:
+        """
+        Refresh the token if needed and return the number of seconds to wait
+        before the next refresh.
+        """
+        try:
+            _, ttl = ServiceAccountUser.get_or_create_authentication_token_with_ttl(
+                self.min_ttl
+            )
+        except Exception:
+            logger.exception('Could not refresh service account token')
+            return RETRY_INTERVAL
+        return self._get_interval(ttl)
+
+    def start(self):
+        if self.is_running:
+            return
+        self.check_settings()
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='kobo-service-account-refresher', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop_event.set()
+        if self.is_running:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.refresh()):
+            pass
+
+
+class AsyncTokenRefresher(BaseTokenRefresher):
+    """
+    Refresh the token in an asyncio task, e.g. under ASGI.
+    """
+
+    def __init__(self):
+        self._task = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def refresh(self) -> float:
+        """
+        Refresh the token if needed and return the number of seconds to wait
+        before the next refresh.
+        """
+        try:
+            _, ttl = await (
+                ServiceAccountUser.aget_or_create_authentication_token_with_ttl(
+                    self.min_ttl
+                )
+            )
+        except Exception:
+            logger.exception('Could not refresh service account token')
+            return RETRY_INTERVAL
+        return self._get_interval(ttl)
+
+    def start(self):
+        """
+        Start refreshing the token in the running event loop
+        """
+        if self.is_running:
+            return
+        self.check_settings()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.is_running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(await self.refresh())
+
+
+_refresher = None
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+
+def start_token_refresher() -> TokenRefresher:
+    """
+    Start the token refresher of the current process, e.g. in
+    `AppConfig.ready()` or in a gunicorn `post_fork` hook.
+
+    Threads do not survive a fork, so a forked worker gets its own refresher.
+    """
+    global _refresher, _refresher_pid
+
+    with _refresher_lock:
+        if _refresher is None or _refresher_pid != os.getpid():
+            _refresher = TokenRefresher()
+            _refresher_pid = os.getpid()
+        _refresher.start()
+        return _refresher
+
+
+def stop_token_refresher(timeout: Optional[float] = None):
+    """
+    Stop the token refresher of the current process, e.g. in a gunicorn
+    `worker_exit` hook.
+    """
+    global _refresher, _refresher_pid
+
+    with _refresher_lock:
+        if _refresher is not None and _refresher_pid == os.getpid():
+            _refresher.stop(timeout)
+        _refresher = None
+        _refresher_pid = None
@@ -0,0 +1,107 @@
+"""
+Authenticate outgoing `requests` calls with the service account.
+
+Requires `requests` (`pip install kobo-service-account[requests]`).
+"""
+from __future__ import annotations
+
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .models import ServiceAccountUser
+from .utils import get_request_headers
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class ServiceAccountAuth(requests.auth.AuthBase):
+    """
+    Add the headers returned by `get_request_headers()` to each request sent
+    on behalf of `username`, with a token of `identity` (default to
+    `settings.SERVICE_IDENTITY`).
+
+    The token comes from the local token cache (see
+    `settings.LOCAL_TOKEN_CACHE`). If the receiving app answers 401 (e.g. the
+    token was rotated in the meantime), the token is read again from the token
+    store and, if it has changed, the request is replayed once. Requests with
+    a streamed body (files, generators) cannot be replayed and return the 401
+    response.
+
+        requests.get(url, auth=ServiceAccountAuth(request.user.username))
+    """
+
+    def __init__(self, username: str, identity: Optional[str] = None):
+        self.username = username
+        self.identity = identity
+
+    def __call__(self, request: requests.PreparedRequest) -> requests.PreparedRequest:
+        request.headers.update(get_request_headers(self.username, self.identity))
+        request.register_hook('response', self._handle_401)
+        return request
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ServiceAccountAuth)
+            and (self.username, self.identity) == (other.username, other.identity)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _handle_401(self, response: requests.Response, **kwargs) -> requests.Response:
+        if response.status_code != 401 or not isinstance(
+            response.request.body, (bytes, str, type(None))
+        ):
+            return response
+
+        ServiceAccountUser.clear_local_token(self.identity)
+        headers = get_request_headers(self.username, self.identity)
+        # The same token would be rejected again.
+        if headers['Authorization'] == response.request.headers['Authorization']:
+            return response
+
+        # Release the connection before sending the request again.
+        response.content  # noqa
+        response.close()
+
+        request = response.request.copy()
+        request.headers.update(headers)
+        # Hooks are copied too; this one must not run on the replayed response.
+        request.hooks['response'] = [
+            hook for hook in request.hooks['response'] if hook != self._handle_401
+        ]
+        replayed_response = response.connection.send(request, **kwargs)
+        replayed_response.history.append(response)
+        replayed_response.request = request
+        return replayed_response
+
+
+def get_session(
+    username: Optional[str] = None,
+    identity: Optional[str] = None,
+    pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+) -> requests.Session:
+    """
+    Return a `requests.Session` which keeps connections alive and pools them
+    (`pool_connections` hosts, `pool_maxsize` connections per host), to send
+    many requests to other apps without a TCP (and TLS) handshake each time.
+
+    Requests are authenticated on behalf of `username` if given; otherwise
+    pass `auth=ServiceAccountAuth(username)` to each call.
+
+    Sessions are not thread-safe: create one per thread (or worker) and reuse
+    it.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if username is not None:
+        session.auth = ServiceAccountAuth(username, identity)
+    return session
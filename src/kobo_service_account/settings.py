@@ -3,16 +3,44 @@ from __future__ import annotations
 from django.conf import settings
 from rest_framework.settings import APISettings
 
+TOKEN_MODE_REDIS = 'redis'
+TOKEN_MODE_SIGNED = 'signed'
+
 DEFAULTS = {
     'BACKEND': {
         'LOCATION': 'redis://localhost/'
     },
+    'TOKEN_STORE': 'kobo_service_account.stores.RedisTokenStore',
+    'TOKEN_STORE_TIMEOUT': 1,
+    'CIRCUIT_BREAKER_THRESHOLD': 5,
+    'CIRCUIT_BREAKER_RESET_TIMEOUT': 10,
     'NAMESPACE': 'kobo-service-account',
+    'SERVICE_IDENTITY': None,
+    'SERVICE_IDENTITIES': {},
+    'TOKEN_MODE': TOKEN_MODE_REDIS,
+    'SIGNING_KEYS': [],
     'TOKEN_TTL': 60,
     'TOKEN_TTL_EXPIRY_THRESHOLD': 5,
     'TOKEN_LENGTH': 50,
+    'TOKEN_RING_SIZE': 0,
     'ON_BEHALF_HEADER': 'Kobo-Service-Account-On-Behalf',
     'WHITELISTED_HOSTS': [],
+    'LOCAL_TOKEN_CACHE': True,
+    'TOKEN_REFRESH_MARGIN': 1,
+    'VALIDATED_TOKEN_CACHE_SIZE': 32,
+    'REJECTED_TOKEN_CACHE_SIZE': 1024,
+    'REJECTED_TOKEN_CACHE_TTL': 60,
+    'FAILED_AUTHENTICATION_LIMIT': 0,
+    'FAILED_AUTHENTICATION_PERIOD': 60,
+    'FAILED_AUTHENTICATION_SOURCE': 'REMOTE_ADDR',
+    'FAILED_AUTHENTICATION_LIMITER': 'kobo_service_account.throttling.LocalFailureLimiter',
+    'REAL_USER_CACHE_SIZE': 0,
+    'REAL_USER_CACHE_TTL': 60,
+    'REAL_USER_FIELDS': [],
+    'REAL_USER_SELECT_RELATED': [],
+    'PERMISSION_CACHE_TTL': 300,
+    'METRICS_SINK': 'kobo_service_account.metrics.NullMetricsSink',
+    'METRICS_OPTIONS': {},
 }
 
 
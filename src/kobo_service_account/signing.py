@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import service_account_settings as settings
+
+TOKEN_VERSION = 'v1'
+# Maximum difference (in seconds) tolerated between the clocks of the
+# sender and the verifier
+MAX_CLOCK_SKEW = 5
+
+
+def create_signed_token() -> tuple[str, float]:
+    """
+    Return a new token signed with the current key (the first one of
+    `settings.SIGNING_KEYS`), with its time to live (in seconds).
+
+    Token format is `v1.<expiry timestamp>.<key id>.<signature>`.
+    """
+    key = _get_signing_keys()[0]
+    expires_at = int(time.time()) + settings.TOKEN_TTL
+    kid = key.get('ID', '')
+    signature = _sign(key['SECRET'], expires_at, kid)
+    token = f'{TOKEN_VERSION}.{expires_at}.{kid}.{signature}'
+    return token, expires_at - time.time()
+
+
+def verify_signed_token(token: str) -> Optional[float]:
+    """
+    Validate a token created by `create_signed_token()` locally, without any
+    network call.
+
+    Return its remaining time to live (in seconds), or `None` if it is not
+    valid, i.e. malformed, expired, or not signed with the current or the
+    previous key.
+    """
+    try:
+        version, expires_at, kid, signature = token.split('.')
+        expires_at = int(expires_at)
+    except ValueError:
+        return None
+
+    if version != TOKEN_VERSION:
+        return None
+
+    # Reject tokens which claim to live longer than a token can.
+    ttl = expires_at - time.time()
+    if not 0 < ttl <= settings.TOKEN_TTL + MAX_CLOCK_SKEW:
+        return None
+
+    for key in _get_signing_keys():
+        # Without key id, try each key (there are at most two).
+        if kid and key.get('ID', '') != kid:
+            continue
+        if hmac.compare_digest(_sign(key['SECRET'], expires_at, kid), signature):
+            return ttl
+
+    return None
+
+
+def _get_signing_keys() -> list[dict]:
+    if not (keys := settings.SIGNING_KEYS):
+        raise ImproperlyConfigured(
+            '`SIGNING_KEYS` must be set to use signed tokens'
+        )
+    return keys
+
+
+def _sign(secret: str, expires_at: int, kid: str) -> str:
+    # The namespace is signed too, so tokens cannot be used across namespaces.
+    message = f'{settings.NAMESPACE}.{expires_at}.{kid}'.encode()
+    digest = hmac.new(secret.encode(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
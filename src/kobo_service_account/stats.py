@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import contextvars
+import threading
+
+
+class RoundTripCounter:
+    """
+    Thread-safe counter of the network round-trips made to redis by this
+    library.
+
+    A pipeline counts as one round-trip, whatever the number of commands it
+    contains.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._context_count = contextvars.ContextVar(
+            'redis_round_trips', default=0
+        )
+
+    def increment(self):
+        with self._lock:
+            self._count += 1
+        self._context_count.set(self._context_count.get() + 1)
+
+    def reset(self):
+        with self._lock:
+            self._count = 0
+
+    @property
+    def context_count(self) -> int:
+        """
+        Number of round-trips made in the current context (thread or asyncio
+        task), e.g. to measure the round-trips of one request.
+        It is not affected by `reset()`.
+        """
+        return self._context_count.get()
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+
+redis_round_trips = RoundTripCounter()
@@ -0,0 +1,1462 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import math
+import os
+import random
+import stat
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+from urllib.parse import urlparse
+
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.asyncio.sentinel
+import redis.cluster
+import redis.sentinel
+from asgiref.sync import sync_to_async
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.utils.module_loading import import_string
+
+from .cache import (
+    INVALIDATION_MESSAGE,
+    AsyncTokenInvalidationSubscriber,
+    SharedMemoryPairCache,
+    SharedPair,
+    TokenInvalidationSubscriber,
+    ValidatedTokenCache,
+    check_private,
+)
+from .connection import (
+    LoopLocal,
+    create_async_redis_client,
+    create_redis_client,
+    get_connection_kwargs,
+)
+from .exceptions import TokenRotationLockTimeout
+from .settings import service_account_settings as settings
+from .stats import redis_round_trips
+
+logger = logging.getLogger(__name__)
+
+
+class TokenKeys(NamedTuple):
+    """
+    Names of the keys (and channel) of the token pair of a service identity
+    """
+
+    current: str
+    obsolete: str
+    ring: str
+    channel: str
+    identity: Optional[str] = None
+
+
+class BaseTokenStore:
+    """
+    Interface of the backends where authentication tokens are stored.
+
+    Times to live are in seconds. Like redis, -2 means the key does not exist
+    and -1 that it does not expire.
+    """
+
+    # Whether the keys of a token pair must share a hash tag, i.e. live in
+    # the same Redis Cluster slot. Other stores keep the key names shared
+    # with apps running older versions of this library.
+    uses_hash_tags = False
+
+    # Errors meaning the store cannot be reached, which are counted by the
+    # circuit breaker (see `kobo_service_account.circuit_breaker`)
+    unavailable_errors = (
+        ConnectionError,
+        TimeoutError,
+        redis.ConnectionError,
+        redis.TimeoutError,
+    )
+
+    def delete(self, *keys: str):
+        raise NotImplementedError
+
+    def get(self, key: str) -> Optional[str]:
+        token, _ = self.get_with_ttl(key)
+        return token
+
+    def get_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        """
+        Return the current token with its time to live
+        """
+        return self.get_with_ttl(keys.current)
+
+    def get_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        """
+        Return the current and the obsolete tokens with their time to live,
+        in one call.
+        """
+        raise NotImplementedError
+
+    def get_pair_for(
+        self, keys: TokenKeys, token: str
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        """
+        Same as `get_pair()`, to validate `token`. Stores which cache pairs
+        read them again if `token` does not match the cached pair.
+        """
+        return self.get_pair(keys)
+
+    def get_ring_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        """
+        Return the newest token of the ring `keys.ring` with its time to live
+        """
+        raise NotImplementedError
+
+    def get_ring_token_ttl(self, keys: TokenKeys, token: str) -> Optional[float]:
+        """
+        Return the time to live of `token` if it belongs to the ring
+        `keys.ring` and has not expired, `None` otherwise
+        """
+        raise NotImplementedError
+
+    def get_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        raise NotImplementedError
+
+    def poll_invalidation(self, channel: str, cache: ValidatedTokenCache) -> bool:
+        """
+        Drop the tokens of `cache` which have been invalidated on `channel`
+        since last call.
+
+        Return whether `cache` can be trusted, i.e. whether the store can
+        notify this process about invalidations. Raise one of
+        `unavailable_errors` if the store cannot be reached.
+        """
+        return False
+
+    def publish_invalidation(self, channel: str, identity: Optional[str] = None):
+        """
+        Tell verifiers to drop the validated tokens of `identity`
+        """
+        pass
+
+    def rotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        """
+        Replace the current token with `token` (for `ttl` seconds) if it
+        expires in less than `min_ttl` seconds. The replaced token becomes
+        the obsolete one until its own expiry, and an invalidation of
+        `keys.identity` is published on `keys.channel`.
+
+        Only one concurrent caller replaces the token; the others get the
+        token of the winner. Return the current token after the rotation,
+        with its time to live.
+        """
+        raise NotImplementedError
+
+    def rotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        """
+        Same as `rotate()` with a ring of (at most) `size` tokens: `token` is
+        added to the ring if its newest token expires in less than `min_ttl`
+        seconds. Older tokens stay valid until their own expiry, unless they
+        are evicted by newer ones.
+        """
+        raise NotImplementedError
+
+    def set(self, key: str, token: str, ttl: float):
+        raise NotImplementedError
+
+    def ttl(self, key: str) -> float:
+        _, ttl = self.get_with_ttl(key)
+        return ttl
+
+    # Async counterparts. Stores without an async client run the sync
+    # methods, which must not block (e.g. `InMemoryTokenStore`).
+
+    async def aget_current(
+        self, keys: TokenKeys
+    ) -> tuple[Optional[str], float]:
+        return await self.aget_with_ttl(keys.current)
+
+    async def aget_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        return self.get_pair(keys)
+
+    async def aget_pair_for(
+        self, keys: TokenKeys, token: str
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        return await self.aget_pair(keys)
+
+    async def aget_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        return self.get_with_ttl(key)
+
+    async def apoll_invalidation(
+        self, channel: str, cache: ValidatedTokenCache
+    ) -> bool:
+        return self.poll_invalidation(channel, cache)
+
+    async def aget_ring_current(
+        self, keys: TokenKeys
+    ) -> tuple[Optional[str], float]:
+        return self.get_ring_current(keys)
+
+    async def aget_ring_token_ttl(
+        self, keys: TokenKeys, token: str
+    ) -> Optional[float]:
+        return self.get_ring_token_ttl(keys, token)
+
+    async def arotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        return self.rotate(keys, token, ttl, min_ttl)
+
+    async def arotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        return self.rotate_ring(keys, token, ttl, min_ttl, size)
+
+
+class InMemoryTokenStore(BaseTokenStore):
+    """
+    Store tokens in process memory.
+
+    Tokens are not shared with other processes. It suits tests and
+    deployments where senders and verifiers run in the same process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._rings = {}
+        self._caches = weakref.WeakSet()
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._rings.pop(key, None)
+
+    def get_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        now = time.monotonic()
+        with self._lock:
+            return self._get(keys.current, now), self._get(keys.obsolete, now)
+
+    def get_ring_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        with self._lock:
+            return self._get_ring_current(keys.ring, time.monotonic())
+
+    def get_ring_token_ttl(self, keys: TokenKeys, token: str) -> Optional[float]:
+        with self._lock:
+            expires_at = self._rings.get(keys.ring, {}).get(token)
+        if expires_at is None or (ttl := expires_at - time.monotonic()) <= 0:
+            return None
+        return ttl
+
+    def get_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def poll_invalidation(self, channel: str, cache: ValidatedTokenCache) -> bool:
+        # Invalidations happen in this process, caches are cleared right away.
+        self._caches.add(cache)
+        return True
+
+    def publish_invalidation(self, channel: str, identity: Optional[str] = None):
+        for cache in list(self._caches):
+            cache.invalidate(identity)
+
+    def rotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        now = time.monotonic()
+        with self._lock:
+            current_token, current_ttl = self._get(keys.current, now)
+            if current_token and current_ttl >= min_ttl:
+                return current_token, current_ttl
+
+            if current_token:
+                self._entries[keys.obsolete] = self._entries[keys.current]
+            self._entries[keys.current] = (token, now + ttl)
+
+        self.publish_invalidation(keys.channel, keys.identity)
+        return token, ttl
+
+    def rotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        now = time.monotonic()
+        with self._lock:
+            current_token, current_ttl = self._get_ring_current(keys.ring, now)
+            if current_token and current_ttl >= min_ttl:
+                return current_token, current_ttl
+
+            ring = {
+                ring_token: expires_at
+                for ring_token, expires_at in self._rings.get(keys.ring, {}).items()
+                if expires_at > now
+            }
+            ring[token] = now + ttl
+            # Keep the newest tokens
+            newest = sorted(ring.items(), key=lambda item: item[1])[-size:]
+            self._rings[keys.ring] = dict(newest)
+
+        self.publish_invalidation(keys.channel, keys.identity)
+        return token, ttl
+
+    def set(self, key: str, token: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (token, time.monotonic() + ttl)
+
+    def _get(self, key: str, now: float) -> tuple[Optional[str], float]:
+        try:
+            token, expires_at = self._entries[key]
+        except KeyError:
+            return None, -2
+
+        if expires_at <= now:
+            del self._entries[key]
+            return None, -2
+
+        return token, expires_at - now
+
+    def _get_ring_current(
+        self, key: str, now: float
+    ) -> tuple[Optional[str], float]:
+        if not (ring := self._rings.get(key)):
+            return None, -2
+
+        token, expires_at = max(ring.items(), key=lambda item: item[1])
+        if expires_at <= now:
+            return None, -2
+        return token, expires_at - now
+
+
+class DjangoCacheTokenStore(BaseTokenStore):
+    """
+    Store tokens with Django cache framework, in the cache
+    `settings.BACKEND['OPTIONS']['CACHE_ALIAS']` (`default` if not set).
+
+    Tokens are stored with their expiry, since the cache API cannot return
+    the time to live of a key. Invalidations cannot be published, so
+    validated tokens are not cached by verifiers.
+    """
+
+    # Maximum time (in seconds) a rotation can take
+    LOCK_TIMEOUT = 5
+
+    @property
+    def cache(self):
+        options = settings.BACKEND.get('OPTIONS', {})
+        return caches[options.get('CACHE_ALIAS', DEFAULT_CACHE_ALIAS)]
+
+    def delete(self, *keys: str):
+        self.cache.delete_many(keys)
+
+    def get_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        values = self.cache.get_many([keys.current, keys.obsolete])
+        return (
+            self._parse(values.get(keys.current)),
+            self._parse(values.get(keys.obsolete)),
+        )
+
+    def get_ring_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        if ring := self._get_ring(keys.ring):
+            return self._parse(ring[-1])
+        return None, -2
+
+    def get_ring_token_ttl(self, keys: TokenKeys, token: str) -> Optional[float]:
+        # Rings are small, a linear search is fine.
+        for ring_token, expires_at in self._get_ring(keys.ring):
+            if ring_token == token:
+                ttl = expires_at - time.time()
+                return ttl if ttl > 0 else None
+        return None
+
+    def get_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        return self._parse(self.cache.get(key))
+
+    def rotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        def _get_current():
+            return self.get_with_ttl(keys.current)
+
+        def _rotate(current_token, current_ttl):
+            if current_token:
+                self.set(keys.obsolete, current_token, current_ttl)
+            self.set(keys.current, token, ttl)
+
+        return self._rotate_with_lock(
+            f'{keys.current}::lock', _get_current, _rotate, token, ttl, min_ttl
+        )
+
+    def rotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        def _get_current():
+            return self.get_ring_current(keys)
+
+        def _rotate(current_token, current_ttl):
+            now = time.time()
+            ring = [entry for entry in self._get_ring(keys.ring) if entry[1] > now]
+            ring.append((token, now + ttl))
+            self.cache.set(keys.ring, ring[-size:], timeout=math.ceil(ttl))
+
+        return self._rotate_with_lock(
+            f'{keys.ring}::lock', _get_current, _rotate, token, ttl, min_ttl
+        )
+
+    def set(self, key: str, token: str, ttl: float):
+        self.cache.set(key, (token, time.time() + ttl), timeout=math.ceil(ttl))
+
+    async def aget_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        return await sync_to_async(self.get_pair)(keys)
+
+    async def aget_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        return await sync_to_async(self.get_with_ttl)(key)
+
+    async def aget_ring_current(
+        self, keys: TokenKeys
+    ) -> tuple[Optional[str], float]:
+        return await sync_to_async(self.get_ring_current)(keys)
+
+    async def aget_ring_token_ttl(
+        self, keys: TokenKeys, token: str
+    ) -> Optional[float]:
+        return await sync_to_async(self.get_ring_token_ttl)(keys, token)
+
+    async def arotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        return await sync_to_async(self.rotate)(keys, token, ttl, min_ttl)
+
+    async def arotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        return await sync_to_async(self.rotate_ring)(
+            keys, token, ttl, min_ttl, size
+        )
+
+    def _get_ring(self, key: str) -> list[tuple[str, float]]:
+        """
+        Return the tokens of the ring with their expiry, the newest last
+        """
+        return self.cache.get(key) or []
+
+    def _parse(self, value: Optional[tuple]) -> tuple[Optional[str], float]:
+        if value is None:
+            return None, -2
+
+        token, expires_at = value
+        if (ttl := expires_at - time.time()) <= 0:
+            return None, -2
+        return token, ttl
+
+    def _rotate_with_lock(
+        self,
+        lock_key: str,
+        get_current: Callable[[], tuple[Optional[str], float]],
+        rotate: Callable[[Optional[str], float], None],
+        token: str,
+        ttl: float,
+        min_ttl: float,
+    ) -> tuple[str, float]:
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + self.LOCK_TIMEOUT
+        while True:
+            current_token, current_ttl = get_current()
+            if current_token and current_ttl >= min_ttl:
+                return current_token, current_ttl
+
+            # `add()` is atomic: only one process gets the lock. The token is
+            # read again once the lock is acquired, in case another process
+            # has just released it.
+            if self.cache.add(lock_key, owner, timeout=self.LOCK_TIMEOUT):
+                break
+
+            if time.monotonic() > deadline:
+                # The current token is still better than no token at all
+                if current_token:
+                    return current_token, current_ttl
+                raise TokenRotationLockTimeout(
+                    'Could not acquire token rotation lock'
+                )
+            time.sleep(0.01)
+
+        try:
+            current_token, current_ttl = get_current()
+            if current_token and current_ttl >= min_ttl:
+                return current_token, current_ttl
+            rotate(current_token, current_ttl)
+        finally:
+            # The lock may have expired and been acquired by another process
+            if self.cache.get(lock_key) == owner:
+                self.cache.delete(lock_key)
+
+        return token, ttl
+
+
+class RedisTokenStore(BaseTokenStore):
+    """
+    Store tokens in a single redis server, `settings.BACKEND['LOCATION']`.
+
+    Verifiers are notified about token rotations with redis pub/sub.
+    """
+
+    # Whether PUBLISH can be part of the rotation transaction
+    publish_in_transaction = True
+
+    def __init__(
+        self,
+        client: Optional[redis.Redis] = None,
+        async_client: Optional[redis.asyncio.Redis] = None,
+    ):
+        self._lock = threading.Lock()
+        self._client = client
+        self._async_client = async_client
+        self._async_clients = LoopLocal(self._create_async_client)
+        self._subscriber = None
+        self._async_subscriber = None
+
+    @property
+    def async_client(self) -> redis.asyncio.Redis:
+        """
+        Client bound to the running event loop
+        """
+        if self._async_client is not None:
+            return self._async_client
+        return self._async_clients.get()
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def delete(self, *keys: str):
+        redis_round_trips.increment()
+        self.client.delete(*keys)
+
+    def get_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        p = self._pair_pipeline(self.client, keys)
+        return self._parse_pair(self._execute(p))
+
+    def get_ring_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        redis_round_trips.increment()
+        return self._parse_ring_current(
+            self.client.zrange(keys.ring, -1, -1, withscores=True)
+        )
+
+    def get_ring_token_ttl(self, keys: TokenKeys, token: str) -> Optional[float]:
+        # Membership and expiry are checked with one command.
+        redis_round_trips.increment()
+        return _score_to_ttl(self.client.zscore(keys.ring, token))
+
+    def get_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        p = self._token_pipeline(self.client, key)
+        return self._parse_token(self._execute(p))
+
+    def poll_invalidation(self, channel: str, cache: ValidatedTokenCache) -> bool:
+        if self._subscriber is None or self._subscriber.cache is not cache:
+            self._subscriber = TokenInvalidationSubscriber(cache)
+        return self._subscriber.poll(self.client, channel)
+
+    def publish_invalidation(self, channel: str, identity: Optional[str] = None):
+        redis_round_trips.increment()
+        self.client.publish(channel, identity or INVALIDATION_MESSAGE)
+
+    def rotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        return self._rotate(
+            keys,
+            keys.current,
+            lambda: self.get_with_ttl(keys.current),
+            lambda p, current_token, current_ttl: self._add_rotation_commands(
+                p, keys, token, ttl, current_token, current_ttl
+            ),
+            token,
+            ttl,
+            min_ttl,
+        )
+
+    def rotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        return self._rotate(
+            keys,
+            keys.ring,
+            lambda: self.get_ring_current(keys),
+            lambda p, _, __: self._add_ring_rotation_commands(
+                p, keys, token, ttl, size
+            ),
+            token,
+            ttl,
+            min_ttl,
+        )
+
+    def set(self, key: str, token: str, ttl: float):
+        redis_round_trips.increment()
+        self.client.set(key, token, px=int(ttl * 1000))
+
+    async def aget_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        p = self._pair_pipeline(self.async_client, keys)
+        return self._parse_pair(await self._aexecute(p))
+
+    async def aget_ring_current(
+        self, keys: TokenKeys
+    ) -> tuple[Optional[str], float]:
+        redis_round_trips.increment()
+        return self._parse_ring_current(
+            await self.async_client.zrange(keys.ring, -1, -1, withscores=True)
+        )
+
+    async def aget_ring_token_ttl(
+        self, keys: TokenKeys, token: str
+    ) -> Optional[float]:
+        redis_round_trips.increment()
+        return _score_to_ttl(await self.async_client.zscore(keys.ring, token))
+
+    async def aget_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        p = self._token_pipeline(self.async_client, key)
+        return self._parse_token(await self._aexecute(p))
+
+    async def apoll_invalidation(
+        self, channel: str, cache: ValidatedTokenCache
+    ) -> bool:
+        if (
+            self._async_subscriber is None
+            or self._async_subscriber.cache is not cache
+        ):
+            self._async_subscriber = AsyncTokenInvalidationSubscriber(cache)
+        return await self._async_subscriber.poll(self.async_client, channel)
+
+    async def arotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        return await self._arotate(
+            keys,
+            keys.current,
+            lambda: self.aget_with_ttl(keys.current),
+            lambda p, current_token, current_ttl: self._add_rotation_commands(
+                p, keys, token, ttl, current_token, current_ttl
+            ),
+            token,
+            ttl,
+            min_ttl,
+        )
+
+    async def arotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        return await self._arotate(
+            keys,
+            keys.ring,
+            lambda: self.aget_ring_current(keys),
+            lambda p, _, __: self._add_ring_rotation_commands(
+                p, keys, token, ttl, size
+            ),
+            token,
+            ttl,
+            min_ttl,
+        )
+
+    def _add_ring_rotation_commands(
+        self, pipeline, keys: TokenKeys, token: str, ttl: float, size: int
+    ):
+        now = time.time()
+        # Scores are expiry timestamps: expired tokens are dropped, then the
+        # oldest ones beyond `size`.
+        pipeline.zadd(keys.ring, {token: now + ttl})
+        pipeline.zremrangebyscore(keys.ring, '-inf', now)
+        pipeline.zremrangebyrank(keys.ring, 0, -(size + 1))
+        # The whole ring expires with its newest token.
+        pipeline.pexpire(keys.ring, int(ttl * 1000))
+        if self.publish_in_transaction:
+            pipeline.publish(keys.channel, keys.identity or INVALIDATION_MESSAGE)
+
+    def _add_rotation_commands(
+        self,
+        pipeline,
+        keys: TokenKeys,
+        token: str,
+        ttl: float,
+        current_token: Optional[str],
+        current_ttl: float,
+    ):
+        # Rotate keys to avoid race conditions when a new key is created
+        # just after a request is sent with old key but before authentication
+        # is completed.
+        if current_ttl > 0:
+            pipeline.rename(keys.current, keys.obsolete)
+        pipeline.set(keys.current, token, px=int(ttl * 1000))
+        # Tell all verifiers to drop the tokens they have cached.
+        if self.publish_in_transaction:
+            pipeline.publish(keys.channel, keys.identity or INVALIDATION_MESSAGE)
+
+    async def _aexecute(self, pipeline) -> list:
+        redis_round_trips.increment()
+        return await pipeline.execute()
+
+    async def _arotate(
+        self,
+        keys: TokenKeys,
+        watched_key: str,
+        get_current: Callable[[], Awaitable[tuple[Optional[str], float]]],
+        add_commands: Callable[
+            [redis.asyncio.client.Pipeline, Optional[str], float], None
+        ],
+        token: str,
+        ttl: float,
+        min_ttl: float,
+    ) -> tuple[str, float]:
+        redis_client = self.async_client
+        async with redis_client.pipeline(transaction=True) as p:
+            while True:
+                redis_round_trips.increment()
+                await p.watch(watched_key)
+                current_token, current_ttl = await get_current()
+                if current_token and current_ttl >= min_ttl:
+                    return current_token, current_ttl
+
+                p.multi()
+                add_commands(p, current_token, current_ttl)
+                try:
+                    await self._aexecute(p)
+                except redis.WatchError:
+                    continue
+                break
+
+        if not self.publish_in_transaction:
+            redis_round_trips.increment()
+            await redis_client.publish(
+                keys.channel, keys.identity or INVALIDATION_MESSAGE
+            )
+        return token, ttl
+
+    def _create_async_client(self) -> redis.asyncio.Redis:
+        return create_async_redis_client()
+
+    def _create_client(self) -> redis.Redis:
+        return create_redis_client()
+
+    def _execute(self, pipeline) -> list:
+        """
+        Send all commands of `pipeline` to redis in one round-trip
+        """
+        redis_round_trips.increment()
+        return pipeline.execute()
+
+    @staticmethod
+    def _pair_pipeline(redis_client, keys: TokenKeys):
+        # Fetch both tokens in one round-trip to avoid a second call when
+        # the token has just been rotated.
+        p = redis_client.pipeline(transaction=False)
+        # GET rather than MGET, which cluster pipelines do not allow
+        p.get(keys.current)  # returns bytes
+        p.get(keys.obsolete)
+        p.pttl(keys.current)
+        p.pttl(keys.obsolete)
+        return p
+
+    @staticmethod
+    def _parse_pair(
+        results: list,
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        token, obsolete_token, pttl, obsolete_pttl = results
+        return (
+            (token and token.decode(), _pttl_to_ttl(pttl)),
+            (obsolete_token and obsolete_token.decode(), _pttl_to_ttl(obsolete_pttl)),
+        )
+
+    @staticmethod
+    def _parse_ring_current(results: list) -> tuple[Optional[str], float]:
+        if not results:
+            return None, -2
+
+        token, score = results[0]
+        if (ttl := _score_to_ttl(score)) is None:
+            return None, -2
+        return token.decode(), ttl
+
+    @staticmethod
+    def _parse_token(results: list) -> tuple[Optional[str], float]:
+        pttl, token = results
+        return token and token.decode(), _pttl_to_ttl(pttl)
+
+    def _rotate(
+        self,
+        keys: TokenKeys,
+        watched_key: str,
+        get_current: Callable[[], tuple[Optional[str], float]],
+        add_commands: Callable[
+            [redis.client.Pipeline, Optional[str], float], None
+        ],
+        token: str,
+        ttl: float,
+        min_ttl: float,
+    ) -> tuple[str, float]:
+        # The token key is watched, so the rotation transaction fails if
+        # any other process changes the token first; the token of the winner
+        # is returned instead.
+        with self.client.pipeline(transaction=True) as p:
+            while True:
+                redis_round_trips.increment()
+                p.watch(watched_key)
+                # Token may have been rotated before WATCH
+                current_token, current_ttl = get_current()
+                if current_token and current_ttl >= min_ttl:
+                    return current_token, current_ttl
+
+                p.multi()
+                add_commands(p, current_token, current_ttl)
+                try:
+                    self._execute(p)
+                except redis.WatchError:
+                    # Another process won, read its token.
+                    continue
+                break
+
+        if not self.publish_in_transaction:
+            self.publish_invalidation(keys.channel, keys.identity)
+        return token, ttl
+
+    @staticmethod
+    def _token_pipeline(redis_client, key: str):
+        p = redis_client.pipeline(transaction=False)
+        p.pttl(key)
+        p.get(key)
+        return p
+
+
+class RedisSentinelTokenStore(RedisTokenStore):
+    """
+    Store tokens in the master of a redis Sentinel deployment.
+
+    `settings.BACKEND['LOCATION']` is the list of sentinels
+    (e.g. `['sentinel://host1:26379', 'sentinel://host2:26379']`) and
+    `settings.BACKEND['OPTIONS']['SERVICE_NAME']` the name of the master.
+    """
+
+    def _create_async_client(self) -> redis.asyncio.Redis:
+        sentinel = redis.asyncio.sentinel.Sentinel(
+            self._get_sentinels(), **self._get_sentinel_kwargs()
+        )
+        return sentinel.master_for(
+            self._get_service_name(), **get_connection_kwargs()
+        )
+
+    def _create_client(self) -> redis.Redis:
+        sentinel = redis.sentinel.Sentinel(
+            self._get_sentinels(), **self._get_sentinel_kwargs()
+        )
+        return sentinel.master_for(
+            self._get_service_name(), **get_connection_kwargs()
+        )
+
+    def _get_sentinel_kwargs(self) -> dict:
+        options = settings.BACKEND.get('OPTIONS', {})
+        return {'sentinel_kwargs': options.get('SENTINEL_KWARGS')}
+
+    def _get_sentinels(self) -> list[tuple[str, int]]:
+        locations = settings.BACKEND['LOCATION']
+        if isinstance(locations, str):
+            locations = locations.split(',')
+
+        sentinels = []
+        for location in locations:
+            if '://' not in location:
+                location = f'sentinel://{location}'
+            url = urlparse(location)
+            sentinels.append((url.hostname, url.port or 26379))
+        return sentinels
+
+    def _get_service_name(self) -> str:
+        return settings.BACKEND['OPTIONS']['SERVICE_NAME']
+
+
+class RedisClusterTokenStore(RedisTokenStore):
+    """
+    Store tokens in a Redis Cluster, `settings.BACKEND['LOCATION']` being the
+    URL of any node.
+
+    Keys of a token pair share the same hash tag, so they live in the same
+    slot and can still be read and rotated together.
+    """
+
+    # PUBLISH has no key, it cannot be part of a single-slot transaction.
+    publish_in_transaction = False
+    uses_hash_tags = True
+
+    def _add_rotation_commands(
+        self,
+        pipeline,
+        keys: TokenKeys,
+        token: str,
+        ttl: float,
+        current_token: Optional[str],
+        current_ttl: float,
+    ):
+        # Cluster pipelines do not allow RENAME. The current token, which is
+        # watched, is copied instead.
+        if current_ttl > 0:
+            pipeline.set(
+                keys.obsolete, current_token, px=int(current_ttl * 1000)
+            )
+        pipeline.set(keys.current, token, px=int(ttl * 1000))
+
+    def _create_async_client(self) -> redis.asyncio.Redis:
+        return redis.asyncio.cluster.RedisCluster.from_url(
+            settings.BACKEND['LOCATION'], **get_connection_kwargs()
+        )
+
+    def _create_client(self) -> redis.Redis:
+        return redis.cluster.RedisCluster.from_url(
+            settings.BACKEND['LOCATION'], **get_connection_kwargs()
+        )
+
+
+class RedisReplicaTokenStore(RedisTokenStore):
+    """
+    Rotate tokens on the primary, `settings.BACKEND['LOCATION']`, and read
+    them from replicas, `settings.BACKEND['OPTIONS']['REPLICAS']` (a list of
+    URLs, or a comma-separated string), picked at random for each read.
+
+    Replicas may lag behind the primary right after a rotation: a token which
+    does not match the one read from a replica is checked once against the
+    primary. Senders read the current token from replicas too; the rotation
+    itself always reads the primary. The primary is also read if a replica
+    cannot be reached, or has no current token yet.
+    """
+
+    # Errors of a replica after which the primary is read instead
+    replica_errors = (redis.ConnectionError, redis.TimeoutError)
+
+    def __init__(
+        self,
+        client: Optional[redis.Redis] = None,
+        async_client: Optional[redis.asyncio.Redis] = None,
+        replica_clients: Optional[list[redis.Redis]] = None,
+        async_replica_clients: Optional[list[redis.asyncio.Redis]] = None,
+    ):
+        super().__init__(client, async_client)
+        self._replica_clients = replica_clients
+        self._async_replica_clients = async_replica_clients
+        self._async_replica_clients_by_loop = LoopLocal(
+            self._create_async_replica_clients
+        )
+
+    @property
+    def async_replica_clients(self) -> list[redis.asyncio.Redis]:
+        if self._async_replica_clients is not None:
+            return self._async_replica_clients
+        return self._async_replica_clients_by_loop.get()
+
+    @property
+    def replica_clients(self) -> list[redis.Redis]:
+        if self._replica_clients is None:
+            with self._lock:
+                if self._replica_clients is None:
+                    self._replica_clients = [
+                        create_redis_client(location)
+                        for location in self._get_replica_locations()
+                    ]
+        return self._replica_clients
+
+    def get_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        try:
+            p = self._token_pipeline(self._get_replica_client(), keys.current)
+            token, ttl = self._parse_token(self._execute(p))
+        except self.replica_errors:
+            return super().get_current(keys)
+        if token is None:
+            return super().get_current(keys)
+        return token, ttl
+
+    def get_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        try:
+            p = self._pair_pipeline(self._get_replica_client(), keys)
+            return self._parse_pair(self._execute(p))
+        except self.replica_errors:
+            return super().get_pair(keys)
+
+    def get_pair_for(
+        self, keys: TokenKeys, token: str
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        pair = self.get_pair(keys)
+        if self._pair_has_token(pair, token):
+            return pair
+        return super().get_pair(keys)
+
+    def get_ring_token_ttl(self, keys: TokenKeys, token: str) -> Optional[float]:
+        try:
+            redis_round_trips.increment()
+            replica_client = self._get_replica_client()
+            if ttl := _score_to_ttl(replica_client.zscore(keys.ring, token)):
+                return ttl
+        except self.replica_errors:
+            pass
+        return super().get_ring_token_ttl(keys, token)
+
+    async def aget_current(
+        self, keys: TokenKeys
+    ) -> tuple[Optional[str], float]:
+        try:
+            p = self._token_pipeline(
+                self._get_async_replica_client(), keys.current
+            )
+            token, ttl = self._parse_token(await self._aexecute(p))
+        except self.replica_errors:
+            return await super().aget_current(keys)
+        if token is None:
+            return await super().aget_current(keys)
+        return token, ttl
+
+    async def aget_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        try:
+            p = self._pair_pipeline(self._get_async_replica_client(), keys)
+            return self._parse_pair(await self._aexecute(p))
+        except self.replica_errors:
+            return await super().aget_pair(keys)
+
+    async def aget_pair_for(
+        self, keys: TokenKeys, token: str
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        pair = await self.aget_pair(keys)
+        if self._pair_has_token(pair, token):
+            return pair
+        return await super().aget_pair(keys)
+
+    async def aget_ring_token_ttl(
+        self, keys: TokenKeys, token: str
+    ) -> Optional[float]:
+        try:
+            redis_round_trips.increment()
+            replica_client = self._get_async_replica_client()
+            score = await replica_client.zscore(keys.ring, token)
+            if ttl := _score_to_ttl(score):
+                return ttl
+        except self.replica_errors:
+            pass
+        return await super().aget_ring_token_ttl(keys, token)
+
+    def _create_async_replica_clients(self) -> list[redis.asyncio.Redis]:
+        return [
+            create_async_redis_client(location)
+            for location in self._get_replica_locations()
+        ]
+
+    def _get_async_replica_client(self) -> redis.asyncio.Redis:
+        return random.choice(self.async_replica_clients)
+
+    def _get_replica_client(self) -> redis.Redis:
+        return random.choice(self.replica_clients)
+
+    def _get_replica_locations(self) -> list[str]:
+        locations = settings.BACKEND['OPTIONS']['REPLICAS']
+        if isinstance(locations, str):
+            locations = locations.split(',')
+        return [location.strip() for location in locations]
+
+    @staticmethod
+    def _pair_has_token(
+        pair: tuple[tuple[Optional[str], float], tuple[Optional[str], float]],
+        token: str,
+    ) -> bool:
+        (current_token, _), (obsolete_token, _) = pair
+        return token in (current_token, obsolete_token)
+
+
+class SharedMemoryTokenStore(BaseTokenStore):
+    """
+    Share the token pairs of another store between all processes of a host,
+    in memory-mapped files.
+
+    Token pairs are read from shared memory, without any lock. The other
+    store is only read when the pair is missing, when its current token has
+    expired, or when the token being validated does not match it (e.g. after
+    a rotation). Then one process of the host reads it while the others wait
+    and reuse its result, so the traffic of a host to the other store does
+    not grow with its number of workers.
+
+    Tokens matching the cached pair are accepted until their expiry.
+    Rings (see `settings.TOKEN_RING_SIZE`) are not cached.
+
+    Options (`settings.BACKEND['OPTIONS']`):
+    - `SHARED_MEMORY_STORE`: dotted path of the other store (default:
+      `kobo_service_account.stores.RedisTokenStore`)
+    - `SHARED_MEMORY_DIR`: directory of the files (default: `/dev/shm` if it
+      exists, the temporary directory otherwise). The files are created in
+      a subdirectory private to the effective user, so only its processes
+      share them.
+
+    If the files cannot be used safely (e.g. created by another user), the
+    other store is read directly.
+    """
+
+    def __init__(self, store: Optional[BaseTokenStore] = None):
+        options = settings.BACKEND.get('OPTIONS', {})
+        if store is None:
+            store = self.get_store_class()()
+        self.store = store
+        self.directory = (
+            options.get('SHARED_MEMORY_DIR') or _get_shared_memory_dir()
+        )
+        self._lock = threading.Lock()
+        self._caches = {}
+        self._pid = os.getpid()
+
+    @staticmethod
+    def get_store_class() -> type[BaseTokenStore]:
+        """
+        Return the class of the wrapped store
+        """
+        return import_string(
+            settings.BACKEND.get('OPTIONS', {}).get(
+                'SHARED_MEMORY_STORE',
+                'kobo_service_account.stores.RedisTokenStore',
+            )
+        )
+
+    @property
+    def unavailable_errors(self) -> tuple[type[BaseException], ...]:
+        return self.store.unavailable_errors
+
+    def delete(self, *keys: str):
+        self.store.delete(*keys)
+        self._clear_caches(keys)
+
+    def get_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        (current, ttl), _ = self._get_pair(keys, None)
+        return current, ttl
+
+    def get_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        return self._get_pair(keys, None)
+
+    def get_pair_for(
+        self, keys: TokenKeys, token: str
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        return self._get_pair(keys, token)
+
+    def get_ring_current(self, keys: TokenKeys) -> tuple[Optional[str], float]:
+        return self.store.get_ring_current(keys)
+
+    def get_ring_token_ttl(self, keys: TokenKeys, token: str) -> Optional[float]:
+        return self.store.get_ring_token_ttl(keys, token)
+
+    def get_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        return self.store.get_with_ttl(key)
+
+    def poll_invalidation(self, channel: str, cache: ValidatedTokenCache) -> bool:
+        return self.store.poll_invalidation(channel, cache)
+
+    def publish_invalidation(self, channel: str, identity: Optional[str] = None):
+        self.store.publish_invalidation(channel, identity)
+
+    def rotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        result = self.store.rotate(keys, token, ttl, min_ttl)
+        self._clear_caches((keys.current,))
+        return result
+
+    def rotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        return self.store.rotate_ring(keys, token, ttl, min_ttl, size)
+
+    def set(self, key: str, token: str, ttl: float):
+        self.store.set(key, token, ttl)
+        self._clear_caches((key,))
+
+    async def aget_current(
+        self, keys: TokenKeys
+    ) -> tuple[Optional[str], float]:
+        (current, ttl), _ = await self._aget_pair(keys, None)
+        return current, ttl
+
+    async def aget_pair(
+        self, keys: TokenKeys
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        return await self._aget_pair(keys, None)
+
+    async def aget_pair_for(
+        self, keys: TokenKeys, token: str
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        return await self._aget_pair(keys, token)
+
+    async def aget_ring_current(
+        self, keys: TokenKeys
+    ) -> tuple[Optional[str], float]:
+        return await self.store.aget_ring_current(keys)
+
+    async def aget_ring_token_ttl(
+        self, keys: TokenKeys, token: str
+    ) -> Optional[float]:
+        return await self.store.aget_ring_token_ttl(keys, token)
+
+    async def aget_with_ttl(self, key: str) -> tuple[Optional[str], float]:
+        return await self.store.aget_with_ttl(key)
+
+    async def apoll_invalidation(
+        self, channel: str, cache: ValidatedTokenCache
+    ) -> bool:
+        return await self.store.apoll_invalidation(channel, cache)
+
+    async def arotate(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float
+    ) -> tuple[str, float]:
+        result = await self.store.arotate(keys, token, ttl, min_ttl)
+        self._clear_caches((keys.current,))
+        return result
+
+    async def arotate_ring(
+        self, keys: TokenKeys, token: str, ttl: float, min_ttl: float, size: int
+    ) -> tuple[str, float]:
+        return await self.store.arotate_ring(keys, token, ttl, min_ttl, size)
+
+    async def _aget_pair(
+        self, keys: TokenKeys, token: Optional[str]
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        if (cache := self._get_cache(keys)) is None:
+            return await self.store.aget_pair(keys)
+
+        now = time.time()
+        if self._is_usable(entry := cache.read(), token, now):
+            return self._to_pair(entry, now)
+
+        # Waiting for another process would block the event loop: read the
+        # other store instead if the refresh is already in progress.
+        with cache.lock(blocking=False) as locked:
+            now = time.time()
+            pair = await self.store.aget_pair(keys)
+            if locked:
+                self._write(cache, pair, now)
+        return pair
+
+    def _clear_caches(self, keys: tuple[str, ...]):
+        for cache_keys, cache in list(self._caches.items()):
+            if cache is None:
+                continue
+            if cache_keys.current in keys or cache_keys.obsolete in keys:
+                with cache.lock():
+                    cache.clear()
+
+    def _get_cache(self, keys: TokenKeys) -> Optional[SharedMemoryPairCache]:
+        """
+        Return the cache of `keys`, or `None` if its file cannot be used
+        """
+        if self._pid != os.getpid():
+            # `flock()` locks are shared with the parent through inherited
+            # descriptors: a forked process opens the files again.
+            with self._lock:
+                self._caches = {}
+                self._pid = os.getpid()
+
+        try:
+            return self._caches[keys]
+        except KeyError:
+            pass
+
+        digest = hashlib.sha256(keys.current.encode()).hexdigest()[:16]
+        with self._lock:
+            if keys in self._caches:
+                return self._caches[keys]
+            try:
+                path = os.path.join(_get_private_dir(self.directory), digest)
+                cache = SharedMemoryPairCache(path)
+            except OSError:
+                logger.warning(
+                    'Token pairs are not shared between processes',
+                    exc_info=True,
+                )
+                cache = None
+            self._caches[keys] = cache
+        return cache
+
+    def _get_pair(
+        self, keys: TokenKeys, token: Optional[str]
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        if (cache := self._get_cache(keys)) is None:
+            return self.store.get_pair(keys)
+
+        start = time.time()
+        if self._is_usable(entry := cache.read(), token, start):
+            return self._to_pair(entry, start)
+
+        with cache.lock():
+            # Another process may have refreshed the pair while this one was
+            # waiting for the lock.
+            now = time.time()
+            entry = cache.read()
+            if entry is not None and entry.refreshed_at >= start:
+                return self._to_pair(entry, now)
+
+            pair = self.store.get_pair(keys)
+            self._write(cache, pair, now)
+        return pair
+
+    @staticmethod
+    def _is_usable(
+        entry: Optional[SharedPair], token: Optional[str], now: float
+    ) -> bool:
+        if entry is None or entry.current_expires_at <= now:
+            return False
+        return token is None or token == entry.current or (
+            token == entry.obsolete and entry.obsolete_expires_at > now
+        )
+
+    @staticmethod
+    def _to_pair(
+        entry: SharedPair, now: float
+    ) -> tuple[tuple[Optional[str], float], tuple[Optional[str], float]]:
+        pair = []
+        for token, expires_at in (
+            (entry.current, entry.current_expires_at),
+            (entry.obsolete, entry.obsolete_expires_at),
+        ):
+            ttl = expires_at - now
+            pair.append((token, ttl) if token and ttl > 0 else (None, -2))
+        return tuple(pair)
+
+    @staticmethod
+    def _write(
+        cache: SharedMemoryPairCache,
+        pair: tuple[tuple[Optional[str], float], tuple[Optional[str], float]],
+        now: float,
+    ):
+        """
+        Cache `pair`, read from the other store at `now` (wall clock). Keys
+        without expiry are cached for `settings.TOKEN_TTL` seconds; tokens
+        which expired while being read are cached as expired.
+
+        The entry is marked as refreshed once `pair` has been read, so the
+        processes which have been waiting meanwhile reuse it.
+        """
+        (current, ttl), (obsolete, obsolete_ttl) = pair
+        cache.write(
+            current,
+            now + _get_cache_ttl(ttl),
+            obsolete,
+            now + _get_cache_ttl(obsolete_ttl),
+            time.time(),
+        )
+
+
+class StoreClient:
+    """
+    Read-only descriptor returning the redis client `name` (`client` or
+    `async_client`) of the token store of the owner class, e.g.
+    `ServiceAccountUser.redis_client` which was the redis client itself
+    before token stores.
+
+    Raise `AttributeError` if the token store is not backed by redis.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __get__(self, instance, owner) -> Any:
+        store = owner.token_store
+        if isinstance(store, SharedMemoryTokenStore):
+            store = store.store
+        if not isinstance(store, RedisTokenStore):
+            raise AttributeError(
+                f'`{type(store).__name__}` does not use a redis client'
+            )
+        return getattr(store, self._name)
+
+    def __set__(self, instance, value):
+        raise AttributeError(f'`{self._name}` cannot be set')
+
+
+def create_token_store() -> BaseTokenStore:
+    """
+    Return a new instance of the store class `settings.TOKEN_STORE`
+    """
+    return import_string(settings.TOKEN_STORE)()
+
+
+def uses_hash_tags() -> bool:
+    """
+    Return whether the store class `settings.TOKEN_STORE` (or the store it
+    wraps) needs hash-tagged keys
+    """
+    store_class = import_string(settings.TOKEN_STORE)
+    if issubclass(store_class, SharedMemoryTokenStore):
+        store_class = store_class.get_store_class()
+    return store_class.uses_hash_tags
+
+
+def _get_cache_ttl(ttl: float) -> float:
+    if ttl == -1:
+        return settings.TOKEN_TTL
+    return max(ttl, 0)
+
+
+def _get_private_dir(parent: str) -> str:
+    """
+    Return a directory of `parent` only accessible to the effective user,
+    creating it if needed.
+
+    Raise `PermissionError` if it exists but is not private, e.g. if another
+    user has created it beforehand.
+    """
+    path = os.path.join(parent, f'kobo-service-account-{os.geteuid()}')
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    # Not followed if it is a symbolic link
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f'`{path}` must be a directory')
+    check_private(st, path)
+    return path
+
+
+def _get_shared_memory_dir() -> str:
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _score_to_ttl(score: Optional[float]) -> Optional[float]:
+    """
+    Convert the score of a ring token (its expiry timestamp) to its time to
+    live, or `None` if it has expired
+    """
+    if score is None or (ttl := score - time.time()) <= 0:
+        return None
+    return ttl
+
+
+def _pttl_to_ttl(pttl: int) -> float:
+    # Negative values (-1, -2) have a special meaning, keep them.
+    return pttl / 1000 if pttl > 0 else pttl
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Optional
+
+import redis
+import redis.asyncio
+from django.utils.module_loading import import_string
+
+from .cache import ExpiringLRUCache
+from .config import get_compiled_settings
+from .exceptions import TokenStoreUnavailable
+from .models import ServiceAccountUser
+from .settings import service_account_settings as settings
+from .stats import redis_round_trips
+
+
+class LocalFailureLimiter:
+    """
+    Count failed authentications per source (see
+    `settings.FAILED_AUTHENTICATION_SOURCE`) in process memory.
+
+    A source which fails `settings.FAILED_AUTHENTICATION_LIMIT` times within
+    `settings.FAILED_AUTHENTICATION_PERIOD` seconds is blocked until the end
+    of the period. Blocked sources are kept in memory, so their requests are
+    rejected without querying the token store (nor redis).
+    """
+
+    # Number of sources tracked at once, least recently used first evicted
+    max_sources = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocked = ExpiringLRUCache()
+        self._failures = ExpiringLRUCache()
+
+    def get_retry_after(self, source: str) -> Optional[float]:
+        """
+        Return the number of seconds `source` is still blocked for, or `None`
+        if it is not blocked
+        """
+        if (blocked_until := self._blocked.get(source)) is None:
+            return None
+        return max(blocked_until - time.monotonic(), 0)
+
+    def record_failure(self, source: str):
+        self._block(source, *self._increment(source))
+
+    async def arecord_failure(self, source: str):
+        self._block(source, *await self._aincrement(source))
+
+    def _block(self, source: str, failures: int, ttl: float):
+        if failures >= settings.FAILED_AUTHENTICATION_LIMIT and ttl > 0:
+            now = time.monotonic()
+            self._blocked.set(source, now + ttl, ttl, self.max_sources, now)
+
+    async def _aincrement(self, source: str) -> tuple[int, float]:
+        return self._increment(source)
+
+    def _increment(self, source: str) -> tuple[int, float]:
+        """
+        Count one more failure of `source` in the current period.
+
+        Return the number of failures and the remaining time of the period
+        """
+        now = time.monotonic()
+        with self._lock:
+            failures, expires_at = self._failures.get(
+                source, (0, now + settings.FAILED_AUTHENTICATION_PERIOD)
+            )
+            failures += 1
+            self._failures.set(
+                source,
+                (failures, expires_at),
+                expires_at - now,
+                self.max_sources,
+                now,
+            )
+        return failures, expires_at - now
+
+
+class RedisFailureLimiter(LocalFailureLimiter):
+    """
+    Count failed authentications per source in redis, with the clients of
+    the token store (`ServiceAccountUser.redis_client`), so failures are
+    shared by all processes.
+
+    Only failures reach redis: blocked sources are still checked in process
+    memory. Failures are counted locally while redis is unavailable (or the
+    circuit breaker is open), and with stores which are not backed by redis.
+    """
+
+    def __init__(
+        self,
+        client: Optional[redis.Redis] = None,
+        async_client: Optional[redis.asyncio.Redis] = None,
+    ):
+        super().__init__()
+        self._client = client
+        self._async_client = async_client
+
+    @property
+    def async_client(self) -> Optional[redis.asyncio.Redis]:
+        """
+        `None` if the token store is not backed by redis
+        """
+        if self._async_client is not None:
+            return self._async_client
+        return getattr(ServiceAccountUser, 'async_redis_client', None)
+
+    @property
+    def client(self) -> Optional[redis.Redis]:
+        """
+        `None` if the token store is not backed by redis
+        """
+        if self._client is not None:
+            return self._client
+        return getattr(ServiceAccountUser, 'redis_client', None)
+
+    async def _aincrement(self, source: str) -> tuple[int, float]:
+        if (client := self.async_client) is None:
+            return await super()._aincrement(source)
+
+        try:
+            with self._guard():
+                p = self._increment_pipeline(client, source)
+                redis_round_trips.increment()
+                return self._parse_increment(await p.execute())
+        except (TokenStoreUnavailable, redis.RedisError):
+            return await super()._aincrement(source)
+
+    def _increment(self, source: str) -> tuple[int, float]:
+        if (client := self.client) is None:
+            return super()._increment(source)
+
+        try:
+            with self._guard():
+                p = self._increment_pipeline(client, source)
+                redis_round_trips.increment()
+                return self._parse_increment(p.execute())
+        except (TokenStoreUnavailable, redis.RedisError):
+            return super()._increment(source)
+
+    @staticmethod
+    def _guard():
+        # Connection errors and timeouts count as failures of the token
+        # store, whose clients are used.
+        return ServiceAccountUser.circuit_breaker.guard(
+            ServiceAccountUser.token_store.unavailable_errors
+        )
+
+    @staticmethod
+    def _increment_pipeline(redis_client, source: str):
+        prefix = get_compiled_settings().failed_authentications_key_prefix
+        key = f'{prefix}{source}'
+        period = int(settings.FAILED_AUTHENTICATION_PERIOD * 1000)
+        p = redis_client.pipeline(transaction=True)
+        # The period starts with the first failure.
+        p.set(key, 0, px=period, nx=True)
+        p.incr(key)
+        p.pttl(key)
+        return p
+
+    @staticmethod
+    def _parse_increment(results: list) -> tuple[int, float]:
+        _, failures, pttl = results
+        return failures, pttl / 1000
+
+
+def create_failure_limiter() -> LocalFailureLimiter:
+    """
+    Return a new instance of the class `settings.FAILED_AUTHENTICATION_LIMITER`
+    """
+    return import_string(settings.FAILED_AUTHENTICATION_LIMITER)()
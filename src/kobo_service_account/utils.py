@@ -1,16 +1,119 @@
 from __future__ import annotations
 
-from typing import Union
+import copy
+import time
+from typing import Any, Iterable, Iterator, Optional, Union
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save
 from django.http import HttpRequest
+from django.utils.functional import LazyObject, SimpleLazyObject, empty
 from rest_framework.request import Request
 
 from .authentication import ServiceAccountAuthentication
+from .cache import ExpiringLRUCache, LocalTokenCache
+from .config import get_compiled_settings
 from .exceptions import MissingHeaderError
+from .metrics import REAL_USER_LOOKUPS, get_metrics_sink
 from .models import ServiceAccountUser
 from .settings import service_account_settings as settings
 
+real_user_cache = ExpiringLRUCache()
+
+
+class RequestHeadersFactory:
+    """
+    Reusable generator of the headers returned by `get_request_headers()`, to
+    send many requests on behalf of different users.
+
+    The token is fetched (or rotated) only when the one in use is about to
+    expire, and the "Authorization" value is built once per token. Each header
+    dict is therefore generated with a token which is still valid for at
+    least `settings.TOKEN_TTL_EXPIRY_THRESHOLD` seconds, however long the
+    batch takes.
+
+    Tokens belong to `identity` (default to `settings.SERVICE_IDENTITY`).
+    """
+
+    def __init__(self, identity: Optional[str] = None):
+        self._identity = identity
+        self._token_cache = LocalTokenCache()
+        self._authorization = None
+
+    def __call__(self, username: str) -> dict:
+        return {
+            'Authorization': self._get_authorization(),
+            get_compiled_settings().on_behalf_header: username,
+        }
+
+    def many(self, usernames: Iterable[str]) -> Iterator[dict]:
+        """
+        Lazily yield the headers of each user of `usernames`
+        """
+        on_behalf_header = get_compiled_settings().on_behalf_header
+        for username in usernames:
+            yield {
+                'Authorization': self._get_authorization(),
+                on_behalf_header: username,
+            }
+
+    def _get_authorization(self) -> str:
+        identity = self._identity or settings.SERVICE_IDENTITY
+        threshold = ServiceAccountUser.get_identity_setting(
+            identity, 'TOKEN_TTL_EXPIRY_THRESHOLD'
+        )
+        if self._token_cache.get(threshold):
+            return self._authorization
+
+        now = time.monotonic()
+        token, ttl = ServiceAccountUser.get_or_create_authentication_token_with_ttl(
+            identity=identity
+        )
+        self._authorization = f'{ServiceAccountAuthentication.keyword} {token}'
+        self._token_cache.set(token, ttl, now)
+        return self._authorization
+
+
+class LazyRealUser(SimpleLazyObject):
+    """
+    `request.real_user`, set by `RealUserMiddleware`: the user returned by
+    `get_real_user()`, resolved on first access.
+
+    It is resolved again if `request.user` has changed since, e.g. if it was
+    accessed before DRF authenticated the service account.
+    """
+
+    def __init__(self, request: HttpRequest):
+        # Set in `__dict__`: `LazyObject` forwards other attributes
+        self.__dict__['_request'] = request
+        self.__dict__['_resolved_for'] = None
+        super().__init__(self._resolve)
+
+    @property
+    def _wrapped(self) -> Any:
+        wrapped = self.__dict__['_wrapped']
+        if (
+            wrapped is not empty
+            and self.__dict__['_resolved_for']
+            is not getattr(self.__dict__['_request'], 'user', None)
+        ):
+            # Resolved for another user: `LazyObject` resolves it again.
+            return empty
+        return wrapped
+
+    def _get_user(self) -> 'settings.AUTH_USER_MODEL':
+        if (wrapped := self._wrapped) is empty:
+            self._setup()
+            wrapped = self._wrapped
+        return wrapped
+
+    def _resolve(self) -> 'settings.AUTH_USER_MODEL':
+        request = self.__dict__['_request']
+        self.__dict__['_resolved_for'] = getattr(request, 'user', None)
+        return _lookup_real_user(request)
+
 
 def get_real_user(request: Union[Request, HttpRequest]) -> 'settings.AUTH_USER_MODEL':
     """
@@ -19,32 +122,146 @@ def get_real_user(request: Union[Request, HttpRequest]) -> 'settings.AUTH_USER_M
     user from the username passed in the request headers with authentication
     token.
     Otherwise, return `request.user` itself.
+
+    When `settings.REAL_USER_CACHE_SIZE` is set, users are cached across
+    requests until they are saved or deleted. Within a request, the user
+    is resolved once by `RealUserMiddleware` if it is installed.
+    """
+    if not isinstance(request.user, ServiceAccountUser):
+        return request.user
+
+    if (real_user := _get_lazy_real_user(request)) is not None:
+        # Each caller gets its own copy
+        return copy.copy(real_user._get_user())
+
+    return _lookup_real_user(request)
+
+
+def _lookup_real_user(
+    request: Union[Request, HttpRequest]
+) -> 'settings.AUTH_USER_MODEL':
+    """
+    Resolve the user returned by `get_real_user()`, without `request.real_user`
     """
     if not isinstance(request.user, ServiceAccountUser):
         return request.user
 
+    username = get_real_username(request)
+
+    if settings.REAL_USER_CACHE_SIZE <= 0:
+        get_metrics_sink().increment(REAL_USER_LOOKUPS, tags={'source': 'db'})
+        return _get_real_user_queryset().get(username=username)
+
+    if (user := real_user_cache.get(username)) is None:
+        _connect_real_user_cache_signals()
+        get_metrics_sink().increment(REAL_USER_LOOKUPS, tags={'source': 'db'})
+        now = time.monotonic()
+        user = _get_real_user_queryset().get(username=username)
+        real_user_cache.set(
+            username,
+            user,
+            settings.REAL_USER_CACHE_TTL,
+            settings.REAL_USER_CACHE_SIZE,
+            now,
+        )
+
+    else:
+        get_metrics_sink().increment(REAL_USER_LOOKUPS, tags={'source': 'cache'})
+
+    # Each caller gets its own copy, which can be modified without altering
+    # the cached one.
+    return copy.copy(user)
+
+
+def get_real_user_id(request: Union[Request, HttpRequest]) -> Any:
+    """
+    Return the primary key of the user returned by `get_real_user()`.
+
+    Without `RealUserMiddleware`, the user row is not loaded if the user is
+    not cached, only its primary key.
+    """
+    if not isinstance(request.user, ServiceAccountUser):
+        return request.user.pk
+
+    if (real_user := _get_lazy_real_user(request)) is not None:
+        return real_user._get_user().pk
+
+    username = get_real_username(request)
+    if settings.REAL_USER_CACHE_SIZE > 0:
+        if (user := real_user_cache.get(username)) is not None:
+            return user.pk
+
+    get_metrics_sink().increment(REAL_USER_LOOKUPS, tags={'source': 'db'})
+    return (
+        get_user_model()
+        .objects.filter(username=username)
+        .values_list('pk', flat=True)
+        .get()
+    )
+
+
+def get_real_username(request: Union[Request, HttpRequest]) -> str:
+    """
+    Return the username of the user returned by `get_real_user()`, without
+    any query: it is read from the headers of service account requests.
+    """
+    if not isinstance(request.user, ServiceAccountUser):
+        return request.user.get_username()
+
     try:
-        username = request.headers[settings.ON_BEHALF_HEADER]
+        # `request.headers` would copy all headers of `request.META` first
+        return request.META[get_compiled_settings().on_behalf_meta_key]
     except KeyError:
         raise MissingHeaderError
 
-    return get_user_model().objects.get(username=username)
-
 
-def get_request_headers(username: str) -> dict:
+def get_request_headers(username: str, identity: Optional[str] = None) -> dict:
     """
     Return a dict to insert in headers to authenticate proxied requests with
-    Python apps
+    Python apps, with a token of `identity` (default to
+    `settings.SERVICE_IDENTITY`)
     """
-    headers = {}
-    token = ServiceAccountUser.get_or_create_authentication_token()
-    headers['Authorization'] = (
-        f'{ServiceAccountAuthentication.keyword} '
-        f'{token}'
-    )
-    headers[settings.ON_BEHALF_HEADER] = username
+    token = ServiceAccountUser.get_or_create_authentication_token(identity)
+    return _build_request_headers(token, username)
 
-    return headers
+
+def get_request_headers_many(
+    usernames: Iterable[str], identity: Optional[str] = None
+) -> Iterator[dict]:
+    """
+    Lazily yield the headers returned by `get_request_headers()` for each user
+    of `usernames`, e.g. for batch jobs.
+
+    See `RequestHeadersFactory`.
+    """
+    return RequestHeadersFactory(identity).many(usernames)
+
+
+async def aget_real_user(
+    request: Union[Request, HttpRequest]
+) -> 'settings.AUTH_USER_MODEL':
+    """
+    Async counterpart of `get_real_user()`
+    """
+    if not isinstance(request.user, ServiceAccountUser):
+        return request.user
+
+    if (user := _get_resolved_real_user(request)) is not None:
+        return copy.copy(user)
+
+    return await sync_to_async(get_real_user)(request)
+
+
+async def aget_request_headers(
+    username: str, identity: Optional[str] = None
+) -> dict:
+    """
+    Async counterpart of `get_request_headers()`, e.g. for `httpx.AsyncClient`
+    """
+    token = await ServiceAccountUser.aget_or_create_authentication_token(
+        identity
+    )
+    return _build_request_headers(token, username)
 
 
 def reversion_monkey_patch():
@@ -53,6 +270,8 @@ def reversion_monkey_patch():
     do not have any representation in the DB, therefore Reversion is not able
     to insert data in DB. This patch fixes it by returning the user for whom
     the sysadmin is making the request.
+
+    With `RealUserMiddleware`, the user resolved for the request is reused.
     """
     try:
         import reversion
@@ -69,6 +288,68 @@ def reversion_monkey_patch():
                 and request.user.is_authenticated
                 and get_user() is None
             ):
-                set_user(get_real_user(request))
+                real_user = getattr(request, 'real_user', None)
+                set_user(real_user or get_real_user(request))
 
         reversion.views._set_user_from_request = _set_user_from_request_patch
+
+
+def _connect_real_user_cache_signals():
+    user_model = get_user_model()
+    for signal in (post_save, post_delete):
+        signal.connect(
+            _invalidate_real_user_cache,
+            sender=user_model,
+            dispatch_uid='kobo_service_account_real_user_cache',
+        )
+
+
+def _get_lazy_real_user(
+    request: Union[Request, HttpRequest]
+) -> Optional[LazyRealUser]:
+    """
+    Return `request.real_user` if it is set by `RealUserMiddleware`
+    """
+    real_user = getattr(request, 'real_user', None)
+    return real_user if isinstance(real_user, LazyRealUser) else None
+
+
+def _get_resolved_real_user(
+    request: Union[Request, HttpRequest]
+) -> Optional['settings.AUTH_USER_MODEL']:
+    """
+    Return `request.real_user` if `RealUserMiddleware` already resolved it
+    (for the current `request.user`)
+    """
+    real_user = getattr(request, 'real_user', None)
+    if isinstance(real_user, LazyObject):
+        # Only read the wrapped object, never trigger the resolution
+        real_user = real_user._wrapped
+        return None if real_user is empty else real_user
+    return real_user
+
+
+def _get_real_user_queryset() -> QuerySet:
+    queryset = get_user_model().objects.all()
+    if settings.REAL_USER_SELECT_RELATED:
+        queryset = queryset.select_related(*settings.REAL_USER_SELECT_RELATED)
+    if settings.REAL_USER_FIELDS:
+        queryset = queryset.only(*settings.REAL_USER_FIELDS)
+    return queryset
+
+
+def _invalidate_real_user_cache(sender, instance, **kwargs):
+    # Username may have been changed, look up cached users by primary key too.
+    real_user_cache.discard(instance.get_username())
+    real_user_cache.discard_where(lambda user: user.pk == instance.pk)
+
+
+def _build_request_headers(token: str, username: str) -> dict:
+    headers = {}
+    headers['Authorization'] = (
+        f'{ServiceAccountAuthentication.keyword} '
+        f'{token}'
+    )
+    headers[get_compiled_settings().on_behalf_header] = username
+
+    return headers
@@ -0,0 +1,143 @@
+import asyncio
+from contextlib import contextmanager
+
+import pytest
+
+from kobo_service_account.authentication import ServiceAccountAuthentication
+from kobo_service_account.models import ServiceAccountUser
+from kobo_service_account.settings import service_account_settings
+
+
+def _is_authorized(headers) -> bool:
+    keyword, _, token = headers['Authorization'].partition(' ')
+    return (
+        keyword == ServiceAccountAuthentication.keyword
+        and headers[service_account_settings.ON_BEHALF_HEADER] == 'someuser'
+        and ServiceAccountUser.has_valid_authentication_token(token)
+    )
+
+
+def _drop_stored_tokens():
+    """
+    Simulate a token which is still cached locally but has been dropped from
+    the token store (e.g. rotated twice while the sender was idle)
+    """
+    ServiceAccountUser.get_or_create_authentication_token()
+    keys = ServiceAccountUser.token_keys
+    ServiceAccountUser.token_store.delete(keys.current, keys.obsolete)
+    ServiceAccountUser.validated_tokens.clear()
+
+
+@contextmanager
+def _reject_all_tokens():
+    """
+    Simulate a receiver which rejects the tokens of the token store
+    """
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(
+            ServiceAccountUser,
+            'has_valid_authentication_token',
+            classmethod(lambda cls, token: False),
+        )
+        yield
+
+
+def test_requests_auth():
+    """
+    Test if `requests` calls are authenticated, and replayed once with a fresh
+    token when the receiver rejects the cached one
+    """
+    pytest.importorskip('requests')
+    import requests
+    from requests.adapters import BaseAdapter
+
+    from kobo_service_account.requests_auth import get_session
+
+    class FakeAdapter(BaseAdapter):
+        calls = 0
+
+        def send(self, request, **kwargs):
+            self.calls += 1
+            response = requests.Response()
+            response.status_code = 200 if _is_authorized(request.headers) else 401
+            response.request = request
+            response.connection = self
+            response.raw = None
+            return response
+
+        def close(self):
+            pass
+
+    session = get_session('someuser')
+    adapter = FakeAdapter()
+    session.mount('http://', adapter)
+
+    response = session.get('http://kobo.test/')
+    assert response.status_code == 200
+    assert (adapter.calls, response.history) == (1, [])
+
+    _drop_stored_tokens()
+    response = session.post('http://kobo.test/', data=b'data')
+    assert response.status_code == 200
+    assert adapter.calls == 3
+    assert [r.status_code for r in response.history] == [401]
+
+    # No replay while the store still holds the rejected token
+    with _reject_all_tokens():
+        response = session.get('http://kobo.test/')
+    assert response.status_code == 401
+    assert (adapter.calls, response.history) == (4, [])
+
+    # Only one replay
+    with _reject_all_tokens():
+        _drop_stored_tokens()
+        response = session.get('http://kobo.test/')
+    assert response.status_code == 401
+    assert adapter.calls == 6
+
+
+def test_httpx_auth():
+    """
+    Test if sync and async `httpx` calls are authenticated, and replayed once
+    with a fresh token when the receiver rejects the cached one
+    """
+    pytest.importorskip('httpx')
+    import httpx
+
+    from kobo_service_account.httpx_auth import get_async_client, get_client
+
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200 if _is_authorized(request.headers) else 401)
+
+    client = get_client('someuser', transport=httpx.MockTransport(handler))
+    assert client.get('http://kobo.test/').status_code == 200
+    assert len(calls) == 1
+
+    _drop_stored_tokens()
+    response = client.post('http://kobo.test/', content=b'data')
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert calls[-1].content == b'data'
+    assert [r.status_code for r in response.history] == [401]
+
+    async def _request():
+        async with get_async_client(
+            'someuser', transport=httpx.MockTransport(handler)
+        ) as async_client:
+            return await async_client.get('http://kobo.test/')
+
+    _drop_stored_tokens()
+    response = asyncio.run(_request())
+    assert response.status_code == 200
+    assert len(calls) == 5
+
+    # No replay while the store still holds the rejected token
+    with _reject_all_tokens():
+        response = client.get('http://kobo.test/')
+        assert response.status_code == 401
+        assert len(calls) == 6
+        assert asyncio.run(_request()).status_code == 401
+        assert len(calls) == 7
@@ -1,19 +1,71 @@
+import asyncio
+import itertools
+import multiprocessing
 import re
+import socket
+import threading
 import time
+from types import SimpleNamespace
 
 import fakeredis
 import pytest
+import redis
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_migrate
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory
 from django.test.utils import override_settings as dj_override_settings
 from mock import patch
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+)
+from rest_framework.exceptions import AuthenticationFailed, Throttled
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.response import Response
 
 from kobo_service_account.authentication import ServiceAccountAuthentication
-from kobo_service_account.exceptions import HostNotAllowedException
+from kobo_service_account.config import get_compiled_settings, get_host_policy
+from kobo_service_account.connection import get_pool_stats
+from kobo_service_account.exceptions import (
+    HostNotAllowedException,
+    TokenStoreUnavailable,
+)
+from kobo_service_account.hosts import HostPolicy
+from kobo_service_account.metrics import get_metrics_sink
+from kobo_service_account.middleware import (
+    RealUserMiddleware,
+    ServiceAccountAuthenticationMiddleware,
+)
 from kobo_service_account.models import ServiceAccountUser
+from kobo_service_account.refresher import (
+    AsyncTokenRefresher,
+    start_token_refresher,
+    stop_token_refresher,
+)
 from kobo_service_account.settings import DEFAULTS, service_account_settings
-from kobo_service_account.utils import get_real_user, get_request_headers
+from kobo_service_account.stats import redis_round_trips
+from kobo_service_account.stores import InMemoryTokenStore
+from kobo_service_account.throttling import RedisFailureLimiter
+from kobo_service_account.utils import (
+    RequestHeadersFactory,
+    aget_real_user,
+    aget_request_headers,
+    get_real_user,
+    get_real_user_id,
+    get_real_username,
+    get_request_headers,
+    get_request_headers_many,
+)
 
 
 class FakeRequest:
@@ -78,7 +130,7 @@ def test_settings():
             == DEFAULTS['ON_BEHALF_HEADER']
     )
 
-    # Three values are overridden in pytest
+    # Four values are overridden in pytest
     # Django settings
     assert (
         settings.SERVICE_ACCOUNT['TOKEN_TTL']
@@ -108,8 +160,83 @@ def test_settings():
     )
 
 
-@patch('kobo_service_account.models.ServiceAccountUser.redis_client',
-       fakeredis.FakeStrictRedis())
+def test_compiled_settings(override_settings):
+    """
+    Test if derived values are compiled once, and compiled again when
+    settings change
+    """
+    compiled = get_compiled_settings()
+    assert get_compiled_settings() is compiled
+    assert ServiceAccountUser.redis_key == compiled.token_keys.current
+    with pytest.raises(AttributeError):
+        compiled.on_behalf_header = 'Other-Header'
+
+    token_store = ServiceAccountUser.token_store
+    with dj_override_settings(SERVICE_ACCOUNT={
+        **settings.SERVICE_ACCOUNT,
+        'NAMESPACE': 'other-namespace',
+        'ON_BEHALF_HEADER': 'Other-Header',
+        'WHITELISTED_HOSTS': ['.example.com'],
+    }):
+        assert ServiceAccountUser.redis_key.startswith('other-namespace::')
+        assert ServiceAccountUser.token_store is not token_store
+        assert get_host_policy().is_allowed('api.example.com')
+        assert 'Other-Header' in get_request_headers('foo')
+        request = FakeRequest(with_auth=True, username='foo')
+        assert get_real_username(request) == 'foo'
+
+    assert get_compiled_settings().token_keys == compiled.token_keys
+    assert get_host_policy() is None
+
+    override_settings(NAMESPACE='fixture-namespace')
+    assert ServiceAccountUser.redis_key.startswith('fixture-namespace::')
+
+
+def test_redis_client(override_settings):
+    """
+    Test if the redis client is created lazily, once per process, with the
+    connection pool options from the settings
+    """
+    override_settings(TOKEN_STORE=DEFAULTS['TOKEN_STORE'], BACKEND={
+        'LOCATION': 'redis://localhost:6379/1',
+        'OPTIONS': {
+            'SOCKET_TIMEOUT': 0.5,
+            'CONNECTION_POOL_CLASS': 'redis.BlockingConnectionPool',
+            'CONNECTION_POOL_KWARGS': {
+                'max_connections': 5,
+                'connection_class': fakeredis.FakeConnection,
+                'server': fakeredis.FakeServer(),
+            },
+        },
+    })
+    descriptor = vars(ServiceAccountUser)['token_store']
+    descriptor.reset()
+    try:
+        redis_client = ServiceAccountUser.token_store.client
+        assert ServiceAccountUser.token_store.client is redis_client
+        pool = redis_client.connection_pool
+        assert isinstance(pool, redis.BlockingConnectionPool)
+        assert pool.max_connections == 5
+        assert pool.connection_kwargs['socket_timeout'] == 0.5
+        assert (
+            pool.connection_kwargs['socket_connect_timeout']
+            == DEFAULTS['TOKEN_STORE_TIMEOUT']
+        )
+        assert pool.connection_kwargs['db'] == 1
+
+        redis_client.set('foo', 'bar')
+        stats = get_pool_stats()
+        assert stats['in_use'] == 0
+        assert stats['idle'] == 1
+        assert stats['wait_count'] == 1
+
+        # A forked process gets its own client
+        with patch('os.getpid', return_value=-1):
+            assert ServiceAccountUser.token_store.client is not redis_client
+    finally:
+        descriptor.reset()
+
+
 def test_get_existing_authentication_token():
     """
     Test if a new token is not created if the current is still valid
@@ -117,14 +244,12 @@ def test_get_existing_authentication_token():
     service_account_user = ServiceAccountUser()
     auth_token = 'my-authentication-token'
     ttl = settings.SERVICE_ACCOUNT['TOKEN_TTL']
-    redis_client = service_account_user.redis_client
-    assert redis_client.get(ServiceAccountUser.redis_key) is None
-    redis_client.setex(ServiceAccountUser.redis_key, ttl, auth_token)
+    token_store = service_account_user.token_store
+    assert token_store.get(ServiceAccountUser.redis_key) is None
+    token_store.set(ServiceAccountUser.redis_key, auth_token, ttl)
     assert service_account_user.get_or_create_authentication_token() == auth_token
 
 
-@patch('kobo_service_account.models.ServiceAccountUser.redis_client',
-       fakeredis.FakeStrictRedis())
 def test_token_rotation():
     """
     Test if a token is regenerated if the current one is about to expire,
@@ -133,25 +258,386 @@ def test_token_rotation():
     service_account_user = ServiceAccountUser()
     ttl = settings.SERVICE_ACCOUNT['TOKEN_TTL']
     threshold = settings.SERVICE_ACCOUNT['TOKEN_TTL_EXPIRY_THRESHOLD']
-    redis_client = service_account_user.redis_client
+    token_store = service_account_user.token_store
 
-    assert redis_client.get(ServiceAccountUser.redis_key) is None
+    assert token_store.get(ServiceAccountUser.redis_key) is None
     auth_token = service_account_user.get_or_create_authentication_token()
 
-    assert redis_client.get(ServiceAccountUser.redis_obsolete_key) is None
+    assert token_store.get(ServiceAccountUser.redis_obsolete_key) is None
     time.sleep(ttl - threshold + 0.5)  # Wait for token expiry
     new_token = service_account_user.get_or_create_authentication_token()
-    obsolete_token = redis_client.get(ServiceAccountUser.redis_obsolete_key).decode()
+    obsolete_token = token_store.get(ServiceAccountUser.redis_obsolete_key)
     assert new_token != auth_token
     assert obsolete_token == auth_token
 
     # validate obsolete_token is valid and ttl is below threshold
     assert service_account_user.has_valid_authentication_token(obsolete_token)
-    assert redis_client.ttl(ServiceAccountUser.redis_obsolete_key) <= threshold
+    assert token_store.ttl(ServiceAccountUser.redis_obsolete_key) <= threshold
+
+
+def test_token_rotation_stampede(override_settings):
+    """
+    Test if only one process rotates the token when many processes find it
+    about to expire at the same time, and if no tokens are lost.
+    """
+    server = fakeredis.TcpFakeServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    override_settings(
+        TOKEN_STORE=DEFAULTS['TOKEN_STORE'],
+        # The fake server is much slower than redis under contention
+        BACKEND={
+            'LOCATION': f'redis://{host}:{port}/0',
+            'OPTIONS': {'SOCKET_TIMEOUT': 10, 'SOCKET_CONNECT_TIMEOUT': 10},
+        },
+        LOCAL_TOKEN_CACHE=False,
+        VALIDATED_TOKEN_CACHE_SIZE=0,
+        # Leave enough time to start all processes before the token expires
+        TOKEN_TTL=30,
+        TOKEN_TTL_EXPIRY_THRESHOLD=20,
+    )
+    descriptor = vars(ServiceAccountUser)['token_store']
+    descriptor.reset()
+    processes_count = 8
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(processes_count)
+    results = ctx.Queue()
+
+    def _get_token():
+        barrier.wait()
+        results.put(ServiceAccountUser.get_or_create_authentication_token())
+
+    try:
+        token_store = ServiceAccountUser.token_store
+        token_store.set(ServiceAccountUser.redis_key, 'old-token', 10)
+        processes = [ctx.Process(target=_get_token) for _ in range(processes_count)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=10)
+        tokens = {results.get(timeout=1) for _ in range(processes_count)}
+
+        # Everybody got the token of the winner, the previous one is obsolete
+        assert len(tokens) == 1
+        assert token_store.get(ServiceAccountUser.redis_obsolete_key) == 'old-token'
+        assert ServiceAccountUser.has_valid_authentication_token(tokens.pop())
+        assert ServiceAccountUser.has_valid_authentication_token('old-token')
+    finally:
+        descriptor.reset()
+        server.shutdown()
+        server.server_close()
+
+
+def test_local_token_cache():
+    """
+    Test if the token is served from process memory until it is about to
+    expire
+    """
+    ttl = settings.SERVICE_ACCOUNT['TOKEN_TTL']
+    threshold = settings.SERVICE_ACCOUNT['TOKEN_TTL_EXPIRY_THRESHOLD']
+    token_store = ServiceAccountUser.token_store
+    auth_token = ServiceAccountUser.get_or_create_authentication_token()
+
+    # Token store is not queried as long as the cached token is valid
+    token_store.delete(ServiceAccountUser.redis_key)
+    assert ServiceAccountUser.get_or_create_authentication_token() == auth_token
+
+    time.sleep(ttl - threshold + 0.5)  # Wait for token expiry
+    new_token = ServiceAccountUser.get_or_create_authentication_token()
+    assert new_token != auth_token
+    assert token_store.get(ServiceAccountUser.redis_key) == new_token
+
+
+def test_local_token_cache_disabled(override_settings):
+    """
+    Test if the token store is queried on every call when the local cache
+    is disabled
+    """
+    override_settings(LOCAL_TOKEN_CACHE=False)
+    ServiceAccountUser.get_or_create_authentication_token()
+    ServiceAccountUser.token_store.set(ServiceAccountUser.redis_key, 'new-token', 10)
+    assert ServiceAccountUser.get_or_create_authentication_token() == 'new-token'
+
+
+def test_token_refresher(override_settings):
+    """
+    Test if the token is rotated in the background before the foreground
+    calls need to rotate it
+    """
+    override_settings(TOKEN_REFRESH_MARGIN=0.5)
+    threshold = settings.SERVICE_ACCOUNT['TOKEN_TTL_EXPIRY_THRESHOLD']
+    token_store = ServiceAccountUser.token_store
+    refresher = start_token_refresher()
+    try:
+        assert refresher.is_running
+        auth_token = ServiceAccountUser.get_or_create_authentication_token()
+        time.sleep(1)  # Wait for rotation in background
+        token, ttl = ServiceAccountUser.token_cache.get_with_ttl(threshold)
+        assert token != auth_token
+        assert token_store.get(ServiceAccountUser.redis_obsolete_key) == auth_token
+        assert ServiceAccountUser.get_or_create_authentication_token() == token
+    finally:
+        stop_token_refresher()
+    assert not refresher.is_running
+
+
+def test_token_refresher_default_margin():
+    """
+    Test if the refresher refuses to start when tokens would be refreshed as
+    soon as they are created
+    """
+    # TOKEN_TTL_EXPIRY_THRESHOLD + default TOKEN_REFRESH_MARGIN == TOKEN_TTL
+    assert service_account_settings.TOKEN_REFRESH_MARGIN == 1
+    with pytest.raises(ImproperlyConfigured):
+        start_token_refresher()
+    with pytest.raises(ImproperlyConfigured):
+        AsyncTokenRefresher().start()
+
+
+def test_async_token_refresher(redis_store, override_settings):
+    """
+    Test if the token is rotated in the background by an asyncio task
+    """
+    override_settings(TOKEN_REFRESH_MARGIN=0.5)
+    threshold = settings.SERVICE_ACCOUNT['TOKEN_TTL_EXPIRY_THRESHOLD']
+
+    async def _test():
+        refresher = AsyncTokenRefresher()
+        refresher.start()
+        await asyncio.sleep(0.1)
+        auth_token = ServiceAccountUser.token_cache.get(threshold)
+        assert auth_token
+        await asyncio.sleep(1)  # Wait for rotation in background
+        assert ServiceAccountUser.token_cache.get(threshold) != auth_token
+        await refresher.stop()
+        assert not refresher.is_running
+
+    asyncio.run(_test())
+
+
+@pytest.mark.parametrize('store', ['memory', 'redis'])
+def test_validated_token_cache(store, request):
+    """
+    Test if an accepted token is validated from memory until the token is
+    rotated
+    """
+    if store == 'redis':
+        request.getfixturevalue('redis_store')
+    token_store = ServiceAccountUser.token_store
+    auth_token = ServiceAccountUser.get_or_create_authentication_token()
+    assert ServiceAccountUser.has_valid_authentication_token(auth_token)
+
+    # Token store is not queried anymore for this token
+    token_store.delete(ServiceAccountUser.redis_key)
+    assert ServiceAccountUser.has_valid_authentication_token(auth_token)
+    assert not ServiceAccountUser.has_valid_authentication_token('wrong-token')
+
+    # Rotation (from any process) drops cached tokens
+    token_store.set(ServiceAccountUser.redis_key, auth_token, 1)
+    ServiceAccountUser.token_cache.clear()
+    new_token = ServiceAccountUser.get_or_create_authentication_token()
+    token_store.delete(ServiceAccountUser.redis_obsolete_key)
+    assert not ServiceAccountUser.has_valid_authentication_token(auth_token)
+    assert ServiceAccountUser.has_valid_authentication_token(new_token)
+
+
+def test_token_expired_during_validation(redis_store):
+    """
+    Test if a token which expires between the read of its value and of its
+    TTL is rejected, instead of being accepted for a whole `TOKEN_TTL`
+    """
+    auth_token = ServiceAccountUser.get_or_create_authentication_token()
+    # GET returned the token, then PTTL found no key anymore (-2)
+    with patch.object(
+        redis_store, 'get_pair_for', return_value=((auth_token, -2), (None, -2))
+    ):
+        assert not ServiceAccountUser.has_valid_authentication_token(auth_token)
+    assert auth_token not in ServiceAccountUser.validated_tokens
+
+    # Keys without expiry (-1) still get the default TTL
+    with patch.object(
+        redis_store, 'get_pair_for', return_value=((auth_token, -1), (None, -2))
+    ):
+        ServiceAccountUser.validated_tokens.clear()
+        assert ServiceAccountUser.has_valid_authentication_token(auth_token)
+    assert auth_token in ServiceAccountUser.validated_tokens
+
+
+def test_redis_client_compatibility(redis_store):
+    """
+    Test if the redis clients of the token store are still exposed, read-only
+    """
+    assert ServiceAccountUser.redis_client is redis_store.client
+    assert ServiceAccountUser.async_redis_client is redis_store.async_client
+    with pytest.raises(AttributeError):
+        ServiceAccountUser().redis_client = redis_store.client
+
+    with patch.object(ServiceAccountUser, 'token_store', InMemoryTokenStore()):
+        with pytest.raises(AttributeError):
+            ServiceAccountUser.redis_client
+
+
+def test_validation_round_trips(redis_store, override_settings):
+    """
+    Test if validating a token costs exactly one round-trip to redis, even
+    with the obsolete token
+    """
+    override_settings(VALIDATED_TOKEN_CACHE_SIZE=0)
+    redis_store.set(ServiceAccountUser.redis_key, 'current-token', 10)
+    redis_store.set(ServiceAccountUser.redis_obsolete_key, 'obsolete-token', 1)
+
+    for token in ['current-token', 'obsolete-token', 'wrong-token']:
+        redis_round_trips.reset()
+        ServiceAccountUser.has_valid_authentication_token(token)
+        assert redis_round_trips.count == 1
+
+    # Key names are shared with older versions
+    namespace = DEFAULTS['NAMESPACE']
+    assert ServiceAccountUser.redis_key == (
+        f'{namespace}::authentication_key::current'
+    )
+    assert ServiceAccountUser.redis_obsolete_key == (
+        f'{namespace}::authentication_key::obsolete'
+    )
+
+    # Both keys share the same Redis Cluster hash slot
+    override_settings(
+        TOKEN_STORE='kobo_service_account.stores.RedisClusterTokenStore'
+    )
+    hash_tag = re.compile(r'^{[^}]+}')
+    assert (
+        hash_tag.match(ServiceAccountUser.redis_key).group()
+        == hash_tag.match(ServiceAccountUser.redis_obsolete_key).group()
+    )
+
+
+def test_rejected_token_cache(redis_store, override_settings):
+    """
+    Test if a rejected token is rejected from memory until the token is
+    rotated, without evicting accepted tokens
+    """
+    override_settings(REJECTED_TOKEN_CACHE_SIZE=2)
+    redis_store.set(ServiceAccountUser.redis_key, 'current-token', 10)
+    assert ServiceAccountUser.has_valid_authentication_token('current-token')
+
+    redis_round_trips.reset()
+    for _ in range(3):
+        assert not ServiceAccountUser.has_valid_authentication_token('wrong-token')
+    assert redis_round_trips.count == 1
+
+    for i in range(3):
+        ServiceAccountUser.has_valid_authentication_token(f'wrong-token-{i}')
+    redis_round_trips.reset()
+    assert ServiceAccountUser.has_valid_authentication_token('current-token')
+    assert redis_round_trips.count == 0
+
+    redis_store.rotate(ServiceAccountUser.token_keys, 'wrong-token-2', 10, 11)
+    assert ServiceAccountUser.has_valid_authentication_token('wrong-token-2')
+
+
+def test_failed_authentication_limit(override_settings):
+    """
+    Test if a source is throttled after too many invalid tokens, before its
+    tokens are validated, and if failures can be shared with redis
+    """
+    override_settings(FAILED_AUTHENTICATION_LIMIT=2)
+    auth_class = ServiceAccountAuthentication()
+    headers = get_request_headers('foo')
+
+    def _get_request(wrong_auth=False, source='10.0.0.1'):
+        request_headers = dict(headers)
+        if wrong_auth:
+            request_headers['Authorization'] += '-wrong-auth'
+        return RequestFactory().get(
+            '/', headers=request_headers, REMOTE_ADDR=source
+        )
+
+    for _ in range(2):
+        with pytest.raises(AuthenticationFailed):
+            auth_class.authenticate(_get_request(wrong_auth=True))
+
+    with pytest.raises(Throttled) as e:
+        auth_class.authenticate(_get_request())
+    assert e.value.wait == 60
+    assert auth_class.authenticate(_get_request(source='10.0.0.2'))
+
+    response = ServiceAccountAuthenticationMiddleware(HttpResponse)(_get_request())
+    assert response.status_code == 429
+    assert response['Retry-After'] == '60'
+
+    # Failures are counted by all processes
+    server = fakeredis.FakeServer()
+    limiters = [
+        RedisFailureLimiter(fakeredis.FakeStrictRedis(server=server))
+        for _ in range(2)
+    ]
+    limiters[0].record_failure('10.0.0.1')
+    limiters[1].record_failure('10.0.0.1')
+    assert limiters[0].get_retry_after('10.0.0.1') is None
+    assert limiters[1].get_retry_after('10.0.0.1') > 59
+
+
+def test_redis_failure_limiter_store(redis_store, override_settings):
+    """
+    Test if failures are counted in redis with the clients of the token
+    store, and locally with other stores or while redis is unavailable
+    """
+    override_settings(
+        FAILED_AUTHENTICATION_LIMIT=2,
+        CIRCUIT_BREAKER_THRESHOLD=1,
+        CIRCUIT_BREAKER_RESET_TIMEOUT=60,
+    )
+    RedisFailureLimiter().record_failure('10.0.0.1')
+    limiter = RedisFailureLimiter()
+    limiter.record_failure('10.0.0.1')
+    assert limiter.get_retry_after('10.0.0.1') > 59
+    asyncio.run(limiter.arecord_failure('10.0.0.2'))
+    assert redis_store.client.keys('*failed_authentications*')
+
+    # Sentinel locations are not URLs: no client is created from them
+    override_settings(BACKEND={'LOCATION': ['sentinel://host1:26380']})
+    with patch.object(ServiceAccountUser, 'token_store', InMemoryTokenStore()):
+        limiter = RedisFailureLimiter()
+        limiter.record_failure('10.0.0.3')
+        limiter.record_failure('10.0.0.3')
+        assert limiter.get_retry_after('10.0.0.3') > 59
+
+    error = redis.ConnectionError('Connection refused')
+    with patch.object(redis_store.client, 'pipeline', side_effect=error):
+        limiter = RedisFailureLimiter()
+        limiter.record_failure('10.0.0.4')
+        assert ServiceAccountUser.circuit_breaker.is_open
+        limiter.record_failure('10.0.0.4')
+        assert limiter.get_retry_after('10.0.0.4') > 59
+
+
+def test_get_request_headers_many(redis_store, override_settings):
+    """
+    Test if headers are generated lazily for many users with one round-trip
+    to redis per token
+    """
+    override_settings(LOCAL_TOKEN_CACHE=False)
+    on_behalf_header = settings.SERVICE_ACCOUNT['ON_BEHALF_HEADER']
+    usernames = (f'user{i}' for i in itertools.count())  # never ends
+    batch = get_request_headers_many(usernames)
+    headers = [next(batch)]
+    round_trips = redis_round_trips.count
+    headers.extend(itertools.islice(batch, 999))
+    assert redis_round_trips.count == round_trips
+    assert headers[999][on_behalf_header] == 'user999'
+    assert len({h['Authorization'] for h in headers}) == 1
+
+    # The token is rotated when it is about to expire, even within a batch
+    ttl = settings.SERVICE_ACCOUNT['TOKEN_TTL']
+    threshold = settings.SERVICE_ACCOUNT['TOKEN_TTL_EXPIRY_THRESHOLD']
+    factory = RequestHeadersFactory()
+    batch = factory.many(['foo', 'bar'])
+    authorization = next(batch)['Authorization']
+    time.sleep(ttl - threshold + 0.5)  # Wait for token expiry
+    assert next(batch)['Authorization'] != authorization
+    assert factory('baz')['Authorization'] != authorization
 
 
-@patch('kobo_service_account.models.ServiceAccountUser.redis_client',
-       fakeredis.FakeStrictRedis())
 @pytest.mark.django_db
 def test_get_real_user():
     """
@@ -163,8 +649,185 @@ def test_get_real_user():
     assert user == real_user
 
 
-@patch('kobo_service_account.models.ServiceAccountUser.redis_client',
-       fakeredis.FakeStrictRedis())
+@pytest.mark.django_db
+def test_get_real_user_cache(override_settings, django_assert_num_queries):
+    """
+    Test if real users are cached across requests until they are saved
+    """
+    override_settings(REAL_USER_CACHE_SIZE=10, REAL_USER_FIELDS=['username'])
+    user = get_user_model().objects.create(username='foo')
+    request = FakeRequest(with_auth=True, username=user.username)
+    with django_assert_num_queries(1):
+        real_user = get_real_user(request)
+        assert get_real_user(request) == real_user
+    assert 'email' in real_user.get_deferred_fields()
+
+    user.email = 'foo@example.org'
+    user.save()
+    with django_assert_num_queries(1):
+        get_real_user(request)
+
+    user.delete()
+    with pytest.raises(get_user_model().DoesNotExist):
+        get_real_user(request)
+
+
+@pytest.mark.django_db
+def test_real_user_middleware(django_assert_num_queries):
+    """
+    Test if the real user is resolved lazily, once per request, and if its id
+    and username can be resolved without loading the user
+    """
+    user = get_user_model().objects.create(username='foo')
+    request = RequestFactory().get(
+        '/', headers={settings.SERVICE_ACCOUNT['ON_BEHALF_HEADER']: 'foo'}
+    )
+    request.user = ServiceAccountUser()
+
+    with django_assert_num_queries(1):
+        assert get_real_username(request) == 'foo'
+        assert get_real_user_id(request) == user.pk
+
+    def view(request):
+        assert request.real_user.username == 'foo'
+        assert get_real_user(request) == user
+        assert get_real_user_id(request) == user.pk
+        return HttpResponse()
+
+    with django_assert_num_queries(0):
+        RealUserMiddleware(view)  # Not resolved until accessed
+    with django_assert_num_queries(1):
+        RealUserMiddleware(view)(request)
+
+
+@pytest.mark.django_db
+def test_real_user_middleware_shared_lookup(django_assert_num_queries):
+    """
+    Test if all callers share the lookup of `RealUserMiddleware`, and if the
+    real user is resolved again once the service account is authenticated
+    """
+    user = get_user_model().objects.create(username='foo')
+    request = RequestFactory().get(
+        '/', headers={settings.SERVICE_ACCOUNT['ON_BEHALF_HEADER']: 'foo'}
+    )
+    request.user = AnonymousUser()
+    RealUserMiddleware(HttpResponse).process_request(request)
+
+    # Accessed before authentication, e.g. by another middleware
+    with django_assert_num_queries(0):
+        assert request.real_user.is_anonymous
+
+    # DRF sets `request.user` of the Django request too
+    drf_request = Request(request)
+    drf_request.user = ServiceAccountUser()
+    with django_assert_num_queries(1):
+        for _ in range(3):
+            assert get_real_user(drf_request) == user
+        assert get_real_user_id(drf_request) == user.pk
+        assert request.real_user.username == 'foo'
+        assert asyncio.run(aget_real_user(drf_request)) == user
+
+
+def test_authentication_middleware():
+    """
+    Test if the middleware authenticates sync and async requests without
+    DRF, and if DRF reuses its result
+    """
+    headers = get_request_headers('foo')
+    token = headers['Authorization'].split()[1]
+
+    def view(request):
+        assert isinstance(request.user, ServiceAccountUser)
+        with patch.object(
+            ServiceAccountUser,
+            'has_valid_authentication_token',
+            side_effect=AssertionError,
+        ):
+            drf_request = Request(
+                request, authenticators=[ServiceAccountAuthentication()]
+            )
+            assert drf_request.auth == token
+        return HttpResponse()
+
+    request = RequestFactory().get('/', headers=headers)
+    assert ServiceAccountAuthenticationMiddleware(view)(request).status_code == 200
+
+    async def async_view(request):
+        assert request.user.username == ServiceAccountUser().username
+        return HttpResponse()
+
+    middleware = ServiceAccountAuthenticationMiddleware(async_view)
+    request = AsyncRequestFactory().get('/', headers=headers)
+    assert asyncio.run(middleware(request)).status_code == 200
+
+    # Unsafe methods are not rejected by CSRF checks of session
+    # authentication, which would accept the user of the middleware first
+    @api_view(['POST'])
+    @authentication_classes(
+        [SessionAuthentication, ServiceAccountAuthentication]
+    )
+    @permission_classes([IsAuthenticated])
+    def drf_view(request):
+        assert isinstance(request.user, ServiceAccountUser)
+        return Response()
+
+    request = RequestFactory().post('/', headers=headers)
+    response = ServiceAccountAuthenticationMiddleware(drf_view)(request)
+    assert response.status_code == 200
+
+    # Other schemes are left to other authentication classes
+    request = RequestFactory().get('/', headers={'Authorization': 'Token abc'})
+    response = ServiceAccountAuthenticationMiddleware(
+        lambda request: HttpResponse(str(hasattr(request, 'user')))
+    )(request)
+    assert response.content == b'False'
+
+    request = AsyncRequestFactory().get(
+        '/', headers={'Authorization': 'ServiceAccountToken wrong'}
+    )
+    response = asyncio.run(middleware(request))
+    assert response.status_code == 401
+    assert response['WWW-Authenticate'] == ServiceAccountAuthentication.keyword
+
+
+@pytest.mark.django_db
+def test_permission_cache(django_assert_num_queries):
+    """
+    Test if the permissions of the service account are loaded once, until
+    permissions or migrations change them
+    """
+    user = ServiceAccountUser()
+    # User and group permissions of `ModelBackend`
+    with django_assert_num_queries(2):
+        permissions = user.get_all_permissions()
+        assert ServiceAccountUser().get_all_permissions() == permissions
+    assert 'auth.add_user' in permissions
+
+    content_type = ContentType.objects.get_for_model(get_user_model())
+    Permission.objects.create(
+        codename='audit_user', name='Can audit user', content_type=content_type
+    )
+    assert 'auth.audit_user' in user.get_all_permissions()
+
+    user.get_all_permissions()
+    auth_config = apps.get_app_config('auth')
+    post_migrate.send(sender=auth_config, app_config=auth_config)
+    with django_assert_num_queries(2):
+        user.get_all_permissions()
+
+
+def test_shared_instances(override_settings):
+    """
+    Test if authenticated requests share one instance per service identity
+    """
+    override_settings(SERVICE_IDENTITIES={'kpi': {}})
+    auth_class = ServiceAccountAuthentication()
+    auth_user, _ = auth_class.authenticate(FakeRequest(with_auth=True, username='foo'))
+    other_user, _ = auth_class.authenticate(FakeRequest(with_auth=True, username='bar'))
+    assert auth_user is other_user is ServiceAccountUser.get_instance()
+    assert ServiceAccountUser.get_instance('kpi').identity == 'kpi'
+
+
 def test_authentication_success():
     """
     Test if authentication is successful with correct headers
@@ -175,8 +838,6 @@ def test_authentication_success():
     assert isinstance(auth_user, ServiceAccountUser)
 
 
-@patch('kobo_service_account.models.ServiceAccountUser.redis_client',
-       fakeredis.FakeStrictRedis())
 def test_authentication_failure():
     """
     Test if authentication fails with wrong headers
@@ -192,6 +853,84 @@ def test_authentication_failure():
         auth_class.authenticate(request)
 
 
+def test_async_authentication(redis_store):
+    """
+    Test if async and sync APIs share the same tokens
+    """
+
+    async def _authenticate(headers):
+        request = SimpleNamespace(
+            META={'HTTP_AUTHORIZATION': headers['Authorization']}
+        )
+        auth_class = ServiceAccountAuthentication()
+        return await auth_class.aauthenticate(request)
+
+    async def _test():
+        # Token created by the async API is accepted by the sync API
+        headers = await aget_request_headers('foo')
+        assert headers[settings.SERVICE_ACCOUNT['ON_BEHALF_HEADER']] == 'foo'
+        _, token = headers['Authorization'].split()
+        assert ServiceAccountUser.has_valid_authentication_token(token)
+
+        # Token created by the sync API is accepted by the async API
+        ServiceAccountUser.token_cache.clear()
+        redis_store.delete(ServiceAccountUser.redis_key)
+        headers = get_request_headers('foo')
+        auth_user, token = await _authenticate(headers)
+        assert isinstance(auth_user, ServiceAccountUser)
+
+        # Validated tokens are cached as well
+        redis_store.delete(ServiceAccountUser.redis_key)
+        assert await ServiceAccountUser.ahas_valid_authentication_token(token)
+
+        headers['Authorization'] += '-wrong-auth'
+        with pytest.raises(AuthenticationFailed):
+            await _authenticate(headers)
+
+    asyncio.run(_test())
+
+
+@patch('kobo_service_account.models.ServiceAccountUser.token_store', None)
+def test_signed_tokens(override_settings):
+    """
+    Test if signed tokens are created and validated without redis, and if
+    tokens signed with the previous key are still valid
+    """
+    override_settings(
+        TOKEN_MODE='signed',
+        SIGNING_KEYS=[{'ID': 'key1', 'SECRET': 'first-secret'}],
+    )
+    old_token = ServiceAccountUser.get_or_create_authentication_token()
+    assert ServiceAccountUser.has_valid_authentication_token(old_token)
+    test_authentication_success()
+
+    # Key rollover
+    override_settings(SIGNING_KEYS=[
+        {'ID': 'key2', 'SECRET': 'second-secret'},
+        {'ID': 'key1', 'SECRET': 'first-secret'},
+    ])
+    ServiceAccountUser.token_cache.clear()
+    new_token = ServiceAccountUser.get_or_create_authentication_token()
+    assert new_token.split('.')[2] == 'key2'
+    assert ServiceAccountUser.has_valid_authentication_token(old_token)
+    assert ServiceAccountUser.has_valid_authentication_token(new_token)
+
+    # Previous key is removed, tampered or expired tokens are rejected
+    override_settings(SIGNING_KEYS=[{'ID': 'key2', 'SECRET': 'second-secret'}])
+    assert not ServiceAccountUser.has_valid_authentication_token(old_token)
+    version, expires_at, kid, signature = new_token.split('.')
+    for token in [
+        f'{version}.{int(expires_at) + 1}.{kid}.{signature}',
+        f'{version}.{expires_at}.key1.{signature}',
+        f'{version}.{expires_at}.{kid}.{signature[:-1]}',
+        'not-a-signed-token',
+    ]:
+        assert not ServiceAccountUser.has_valid_authentication_token(token)
+
+    with patch('time.time', return_value=int(expires_at) + 1):
+        assert not ServiceAccountUser.has_valid_authentication_token(new_token)
+
+
 def test_authentication_success_with_whitelisted_hosts(override_settings):
     """
     Test if authentication is still successful when a host is whitelisted and
@@ -209,3 +948,303 @@ def test_authentication_failure_with_whitelisted_hosts(override_settings):
     override_settings(WHITELISTED_HOSTS=['fakeserver'])
     with pytest.raises(HostNotAllowedException) as e:
         test_authentication_success()
+
+
+def test_host_policy():
+    """
+    Test if hosts are matched regardless of case and port, with exact names
+    and patterns
+    """
+    host_policy = HostPolicy([
+        'TestServer:8000', 'api-*.example.org', '.kobo.local', '[::1]',
+    ])
+    for host in [
+        'testserver', 'TESTSERVER:80', 'testserver.', 'api-1.example.org:443',
+        'kobo.local', 'kf.kobo.local', '[::1]:8000',
+    ]:
+        assert host_policy.is_allowed(host)
+
+    for host in [
+        'fakeserver', 'api.example.org', 'api-1.kf.example.org',
+        'kobo.local.evil.org', 'testserver:bad-port', '',
+    ]:
+        assert not host_policy.is_allowed(host)
+
+    assert HostPolicy(['*']).is_allowed('anything')
+
+
+def test_host_rejected_before_token_validation(redis_store, override_settings):
+    """
+    Test if disallowed hosts are rejected without querying the token store
+    """
+    override_settings(WHITELISTED_HOSTS=['fakeserver'])
+    request = SimpleNamespace(
+        META=FakeRequest(with_auth=True, username='foo').META
+    )
+    redis_round_trips.reset()
+    with pytest.raises(HostNotAllowedException):
+        ServiceAccountAuthentication().authenticate(request)
+    assert redis_round_trips.count == 0
+
+
+@pytest.mark.django_db
+def test_metrics(redis_store, override_settings):
+    """
+    Test if validations, rotations, round-trips and real user lookups are
+    recorded by the in-memory registry
+    """
+    override_settings(
+        METRICS_SINK='kobo_service_account.metrics.InMemoryMetricsSink',
+        VALIDATED_TOKEN_CACHE_SIZE=0,
+    )
+    sink = get_metrics_sink()
+    sink.clear()
+    user = get_user_model().objects.create(username='foo')
+    request = FakeRequest(with_auth=True, username=user.username)
+    ServiceAccountAuthentication().authenticate(request)
+    with pytest.raises(AuthenticationFailed):
+        ServiceAccountAuthentication().authenticate(
+            FakeRequest(with_auth=True, username='foo', wrong_auth=True)
+        )
+    get_real_user(request)
+
+    assert sink.get_counter('token_rotations_total') == 1
+    assert sink.get_counter('token_validations_total', {'outcome': 'current'}) == 1
+    assert sink.get_counter('token_validations_total', {'outcome': 'miss'}) == 1
+    assert sink.get_counter('real_user_lookups_total', {'source': 'db'}) == 1
+    latency = sink.get_histogram('token_validation_seconds', {'outcome': 'current'})
+    assert latency['count'] == 1
+    round_trips = sink.get_histogram('redis_round_trips_per_request')
+    assert round_trips['count'] == 2
+    assert round_trips['sum'] == 2
+    assert (
+        'kobo_service_account_token_validations_total{outcome="miss"} 1'
+        in sink.render()
+    )
+
+
+@pytest.mark.parametrize('family, host', [
+    (socket.AF_INET, '127.0.0.1'),
+    (socket.AF_INET6, '::1'),
+])
+def test_statsd_metrics(family, host):
+    """
+    Test if metrics are sent to statsd over UDP, over IPv4 or IPv6
+    """
+    server = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        server.bind((host, 0))
+    except OSError:
+        server.close()
+        pytest.skip(f'{host} is not available')
+    server.settimeout(1)
+    port = server.getsockname()[1]
+    with server, dj_override_settings(SERVICE_ACCOUNT={
+        **settings.SERVICE_ACCOUNT,
+        'METRICS_SINK': 'kobo_service_account.metrics.StatsdMetricsSink',
+        'METRICS_OPTIONS': {'HOST': host, 'PORT': port},
+    }):
+        token = ServiceAccountUser.get_or_create_authentication_token()
+        assert server.recv(1024) == b'kobo_service_account.token_rotations_total:1|c'
+        ServiceAccountUser.has_valid_authentication_token(token)
+        packet = server.recv(1024).decode()
+        assert re.fullmatch(
+            r'kobo_service_account\.token_validation:[0-9.e-]+\|ms\|#outcome:current',
+            packet,
+        )
+
+
+@pytest.mark.parametrize('identity', ['kpi.v2', 'kpi v2', ''])
+def test_invalid_service_identity_names(identity, override_settings):
+    """
+    Test if identities which could not be parsed back from their tokens are
+    rejected
+    """
+    with pytest.raises(ImproperlyConfigured):
+        override_settings(SERVICE_IDENTITIES={identity: {}})
+
+
+def test_service_identities_signed_tokens(override_settings):
+    """
+    Test if service identities cannot be used with signed tokens, which
+    would ignore them
+    """
+    override_settings(SIGNING_KEYS=[{'ID': 'k1', 'SECRET': 'secret'}])
+    with pytest.raises(ImproperlyConfigured):
+        override_settings(TOKEN_MODE='signed', SERVICE_IDENTITIES={'kpi': {}})
+    with pytest.raises(ImproperlyConfigured):
+        override_settings(SERVICE_IDENTITIES={}, SERVICE_IDENTITY='kpi')
+
+
+def test_service_identities(redis_store, override_settings):
+    """
+    Test if each service identity has its own token pair and TTL, and if the
+    identity is found from the token
+    """
+    override_settings(SERVICE_IDENTITIES={'kpi': {'TOKEN_TTL': 10}, 'kobocat': {}})
+    token = ServiceAccountUser.get_or_create_authentication_token()
+    kpi_token, kpi_ttl = (
+        ServiceAccountUser.get_or_create_authentication_token_with_ttl(
+            identity='kpi'
+        )
+    )
+    kobocat_token = ServiceAccountUser.get_or_create_authentication_token('kobocat')
+    assert kpi_token.startswith('kpi.')
+    assert 9 < kpi_ttl <= 10
+    # Tokens without expiry get the TTL of their identity
+    assert ServiceAccountUser._match_token(
+        kpi_token, ((kpi_token, -1), (None, -2)), 'kpi'
+    )[0] == 10
+    assert len({token, kpi_token, kobocat_token}) == 3
+    assert ServiceAccountUser.get_token_identity(kpi_token) == 'kpi'
+    assert ServiceAccountUser.get_token_identity(token) is None
+    assert ServiceAccountUser.get_token_identity('unknown.token') is None
+
+    # Each identity has its own token pair
+    kpi_keys = ServiceAccountUser._get_token_keys('kpi')
+    assert kpi_keys.current.startswith('kobo-service-account:kpi::')
+    assert redis_store.get(kpi_keys.current) == kpi_token
+
+    auth_class = ServiceAccountAuthentication()
+    for headers, identity in [
+        (get_request_headers('foo', identity='kpi'), 'kpi'),
+        (get_request_headers('foo'), None),
+    ]:
+        request = SimpleNamespace(META={
+            'HTTP_AUTHORIZATION': headers['Authorization'],
+        })
+        auth_user, _ = auth_class.authenticate(request)
+        assert auth_user.identity == identity
+
+    # A token is only valid for its own identity
+    assert not ServiceAccountUser.has_valid_authentication_token(
+        'kobocat.' + kpi_token.split('.')[1]
+    )
+    with pytest.raises(ImproperlyConfigured):
+        ServiceAccountUser.get_or_create_authentication_token('unknown')
+
+    # Rotating the token of an identity keeps validated tokens of others
+    assert ServiceAccountUser.has_valid_authentication_token(kobocat_token)
+    assert kpi_token in ServiceAccountUser.validated_tokens
+    ServiceAccountUser.get_or_create_authentication_token_with_ttl(
+        min_ttl=100, identity='kobocat'
+    )
+    ServiceAccountUser.has_valid_authentication_token(token)
+    assert kpi_token in ServiceAccountUser.validated_tokens
+    assert kobocat_token not in ServiceAccountUser.validated_tokens
+
+
+def test_token_ring(redis_store, override_settings):
+    """
+    Test if every token of the ring is accepted with one round-trip, even
+    after many rotations
+    """
+    override_settings(
+        TOKEN_RING_SIZE=3, VALIDATED_TOKEN_CACHE_SIZE=0, LOCAL_TOKEN_CACHE=False
+    )
+    ttl = settings.SERVICE_ACCOUNT['TOKEN_TTL']
+    tokens = [
+        ServiceAccountUser.get_or_create_authentication_token_with_ttl(
+            min_ttl=ttl + 1
+        )[0]
+        for _ in range(4)
+    ]
+    assert len(set(tokens)) == 4
+    assert ServiceAccountUser.get_or_create_authentication_token() == tokens[-1]
+
+    for token in tokens[1:]:
+        redis_round_trips.reset()
+        assert ServiceAccountUser.has_valid_authentication_token(token)
+        assert redis_round_trips.count == 1
+    assert not ServiceAccountUser.has_valid_authentication_token(tokens[0])
+
+    async def _test():
+        assert await ServiceAccountUser.ahas_valid_authentication_token(tokens[1])
+        assert (
+            await ServiceAccountUser.aget_or_create_authentication_token()
+            == tokens[-1]
+        )
+
+    asyncio.run(_test())
+
+
+def test_circuit_breaker(override_settings):
+    """
+    Test if known tokens are still accepted and sent while the token store is
+    unavailable, and if everything else fails fast
+    """
+    override_settings(
+        CIRCUIT_BREAKER_THRESHOLD=2,
+        CIRCUIT_BREAKER_RESET_TIMEOUT=60,
+    )
+    token = ServiceAccountUser.get_or_create_authentication_token()
+    assert ServiceAccountUser.has_valid_authentication_token(token)
+
+    store = ServiceAccountUser.token_store
+    error = redis.ConnectionError('Connection refused')
+    with patch.object(store, 'get_pair', side_effect=error) as get_pair, \
+            patch.object(store, 'get_with_ttl', side_effect=error):
+        for _ in range(2):
+            with pytest.raises(TokenStoreUnavailable):
+                ServiceAccountUser.has_valid_authentication_token('unknown')
+        assert ServiceAccountUser.circuit_breaker.is_open
+
+        # Fail fast, without calling the store
+        ServiceAccountUser.validated_tokens.discard(token)
+        with pytest.raises(TokenStoreUnavailable):
+            ServiceAccountUser.has_valid_authentication_token(token)
+        assert get_pair.call_count == 2
+
+        # Tokens seen before are still accepted, and sent
+        ServiceAccountUser.validated_tokens.add(token, 1, 10)
+        assert ServiceAccountUser.has_valid_authentication_token(token)
+        assert ServiceAccountUser.get_or_create_authentication_token_with_ttl(
+            min_ttl=10
+        )[0] == token
+
+        ServiceAccountUser.token_cache.clear()
+        with pytest.raises(TokenStoreUnavailable):
+            ServiceAccountUser.get_or_create_authentication_token()
+
+        request = SimpleNamespace(META={
+            'HTTP_AUTHORIZATION': 'ServiceAccountToken unknown',
+            'HTTP_HOST': 'testserver',
+        })
+        with pytest.raises(TokenStoreUnavailable) as e:
+            ServiceAccountAuthentication().authenticate(request)
+        assert e.value.status_code == 503
+
+    # One trial call after the reset timeout closes the circuit again
+    override_settings(CIRCUIT_BREAKER_RESET_TIMEOUT=0)
+    assert ServiceAccountUser.get_or_create_authentication_token() == token
+    assert not ServiceAccountUser.circuit_breaker.is_open
+
+
+def test_circuit_breaker_subscription(redis_store, override_settings):
+    """
+    Test if failed subscriptions to invalidations count as failures, and are
+    not attempted again while the circuit is open
+    """
+    override_settings(
+        CIRCUIT_BREAKER_THRESHOLD=1,
+        CIRCUIT_BREAKER_RESET_TIMEOUT=60,
+    )
+    error = redis.ConnectionError('Connection refused')
+    with patch.object(
+        redis_store.client, 'pubsub', side_effect=error
+    ) as pubsub, patch.object(redis_store, 'get_pair_for') as get_pair_for:
+        with pytest.raises(TokenStoreUnavailable):
+            ServiceAccountUser.has_valid_authentication_token('unknown')
+        assert ServiceAccountUser.circuit_breaker.is_open
+        get_pair_for.assert_not_called()
+
+        with pytest.raises(TokenStoreUnavailable):
+            ServiceAccountUser.has_valid_authentication_token('unknown')
+        assert pubsub.call_count == 1
+
+    # Threads do not wait for the one polling
+    subscriber = redis_store._subscriber
+    with subscriber._lock:
+        assert not subscriber.poll(
+            redis_store.client, ServiceAccountUser.redis_channel
+        )
@@ -0,0 +1,401 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+
+import fakeredis
+import pytest
+import redis.cluster
+from mock import patch
+
+from kobo_service_account.cache import SharedMemoryPairCache, ValidatedTokenCache
+from kobo_service_account.exceptions import TokenRotationLockTimeout
+from kobo_service_account.models import ServiceAccountUser
+from kobo_service_account.stores import (
+    DjangoCacheTokenStore,
+    InMemoryTokenStore,
+    RedisClusterTokenStore,
+    RedisReplicaTokenStore,
+    RedisSentinelTokenStore,
+    RedisTokenStore,
+    SharedMemoryTokenStore,
+)
+
+keys = ServiceAccountUser.token_keys
+
+
+@pytest.fixture(params=['memory', 'django-cache', 'redis', 'shared-memory'])
+def token_store(request, override_settings, tmp_path):
+    if request.param == 'memory':
+        yield InMemoryTokenStore()
+    elif request.param == 'shared-memory':
+        override_settings(BACKEND={
+            'LOCATION': 'redis://localhost/',
+            'OPTIONS': {'SHARED_MEMORY_DIR': str(tmp_path)},
+        })
+        yield SharedMemoryTokenStore(InMemoryTokenStore())
+    elif request.param == 'django-cache':
+        store = DjangoCacheTokenStore()
+        yield store
+        store.cache.clear()
+    else:
+        yield RedisTokenStore(fakeredis.FakeStrictRedis())
+
+
+def test_get_set_delete(token_store):
+    """
+    Test if tokens are stored with their time to live
+    """
+    assert token_store.get_with_ttl(keys.current) == (None, -2)
+    token_store.set(keys.current, 'token', 10)
+    token, ttl = token_store.get_with_ttl(keys.current)
+    assert token == 'token'
+    assert 9 < ttl <= 10
+
+    token_store.set(keys.obsolete, 'obsolete-token', 0.5)
+    (token, _), (obsolete_token, obsolete_ttl) = token_store.get_pair(keys)
+    assert (token, obsolete_token) == ('token', 'obsolete-token')
+    assert obsolete_ttl <= 0.5
+
+    time.sleep(0.6)
+    assert token_store.get(keys.obsolete) is None
+    token_store.delete(keys.current)
+    assert token_store.get(keys.current) is None
+
+
+def test_rotate(token_store):
+    """
+    Test if the current token is kept as obsolete on rotation, and only
+    replaced when it is about to expire
+    """
+    assert token_store.rotate(keys, 'first-token', 10, 5) == ('first-token', 10)
+    assert token_store.get(keys.obsolete) is None
+
+    token, ttl = token_store.rotate(keys, 'second-token', 10, 5)
+    assert token == 'first-token'
+    assert 9 < ttl <= 10
+
+    assert token_store.rotate(keys, 'second-token', 10, 11) == ('second-token', 10)
+    obsolete_token, obsolete_ttl = token_store.get_with_ttl(keys.obsolete)
+    assert obsolete_token == 'first-token'
+    assert obsolete_ttl <= 10
+
+
+def test_rotate_single_winner(token_store):
+    """
+    Test if concurrent rotations all return the token of a single winner
+    """
+    token_store.set(keys.current, 'old-token', 1)
+    barrier = threading.Barrier(8)
+    tokens = []
+
+    def _rotate(i):
+        barrier.wait()
+        token, _ = token_store.rotate(keys, f'token-{i}', 10, 5)
+        tokens.append(token)
+
+    threads = [threading.Thread(target=_rotate, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(tokens)) == 1
+    assert token_store.get(keys.obsolete) == 'old-token'
+
+
+def test_django_cache_rotation_lock():
+    """
+    Test if the rotation lock is only released by its owner, and if lock
+    contention does not look like an outage of the token store
+    """
+    token_store = DjangoCacheTokenStore()
+    lock_key = f'{keys.current}::lock'
+    try:
+        # The lock expired during the rotation and was acquired by another
+        # process, which keeps it.
+        def _rotate(current_token, current_ttl):
+            token_store.cache.set(lock_key, 'other-owner')
+
+        token_store._rotate_with_lock(
+            lock_key, lambda: (None, -2), _rotate, 'token', 10, 5
+        )
+        assert token_store.cache.get(lock_key) == 'other-owner'
+
+        with patch.object(DjangoCacheTokenStore, 'LOCK_TIMEOUT', 0.05):
+            # The current token is returned, even if it expires soon
+            token_store.set(keys.current, 'current-token', 2)
+            assert token_store.rotate(keys, 'token', 10, 5)[0] == 'current-token'
+
+            token_store.delete(keys.current)
+            with pytest.raises(TokenRotationLockTimeout):
+                token_store.rotate(keys, 'token', 10, 5)
+            assert not issubclass(
+                TokenRotationLockTimeout, token_store.unavailable_errors
+            )
+    finally:
+        token_store.cache.clear()
+
+
+def test_invalidation(token_store):
+    """
+    Test if caches are cleared on rotation by stores which support
+    invalidations
+    """
+    cache = ValidatedTokenCache()
+    if not token_store.poll_invalidation(keys.channel, cache):
+        assert isinstance(token_store, DjangoCacheTokenStore)
+        return
+
+    # Wait for the subscription to be confirmed
+    while not token_store.poll_invalidation(keys.channel, cache):
+        pass
+    cache.add('token', 10, 10)
+    token_store.rotate(keys, 'token', 10, 5)
+    token_store.poll_invalidation(keys.channel, cache)
+    assert 'token' not in cache
+
+
+def test_sentinel_settings(override_settings):
+    """
+    Test if sentinels are read from the backend settings
+    """
+    override_settings(BACKEND={
+        'LOCATION': ['sentinel://host1:26380', 'host2'],
+        'OPTIONS': {'SERVICE_NAME': 'mymaster'},
+    })
+    token_store = RedisSentinelTokenStore()
+    assert token_store._get_sentinels() == [('host1', 26380), ('host2', 26379)]
+    assert token_store.client.connection_pool.service_name == 'mymaster'
+
+
+def test_replica_reads(override_settings):
+    """
+    Test if tokens are read from replicas, and from the primary when a
+    replica lags behind or is down
+    """
+    primary, replica = fakeredis.FakeServer(), fakeredis.FakeServer()
+    token_store = RedisReplicaTokenStore(
+        fakeredis.FakeStrictRedis(server=primary),
+        fakeredis.aioredis.FakeRedis(server=primary),
+        [fakeredis.FakeStrictRedis(server=replica)],
+        [fakeredis.aioredis.FakeRedis(server=replica)],
+    )
+    RedisTokenStore(fakeredis.FakeStrictRedis(server=replica)).set(
+        keys.current, 'replica-token', 10
+    )
+    token_store.set(keys.current, 'primary-token', 10)
+
+    assert token_store.get_current(keys)[0] == 'replica-token'
+    assert token_store.get_with_ttl(keys.current)[0] == 'primary-token'
+    (token, _), _ = token_store.get_pair_for(keys, 'replica-token')
+    assert token == 'replica-token'
+    # Not replicated yet
+    (token, _), _ = token_store.get_pair_for(keys, 'primary-token')
+    assert token == 'primary-token'
+    token_store.rotate_ring(keys, 'ring-token', 10, 5, 3)
+    assert token_store.get_ring_token_ttl(keys, 'ring-token') > 9
+
+    async def _aget():
+        (token, _), _ = await token_store.aget_pair_for(keys, 'replica-token')
+        (other_token, _), _ = await token_store.aget_pair_for(
+            keys, 'primary-token'
+        )
+        return token, other_token
+
+    assert asyncio.run(_aget()) == ('replica-token', 'primary-token')
+
+    replica.connected = False
+    assert token_store.get_current(keys)[0] == 'primary-token'
+    (token, _), _ = token_store.get_pair(keys)
+    assert token == 'primary-token'
+
+    override_settings(BACKEND={
+        'LOCATION': 'redis://primary/',
+        'OPTIONS': {'REPLICAS': 'redis://replica1/, redis://replica2:6380/'},
+    })
+    token_store = RedisReplicaTokenStore()
+    assert [
+        client.connection_pool.connection_kwargs['host']
+        for client in token_store.replica_clients
+    ] == ['replica1', 'replica2']
+
+
+def test_cluster_rotation(override_settings):
+    """
+    Test if token pairs are read and rotated in one transaction through
+    Redis Cluster
+    """
+    server = fakeredis.FakeServer()
+
+    class FakeClusterNode(fakeredis.FakeStrictRedis):
+        # A single node serving all the slots
+        def __init__(self, *args, **kwargs):
+            super().__init__(server=server)
+
+        def execute_command(self, *args, **options):
+            if args[0] == 'CLUSTER SLOTS':
+                return [[0, 16383, [b'127.0.0.1', 7000, b'node']]]
+            return super().execute_command(*args, **options)
+
+    override_settings(
+        TOKEN_STORE='kobo_service_account.stores.RedisClusterTokenStore'
+    )
+    cluster_keys = ServiceAccountUser.token_keys
+    with patch('redis.cluster.Redis', FakeClusterNode):
+        token_store = RedisClusterTokenStore(
+            redis.cluster.RedisCluster(host='127.0.0.1', port=7000)
+        )
+        assert token_store.rotate(cluster_keys, 'token', 10, 5) == ('token', 10)
+        assert token_store.rotate(cluster_keys, 'new-token', 10, 5)[0] == 'token'
+        assert token_store.rotate(cluster_keys, 'new-token', 10, 11) == (
+            'new-token', 10
+        )
+        (current, _), (obsolete, _) = token_store.get_pair(cluster_keys)
+        assert (current, obsolete) == ('new-token', 'token')
+
+        token_store.rotate_ring(cluster_keys, 'ring-token', 10, 5, 3)
+        assert token_store.get_ring_token_ttl(cluster_keys, 'ring-token') > 9
+
+
+def test_rotate_ring(token_store):
+    """
+    Test if ring tokens stay valid until their own expiry, unless newer
+    tokens evict them
+    """
+    assert token_store.get_ring_current(keys) == (None, -2)
+    assert token_store.rotate_ring(keys, 'token-0', 10, 5, 3) == ('token-0', 10)
+    token, ttl = token_store.rotate_ring(keys, 'token-1', 10, 5, 3)
+    assert token == 'token-0'
+
+    for i in range(1, 4):
+        token_store.rotate_ring(keys, f'token-{i}', 10, 11, 3)
+
+    token, ttl = token_store.get_ring_current(keys)
+    assert token == 'token-3'
+    assert 9 < ttl <= 10
+    assert token_store.get_ring_token_ttl(keys, 'token-0') is None  # evicted
+    assert token_store.get_ring_token_ttl(keys, 'token-1') > 9
+    assert token_store.get_ring_token_ttl(keys, 'wrong-token') is None
+
+    short_keys = keys._replace(ring=f'{keys.ring}::short')
+    token_store.rotate_ring(short_keys, 'short-token', 0.5, 5, 3)
+    assert token_store.get_ring_token_ttl(short_keys, 'short-token') <= 0.5
+    time.sleep(0.6)
+    assert token_store.get_ring_token_ttl(short_keys, 'short-token') is None
+    assert token_store.get_ring_current(short_keys) == (None, -2)
+
+
+def test_shared_memory_single_refresh(override_settings, tmp_path):
+    """
+    Test if one process per host reads the token pair while the others wait
+    for it, and if readers retry while the pair is being written
+    """
+    override_settings(BACKEND={
+        'LOCATION': 'redis://localhost/',
+        'OPTIONS': {'SHARED_MEMORY_DIR': str(tmp_path)},
+    })
+    reads_path = tmp_path / 'reads'
+
+    class SlowTokenStore(InMemoryTokenStore):
+        def get_pair(self, keys):
+            with open(reads_path, 'a') as f:
+                f.write('.')
+            time.sleep(0.2)
+            return ('token', 10), ('obsolete-token', 5)
+
+    token_store = SharedMemoryTokenStore(SlowTokenStore())
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(8)
+    results = ctx.Queue()
+
+    def _validate():
+        barrier.wait()
+        pair = token_store.get_pair_for(keys, 'obsolete-token')
+        results.put(pair[1][0])
+
+    processes = [ctx.Process(target=_validate) for _ in range(8)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=10)
+    assert {results.get(timeout=1) for _ in processes} == {'obsolete-token'}
+    assert reads_path.read_text() == '.'
+
+    # A token which does not match the pair refreshes it
+    (token, ttl), _ = token_store.get_pair_for(keys, 'new-token')
+    assert token == 'token' and 9 < ttl <= 10
+    assert reads_path.read_text() == '..'
+
+    # Readers never return a pair which is being written
+    cache = SharedMemoryPairCache(str(tmp_path / 'cache'))
+    with cache.lock():
+        cache.write('token', time.time() + 10, None, 0, time.time())
+    assert cache.read().current == 'token'
+    cache._version.pack_into(cache._mmap, 0, 3)
+    assert cache.read() is None
+
+
+def test_shared_memory_private_files(override_settings, tmp_path):
+    """
+    Test if shared memory files which other users can write (or replace) are
+    not trusted
+    """
+    path = tmp_path / 'cache'
+    path.touch(mode=0o644)
+    with pytest.raises(PermissionError):
+        SharedMemoryPairCache(str(path))
+
+    path.chmod(0o600)
+    with patch('os.geteuid', return_value=os.geteuid() + 1):
+        with pytest.raises(PermissionError):
+            SharedMemoryPairCache(str(path))
+
+    link = tmp_path / 'link'
+    link.symlink_to(path)
+    with pytest.raises(OSError):
+        SharedMemoryPairCache(str(link))
+
+    # The private directory has been created beforehand by another user:
+    # the wrapped store is read directly.
+    override_settings(BACKEND={
+        'LOCATION': 'redis://localhost/',
+        'OPTIONS': {'SHARED_MEMORY_DIR': str(tmp_path)},
+    })
+    private_dir = tmp_path / f'kobo-service-account-{os.geteuid()}'
+    private_dir.mkdir(mode=0o777)
+    private_dir.chmod(0o777)
+    token_store = SharedMemoryTokenStore(InMemoryTokenStore())
+    token_store.set(keys.current, 'token', 10)
+    (token, ttl), _ = token_store.get_pair_for(keys, 'token')
+    assert token == 'token' and 9 < ttl <= 10
+    assert not any(private_dir.iterdir())
+
+    # Files are created in a private directory otherwise
+    private_dir.rmdir()
+    token_store = SharedMemoryTokenStore(InMemoryTokenStore())
+    token_store.get_pair(keys)
+    assert private_dir.stat().st_mode & 0o777 == 0o700
+    assert len(list(private_dir.iterdir())) == 1
+
+
+def test_shared_memory_expired_tokens(override_settings, tmp_path):
+    """
+    Test if tokens which expired while being read from the other store are
+    not shared as valid ones
+    """
+    override_settings(BACKEND={
+        'LOCATION': 'redis://localhost/',
+        'OPTIONS': {'SHARED_MEMORY_DIR': str(tmp_path)},
+    })
+    store = InMemoryTokenStore()
+    token_store = SharedMemoryTokenStore(store)
+    with patch.object(
+        store, 'get_pair', return_value=(('token', -2), (None, -2))
+    ):
+        token_store.get_pair_for(keys, 'token')
+
+    store.set(keys.current, 'new-token', 10)
+    (token, _), _ = token_store.get_pair_for(keys, 'token')
+    assert token == 'new-token'